@@ -0,0 +1,223 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sys
+import uuid
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+from cli import load_app
+from ledger import CASH_COLS, cashbook_frame
+
+# --- API CHỈ ĐỌC (JSON) ---
+# Cho nhân viên giao hàng và file kế toán đọc đơn hàng, công nợ, sổ quỹ, hoa hồng mà không mở app
+# và không gọi thêm Google Sheets: dữ liệu lấy từ cùng LocalStore/bản lưu SQLite của app.
+#   python api.py --port 8502
+# Đặt biến API_TOKEN để bắt buộc "Authorization: Bearer <token>" (hoặc ?token=<token> cho bảng tính
+# không gửi được header).
+# Mỗi phản hồi có ETag theo phiên bản dữ liệu; gửi lại If-None-Match khi không có gì đổi chỉ nhận 304.
+#   GET /orders?status=Giao hàng&from=2025-01-01&to=2025-01-31&staff=Nam&limit=100&offset=0
+#   GET /orders/<mã đơn>   /debtors   /debtors/<mã khách>   /cashbook?from=&to=&method=TM   /commissions?from=&to=
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# Phiên bản dữ liệu chỉ có nghĩa trong một tiến trình: khởi động lại thì ETag cũ không còn khớp
+BOOT = uuid.uuid4().hex[:8]
+ROUTE_SHEETS = {"orders": ["Orders"], "debtors": ["Orders"], "cashbook": ["Cashbook"], "commissions": ["Orders"]}
+
+app = None
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _num(value):
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+
+def _day(value):
+    text = str(value or "").strip()[:10]
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try: return datetime.strptime(text, fmt).date()
+        except ValueError: continue
+    return None
+
+
+def _date_param(params, name):
+    if not params.get(name): return None
+    try: return datetime.strptime(params[name], "%Y-%m-%d").date()
+    except ValueError: raise ApiError(400, f"{name} phải có dạng YYYY-MM-DD")
+
+
+def _in_range(day, start, end):
+    if start is None and end is None: return True
+    return day is not None and (start is None or day >= start) and (end is None or day <= end)
+
+
+def _json(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else str(value)
+
+
+# --- DỮ LIỆU (cache theo phiên bản sheet: dữ liệu đổi thì khóa đổi) ---
+@functools.lru_cache(maxsize=32)
+def order_list(versions, status, start, end, staff):
+    out = []
+    for o in app.fetch_all_orders():
+        if status and o.get('status') != status: continue
+        if staff and o['financial'].get('staff') != staff: continue
+        if not _in_range(_day(o.get('date')), start, end): continue
+        out.append(o)
+    return out
+
+
+@functools.lru_cache(maxsize=8)
+def order_by_id(versions):
+    return {str(o.get('order_id')): o for o in app.fetch_all_orders()}
+
+
+@functools.lru_cache(maxsize=8)
+def debtor_list(versions, today):
+    return app.receivables().aging(today)
+
+
+@functools.lru_cache(maxsize=16)
+def cashbook_list(versions, start, end, method):
+    df = cashbook_frame(app.fetch_cashbook())
+    if method: df = df[df['TM/CK'] == method]
+    if start is not None: df = df[df['Day'] >= datetime.combine(start, datetime.min.time())]
+    if end is not None: df = df[df['Day'] <= datetime.combine(end, datetime.min.time())]
+    rows = df[CASH_COLS].to_dict('records')
+    summary = {'thu': float(df['Thu'].sum()), 'chi': float(df['Chi'].sum())}
+    if start is not None and method in (None, "TM"):
+        # Số dư đầu kỳ chỉ có ý nghĩa với quỹ tiền mặt
+        summary['opening'] = app.get_cash_ledger().opening_balance(start)
+        summary['closing'] = summary['opening'] + summary['thu'] - summary['chi']
+    return rows, summary
+
+
+@functools.lru_cache(maxsize=16)
+def commission_summary(versions, start, end, staff):
+    by_staff = {}
+    for o in order_list(versions, None, start, end, staff):
+        fin = o['financial']
+        s = by_staff.setdefault(fin.get('staff', ''), {'staff': fin.get('staff', ''), 'orders': 0, 'total': 0.0, 'paid': 0.0, 'pending': 0.0})
+        comm = _num(fin.get('total_comm'))
+        s['orders'] += 1
+        s['total'] += comm
+        s['paid' if fin.get('commission_status') == "Đã chi" else 'pending'] += comm
+    return sorted(by_staff.values(), key=lambda s: -s['total'])
+
+
+# --- ĐỊNH TUYẾN ---
+def data_versions(route):
+    # Gọi get() để dữ liệu hết hạn được làm mới ngầm như trong app, rồi đọc phiên bản hiện tại
+    store = app.get_local_store()
+    sheets = ROUTE_SHEETS[route]
+    store.prefetch(sheets)
+    for s in sheets: store.get(s)
+    return tuple(store.version_of(s) for s in sheets)
+
+
+def page(items, params, path):
+    try:
+        limit = min(max(int(params.get('limit') or DEFAULT_LIMIT), 1), MAX_LIMIT)
+        offset = max(int(params.get('offset') or 0), 0)
+    except ValueError: raise ApiError(400, "limit/offset phải là số nguyên")
+    nxt = None
+    if offset + limit < len(items): nxt = path + "?" + urlencode(dict(params, offset=offset + limit, limit=limit))
+    return {'total': len(items), 'offset': offset, 'limit': limit, 'next': nxt, 'items': items[offset:offset + limit]}
+
+
+def resolve(path, params, versions):
+    route, _, rest = path.strip("/").partition("/")
+    # Mã đơn có dấu "/" (vd. 015/DH.24) nên phần còn lại của đường dẫn là cả mã
+    ident = unquote(rest)
+    start, end = _date_param(params, 'from'), _date_param(params, 'to')
+    if route == "orders":
+        if ident:
+            order = order_by_id(versions).get(ident)
+            if not order: raise ApiError(404, "Không tìm thấy đơn hàng")
+            return order
+        return page(order_list(versions, params.get('status'), start, end, params.get('staff')), params, path)
+    if route == "debtors":
+        if ident:
+            statement = app.receivables().statement(ident)
+            if not statement: raise ApiError(404, "Khách không còn nợ")
+            return statement
+        return page(debtor_list(versions, date.today()), params, path)
+    if route == "cashbook":
+        rows, summary = cashbook_list(versions, start, end, (params.get('method') or "").upper() or None)
+        return dict(page(rows, params, path), summary=summary)
+    return {'items': commission_summary(versions, start, end, params.get('staff'))}
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "InAnAPI/1"
+    token = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            token = params.pop('token', None)
+            if self.token and self.token not in (token, self.headers.get('Authorization', '').removeprefix("Bearer ")): raise ApiError(401, "Sai hoặc thiếu token")
+            route = url.path.strip("/").split("/")[0]
+            if not route: return self.send(200, self.health())
+            if route not in ROUTE_SHEETS: raise ApiError(404, "Không có đường dẫn này")
+            versions = data_versions(route)
+            tag = '"' + hashlib.sha1(f"{BOOT}|{versions}|{url.path}|{sorted(params.items())}|{date.today()}".encode()).hexdigest()[:20] + '"'
+            # Không đổi gì thì trả 304 trước khi dựng dữ liệu
+            if tag in [t.strip() for t in self.headers.get('If-None-Match', '').split(",")]: return self.send(304, None, tag)
+            self.send(200, resolve(url.path, params, versions), tag)
+        except ApiError as e: self.send(e.status, {'error': str(e)})
+        except Exception as e:
+            self.log_error("%s", e)
+            self.send(500, {'error': "Lỗi máy chủ"})
+
+    def health(self):
+        store = app.get_local_store()
+        age, source = store.age()
+        return {'sheets': {s: store.version_of(s) for s in app.SHEET_LAYOUTS}, 'age': age, 'source': source,
+                'routes': ["/orders", "/orders/<id>", "/debtors", "/debtors/<key>", "/cashbook", "/commissions"]}
+
+    def send(self, status, body, etag=None):
+        data = b"" if body is None else json.dumps(body, ensure_ascii=False, default=_json).encode("utf-8")
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if body is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if data: self.wfile.write(data)
+
+
+def make_server(host, port, token=None):
+    global app
+    app = load_app()
+    handler = type("Handler", (Handler,), {'token': token})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="API JSON chỉ đọc cho đơn hàng, công nợ, sổ quỹ, hoa hồng")
+    p.add_argument("--host", default="127.0.0.1", help="Đặt 0.0.0.0 để máy khác trong mạng nội bộ truy cập")
+    p.add_argument("--port", type=int, default=8502)
+    args = p.parse_args(argv)
+    server = make_server(args.host, args.port, os.environ.get("API_TOKEN"))
+    print(f"API chạy tại http://{args.host}:{args.port}")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,68 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
 import time
 import os
 import requests
 import unicodedata
 import traceback
-import io
+import uuid
+import functools
 from datetime import datetime
-from fpdf import FPDF
-from num2words import num2words
 import gspread
 from google.oauth2.service_account import Credentials
-import plotly.express as px  # Thư viện vẽ biểu đồ đẹp
+from auth import UserDirectory, hash_password
+from catalog import ProductCatalog
+import commission
+from receivables import BUCKETS, ReceivablesIndex
+from datastore import Compactor, DiskSnapshot, LocalStore, WriteQueue, apply_op
+from ledger import CashLedger
+from orderstore import OrderColumns
+import reconcile
+from rowversion import Conflict, make_patch, merge_patch, read_path, row_version
+import exports
+from sheets_client import QuotaAwareClient, batch_get_records
+from perf import RECORDER as perf_recorder, span, timed
 
 # --- CẤU HÌNH ---
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1Oq3fo2vK-LGHMZq3djZ3mmX5TZMGVZeJVu-MObC5_cU/edit"
 FONT_FILENAME = 'arial.ttf' 
 HEADER_IMAGE = 'tieu_de.png'
+SYNC_DIR = os.environ.get('SYNC_DIR', '.sync')
+JOURNAL_FILE = os.path.join(SYNC_DIR, 'journal.jsonl')
+SNAPSHOT_FILE = os.path.join(SYNC_DIR, 'snapshot.sqlite3')
+# File Excel dựng sẵn ban đêm bởi cli.py
+REPORTS_DIR = os.environ.get('REPORTS_DIR', 'reports')
+# Khung giờ vắng (giờ máy chủ) để xóa thật các đơn đã xóa mềm
+COMPACT_HOURS = (1, 5)
+
+# version: số lần dòng đã được sửa, dùng để phát hiện hai người sửa cùng một đơn
+# deleted: thời điểm xóa mềm; dòng vẫn nằm nguyên chỗ tới lần dọn theo lịch
+ORDER_COLS = ["order_id", "date", "status", "payment_status", "customer", "items", "financial", "version", "deleted"]
+CUSTOMER_COLS = ["phone", "name", "address", "last_order"]
+CASH_COLS = ["Date", "Content", "Amount", "TM/CK", "Note"]
+EXTRA_COLS = ["id", "customer", "pre_tax", "actual", "not_done", "vat_rate", "pit_tax", "refund", "status", "version"]
+USER_COLS = ["username", "password", "role"]
+COUNTER_COLS = ["name", "value"]
+# Cấu trúc worksheet: (tiêu đề cột, số dòng, số cột) dùng khi phải tạo mới
+SHEET_LAYOUTS = {
+    "Orders": (ORDER_COLS, 1000, 20),
+    "Customers": (CUSTOMER_COLS, 1000, 5),
+    "Cashbook": (CASH_COLS, 1000, 10),
+    "ExtraCustomers": (EXTRA_COLS, 1000, 10),
+    "Users": (USER_COLS, 100, 3),
+    "CommissionRules": (commission.RULE_COLS, 100, 3),
+    "Counters": (COUNTER_COLS, 100, 2),
+}
+# Các worksheet mỗi trang cần, được nạp chung trong một lần values_batch_get
+PAGE_SHEETS = {
+    "1. Tạo Báo Giá": ["Customers", "Orders"],
+    "2. Quản Lý Đơn Hàng (Pipeline)": ["Orders"],
+    "3. Khách Thêm": ["ExtraCustomers", "Cashbook"],
+    "4. Sổ Quỹ": ["Cashbook"],
+    "5. Dashboard & Báo Cáo": ["Orders", "Cashbook"],
+}
 
 # --- HÀM HỖ TRỢ ---
 def remove_accents(input_str):
@@ -38,6 +83,7 @@ def format_currency(value):
     except: return "0"
 
 def read_money_vietnamese(amount):
+    from num2words import num2words  # chỉ nạp khi xuất PDF
     try: return num2words(amount, lang='vi').capitalize() + " đồng chẵn."
     except: return "..................... đồng."
 
@@ -55,346 +101,533 @@ def get_gspread_client():
         
         scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
         creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        return gspread.authorize(creds)
+        client = QuotaAwareClient(gspread.authorize(creds))
+        client.on_call = perf_recorder.record_api_call
+        return client
     except Exception as e:
         st.error(f"⚠️ Lỗi kết nối Google: {e}")
         return None
 
+# --- DỮ LIỆU CỤC BỘ & HÀNG ĐỢI GHI ---
+def load_sheet_records(sheet):
+    # Lỗi mạng/hạn mức được ném ra để LocalStore giữ lại bản dữ liệu gần nhất thay vì trả về rỗng
+    client = get_gspread_client()
+    if not client: return None
+    sh = client.open_by_url(SHEET_URL)
+    try: ws = sh.worksheet(sheet)
+    except gspread.WorksheetNotFound: return []
+    return ws.get_all_records()
+
+def load_sheets_batch(sheets):
+    client = get_gspread_client()
+    if not client: return None
+    return batch_get_records(client.open_by_url(SHEET_URL), sheets)
+
+def probe_revision():
+    # Một lệnh Drive rất nhẹ: modifiedTime đổi khi có bất kỳ ai sửa file, kể cả sửa tay trên Google Sheets
+    client = get_gspread_client()
+    if not client: return None
+    return client.open_by_url(SHEET_URL).get_lastUpdateTime()
+
+@st.cache_resource
+def get_local_store():
+    # Khởi động lại vẫn có dữ liệu ngay từ bản lưu trên đĩa, Sheets được tải lại ở luồng nền
+    # Kiểm tra thay đổi rẻ nên hạn dùng ngắn hơn: mỗi 10 giây một lệnh nhỏ, chỉ tải lại khi file thực sự đổi
+    return LocalStore(load_sheet_records, ttl=10, batch_loader=load_sheets_batch, disk=DiskSnapshot(SNAPSHOT_FILE), probe=probe_revision)
+
+@st.cache_resource
+def get_write_queue():
+    return WriteQueue(get_gspread_client, SHEET_URL, get_local_store(), SHEET_LAYOUTS, JOURNAL_FILE, derive={"Orders": derive_order})
+
+@st.cache_resource
+def get_compactor():
+    return Compactor(get_write_queue(), {"Orders": ("order_id", "deleted")}, quiet_hours=COMPACT_HOURS, before=save_id_counters)
+
+def find_record(sheet, key, key_value):
+    for r in get_local_store().get(sheet):
+        if str(r.get(key, '')) == str(key_value): return r
+    return None
+
+def append_op(sheet, row):
+    return {"sheet": sheet, "op": "append", "header": SHEET_LAYOUTS[sheet][0], "row": row}
+
+def update_op(sheet, key, key_value, values):
+    return {"sheet": sheet, "op": "update", "header": SHEET_LAYOUTS[sheet][0], "key": key, "key_value": str(key_value), "values": values}
+
+def queue_append(sheet, row):
+    # Không cần tải sheet trước: khi tải sau này các thao tác còn chờ sẽ được áp dụng lại
+    return get_write_queue().submit(append_op(sheet, row))
+
+def queue_update(sheet, key, key_value, values):
+    return get_write_queue().submit(update_op(sheet, key, key_value, values))
+
 # --- CUSTOMER MANAGEMENT ---
+@timed
 def fetch_customers():
-    client = get_gspread_client()
-    if not client: return []
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("Customers")
-        except: return [] 
-        return ws.get_all_records()
-    except: return []
+    return [dict(c) for c in get_local_store().get("Customers")]
 
+@timed
 def save_customer_db(name, phone, address):
-    client = get_gspread_client()
-    if not client or not phone: return
+    if not phone: return
     try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("Customers")
-        except: 
-            ws = sh.add_worksheet("Customers", 1000, 5)
-            ws.append_row(["phone", "name", "address", "last_order"])
-        
-        try: phones = ws.col_values(1) 
-        except: phones = []
-
-        if phone not in phones:
-            ws.append_row([str(phone), name, address, datetime.now().strftime("%Y-%m-%d")])
-            st.cache_data.clear() 
+        # get_all_records đổi SĐT sang số nên mất số 0 đầu, so sánh sau khi bỏ số 0
+        phones = {str(c.get('phone', '')).lstrip('0') for c in get_local_store().get("Customers")}
+        if str(phone).lstrip('0') not in phones:
+            queue_append("Customers", [str(phone), name, address, datetime.now().strftime("%Y-%m-%d")])
     except: pass
 
 # --- USER MANAGEMENT ---
-def init_users():
+def load_users():
     client = get_gspread_client()
-    if not client: return
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("Users")
-        except:
-            ws = sh.add_worksheet("Users", 100, 3)
-            ws.append_row(["username", "password", "role"])
-            default_users = [
-                ["Nam", "Emyeu0901", "admin"],
-                ["Duong", "Duong", "staff"],
-                ["Van", "Van", "staff"]
-            ]
-            for u in default_users: ws.append_row(u)
-    except: pass
+    if not client: return None
+    # Mật khẩu vừa đổi có thể còn chờ ghi: lấy trước khi đọc sheet rồi áp lại, để lần tải lại
+    # (vd. sau một lần đăng nhập sai) không trả về hash cũ
+    pending = get_write_queue().pending_for("Users")
+    sh = client.open_by_url(SHEET_URL)
+    try: ws = sh.worksheet("Users")
+    except gspread.WorksheetNotFound:
+        ws = sh.add_worksheet("Users", 100, 3)
+        default_users = [
+            ["Nam", "Emyeu0901", "admin"],
+            ["Duong", "Duong", "staff"],
+            ["Van", "Van", "staff"]
+        ]
+        rows = [[u, hash_password(p), role] for u, p, role in default_users]
+        ws.append_rows([USER_COLS] + rows)
+        return [dict(zip(USER_COLS, r)) for r in rows]
+    # get_all_values giữ nguyên chuỗi: get_all_records làm mật khẩu "0901" thành 901
+    values = ws.get_all_values()
+    if not values: return []
+    users = [dict(zip(values[0], row)) for row in values[1:]]
+    for op in pending: apply_op(users, op)
+    return users
 
-def get_users_db():
-    client = get_gspread_client()
-    if not client: return []
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Users")
-        return ws.get_all_records()
-    except: return []
+@st.cache_resource
+def get_user_directory():
+    return UserDirectory(load_users, lambda username, hashed: queue_update("Users", "username", username, {"password": hashed}))
 
+@timed
 def change_password(username, new_pass):
-    client = get_gspread_client()
-    if not client: return False
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Users")
-        cell = ws.find(username)
-        if cell:
-            ws.update_cell(cell.row, 2, new_pass)
-            return True
-        return False
+    try: return get_user_directory().set_password(username, new_pass)
     except: return False
 
+@timed
 def check_login(username, password):
-    users = get_users_db()
-    for u in users:
-        if str(u['username']).strip() == username and str(u['password']).strip() == password:
-            return u
-    return None
+    return get_user_directory().check(username, password)
 
 # --- DATABASE CORE ---
-def fetch_all_orders():
-    client = get_gspread_client()
-    if not client: return []
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Orders")
-        raw_data = ws.get_all_records()
-        processed_data = []
+def parse_order(row):
+    row = dict(row)
+    cust = row.get('customer')
+    row['customer'] = json.loads(cust) if isinstance(cust, str) and cust else (cust if isinstance(cust, dict) else {})
+    items = row.get('items')
+    row['items'] = json.loads(items) if isinstance(items, str) and items else (items if isinstance(items, list) else [])
+    fin = row.get('financial')
+    row['financial'] = json.loads(fin) if isinstance(fin, str) and fin else (fin if isinstance(fin, dict) else {})
+    return row
+
+def parse_orders(raw_data):
+    processed_data = []
+    with span("parse_json"):
         for row in raw_data:
-            try:
-                cust = row.get('customer')
-                row['customer'] = json.loads(cust) if isinstance(cust, str) and cust else (cust if isinstance(cust, dict) else {})
-                items = row.get('items')
-                row['items'] = json.loads(items) if isinstance(items, str) and items else (items if isinstance(items, list) else [])
-                fin = row.get('financial')
-                row['financial'] = json.loads(fin) if isinstance(fin, str) and fin else (fin if isinstance(fin, dict) else {})
-                processed_data.append(row)
+            if row.get('deleted'): continue
+            try: processed_data.append(parse_order(row))
             except: continue
-        return processed_data
+    return processed_data
+
+@timed
+def fetch_all_orders():
+    try: return parse_orders(get_local_store().get("Orders"))
     except: return []
 
-def update_order_status(order_id, new_status, new_payment_status=None, paid_amount=0):
-    client = get_gspread_client()
-    if not client: return False
+# --- CÔNG NỢ THEO KHÁCH HÀNG ---
+@st.cache_resource
+def get_receivables_index():
+    return ReceivablesIndex(remove_accents)
+
+@timed
+def receivables():
+    # Dựng lại chỉ khi Orders được nạp lại từ Sheets; đơn ghi tại đây được cập nhật qua refresh_order_indexes
+    records = get_local_store().get("Orders")
+    index = get_receivables_index()
+    index.ensure(records, fetch_all_orders)
+    return index
+
+def refresh_order_indexes(order_ids):
+    # Đọc lại các đơn vừa ghi từ bản cục bộ (đã áp thao tác) và cập nhật chỉ mục công nợ
+    index = get_receivables_index()
+    for oid in order_ids:
+        rec = find_record("Orders", "order_id", oid)
+        if not rec: index.remove(oid)
+        else:
+            try: index.upsert([parse_order(rec)])
+            except ValueError: index.remove(oid)
+
+# --- DANH MỤC SẢN PHẨM (GỢI Ý KHI NHẬP BÁO GIÁ) ---
+@st.cache_resource
+def get_product_catalog():
+    return ProductCatalog(remove_accents)
+
+@timed
+def product_catalog():
+    # Chỉ dựng lại khi Orders được nạp lại từ Sheets; đơn lưu/sửa/xóa tại đây cập nhật thẳng vào danh mục
+    records = get_local_store().get("Orders")
+    catalog = get_product_catalog()
+    catalog.ensure(records, fetch_all_orders)
+    return catalog
+
+def order_items(order_id):
+    items = read_path(find_record("Orders", "order_id", order_id) or {}, 'items')
+    try: return json.loads(items) if isinstance(items, str) else (items or [])
+    except ValueError: return []
+
+# --- SỬA ĐƠN HÀNG SONG SONG (KHÓA LẠC QUAN) ---
+# Mọi thao tác sửa đơn là một patch theo trường, gộp vào bản mới nhất của dòng trong khóa của hàng đợi.
+# Hai người sửa hai phần khác nhau của cùng một đơn đều được ghi; sửa cùng một trường mà giá trị
+# đã đổi so với lúc người dùng nhìn thấy thì trả về Conflict để giao diện yêu cầu tải lại.
+ORDER_SEEN_FIELDS = ["status", "payment_status", "customer", "items", "financial.total", "financial.paid",
+                     "financial.total_profit", "financial.total_comm", "financial.commission_status"]
+
+def derive_order(values):
+    # Công nợ luôn được tính lại từ tổng tiền và số đã trả của bản đã gộp
+    fin = values.get('financial')
+    if isinstance(fin, dict):
+        try: fin['debt'] = max(0.0, float(fin.get('total', 0) or 0) - float(fin.get('paid', 0) or 0))
+        except (TypeError, ValueError): pass
+
+def order_seen(order_id, fields=ORDER_SEEN_FIELDS):
+    rec = find_record("Orders", "order_id", order_id) or {}
+    return {'base_version': row_version(rec), 'base': {f: read_path(rec, f) for f in fields}}
+
+def seen_before(panel, order_id):
+    # Bấm nút làm script chạy lại với dữ liệu mới nhất: mốc so sánh phải là bản người dùng thấy ở lần vẽ trước.
+    # Mỗi panel giữ mốc riêng: các fragment chạy lại độc lập nên không được ghi đè mốc của nhau
+    key = f"seen_{panel}_{order_id}"
+    now = order_seen(order_id)
+    prev = st.session_state.get(key) or now
+    st.session_state[key] = now
+    return prev
+
+def order_patch(order_id, set_=None, inc=None, seen=None, fields=()):
+    # seen: kết quả order_seen lúc vẽ giao diện; fields: các trường phải còn nguyên như lúc đó
+    seen = seen or {}
+    base = {f: v for f, v in seen.get('base', {}).items() if f in fields}
+    return make_patch(set_, inc, base, seen.get('base_version'))
+
+def order_patch_op(order_id, patch):
+    rec = find_record("Orders", "order_id", order_id)
+    if not rec or rec.get('deleted'): return False
+    values, conflicts = merge_patch(rec, patch, derive_order)
+    if conflicts: return Conflict(conflicts)
+    return dict(update_op("Orders", "order_id", order_id, values), patch=patch, expect=row_version(rec))
+
+def submit_order_patches(patches, extra_ops=(), key=None):
+    # patches: [(order_id, patch)]; đọc - gộp - ghi trong cùng một khóa nên không có cập nhật bị mất
+    get_local_store().get("Orders")
+
+    def build():
+        ops = []
+        for oid, patch in patches:
+            op = order_patch_op(oid, patch)
+            if isinstance(op, Conflict): return op
+            if op: ops.append(op)
+        return ops + list(extra_ops) if ops else False
+    res = get_write_queue().transact(build, key=key)
+    if res is True: refresh_order_indexes([oid for oid, _ in patches])
+    return res
+
+def order_status_patch(order_id, new_status, new_payment_status=None, paid_amount=0, seen=None):
+    set_ = {}
+    if new_status: set_['status'] = new_status
+    if new_payment_status: set_['payment_status'] = new_payment_status
+    inc = {'financial.paid': float(paid_amount)} if paid_amount > 0 else {}
+    # Thu tiền dựa trên công nợ đã thấy: nếu người khác vừa thu thì phải xem lại số còn nợ
+    return order_patch(order_id, set_, inc, seen, fields=("status", "financial.paid"))
+
+@timed
+def update_order_status(order_id, new_status, new_payment_status=None, paid_amount=0, seen=None):
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Orders")
-        cell = ws.find(order_id)
-        if not cell: return False
-        
-        row_idx = cell.row
-        if new_status: 
-            ws.update_cell(row_idx, 3, new_status)
-        if new_payment_status: 
-            ws.update_cell(row_idx, 4, new_payment_status)
-        
-        if paid_amount > 0:
-            current_fin_str = ws.cell(row_idx, 7).value
-            try: fin = json.loads(current_fin_str)
-            except: fin = {}
-            fin['paid'] = float(fin.get('paid', 0)) + float(paid_amount)
-            fin['debt'] = float(fin.get('total', 0)) - fin['paid']
-            if fin['debt'] < 0: fin['debt'] = 0
-            ws.update_cell(row_idx, 7, json.dumps(fin, ensure_ascii=False))
-            
-        st.cache_data.clear()
-        return True
+        patch = order_status_patch(order_id, new_status, new_payment_status, paid_amount, seen)
+        if not patch['set'] and not patch['inc']: return bool(find_record("Orders", "order_id", order_id))
+        res = submit_order_patches([(order_id, patch)])
+        return res if isinstance(res, Conflict) else bool(res)
     except: return False
 
-def update_commission_status(order_id, status_text):
-    client = get_gspread_client()
-    if not client: return False
+# --- GHI NHẬN THANH TOÁN (ĐƠN HÀNG + SỔ QUỸ CÙNG MỘT GIAO DỊCH) ---
+# Trả về True nếu đã ghi, None nếu key đã được ghi trước đó (bấm đúp/thử lại), False nếu lỗi.
+@timed
+def post_payment(order_id, new_status, new_payment_status, amount, method, key, seen=None):
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Orders")
-        cell = ws.find(order_id)
-        if not cell: return False
-        
-        row_idx = cell.row
-        old_fin_str = ws.cell(row_idx, 7).value
-        try: fin = json.loads(old_fin_str)
-        except: fin = {}
-        fin['commission_status'] = status_text
-        ws.update_cell(row_idx, 7, json.dumps(fin, ensure_ascii=False))
-        st.cache_data.clear()
-        return True
+        patch = order_status_patch(order_id, new_status, new_payment_status, amount, seen)
+        receipt = append_op("Cashbook", [datetime.now().strftime("%Y-%m-%d"), "Thu", amount, method, f"Thu tiền đơn {order_id}"])
+        res = submit_order_patches([(order_id, patch)], [receipt], key=f"pay:{order_id}:{key}")
+        if res is None or isinstance(res, Conflict): return res
+        return bool(res)
     except: return False
 
+@timed
+def post_refund(id_, customer, refund):
+    try:
+        rec = find_record("ExtraCustomers", "id", id_)
+        if not rec: return False
+        # Khóa chống trùng gồm mã hồ sơ và version: bấm đúp không chi hai lần, nhưng hồ sơ bị chuyển lại
+        # "Chưa chi" (version đã tăng) vẫn duyệt chi lại được
+        if rec.get('status') == "Đã chi": return None
+        version = row_version(rec)
+        ops = [
+            update_op("ExtraCustomers", "id", id_, {"status": "Đã chi", "version": version + 1}),
+            append_op("Cashbook", [datetime.now().strftime("%Y-%m-%d"), "Chi", float(refund), "CK", f"Hoàn tiền khách thêm: {customer}"]),
+        ]
+        return True if get_write_queue().submit_many(ops, key=f"refund:{id_}:{version}") else None
+    except: return False
+
+def update_commission_status(order_id, status_text):
+    return update_multiple_commissions([order_id], status_text)
+
 # --- HÀM UPDATE HÀNG LOẠT HOA HỒNG ---
+@timed
 def update_multiple_commissions(order_ids, status_text):
-    client = get_gspread_client()
-    if not client or not order_ids: return False
+    if not order_ids: return False
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Orders")
-        
-        # Lấy toàn bộ cột ID để tìm nhanh hơn
-        id_list = ws.col_values(1)
-        
-        for oid in order_ids:
-            if oid in id_list:
-                row_idx = id_list.index(oid) + 1
-                old_fin_str = ws.cell(row_idx, 7).value
-                try: fin = json.loads(old_fin_str)
-                except: fin = {}
-                fin['commission_status'] = status_text
-                ws.update_cell(row_idx, 7, json.dumps(fin, ensure_ascii=False))
-                
-        st.cache_data.clear()
-        return True
+        # Chỉ đổi trường commission_status trong ô financial: thu tiền/sửa đơn cùng lúc không bị ghi đè.
+        # Hàng đợi gộp các ô này thành một lệnh batch_update duy nhất
+        patches = [(oid, order_patch(oid, {'financial.commission_status': status_text})) for oid in order_ids]
+        res = submit_order_patches(patches)
+        return res if isinstance(res, Conflict) else bool(res)
     except:
         return False
 
+# --- QUY TẮC & TÍNH LẠI HOA HỒNG ---
+@st.cache_resource(max_entries=2)
+def _commission_rules(version):
+    # Sheet CommissionRules chưa có thì dùng bảng mặc định (Nam/Dương 60%, Vạn 50%, còn lại 30%)
+    return commission.rules_frame(get_local_store().get("CommissionRules"))
+
+def get_commission_rules():
+    store = get_local_store()
+    store.get("CommissionRules")
+    return _commission_rules(store.version_of("CommissionRules"))
+
+def commission_rate(staff, day=None):
+    return commission.rate_for(get_commission_rules(), staff, day)
+
+@timed
+def save_commission_rules(df_records):
+    try:
+        rows = [[str(r['staff']).strip(), str(r['effective_from'])[:10], float(r['rate'])] for r in df_records if str(r.get('staff') or '').strip()]
+        return get_write_queue().submit({"sheet": "CommissionRules", "op": "replace", "header": commission.RULE_COLS, "rows": rows})
+    except: return False
+
+@timed
+def preview_commission_recompute(include_paid=False):
+    # Chạy thử: chỉ tính và trả về các đơn sẽ thay đổi, chưa ghi gì
+    return commission.recompute(fetch_all_orders(), get_commission_rules(), include_paid)
+
+@timed
+def apply_commission_recompute(report, item_comms):
+    # Mỗi đơn là một patch có mốc là hoa hồng và danh sách mặt hàng lúc chạy thử; cả lô đi chung một batch_update.
+    # Trả về (kết quả, các đơn bị bỏ qua vì số mặt hàng đã khác lúc chạy thử)
+    skipped = []
+    try:
+        orders = {o['order_id']: o for o in fetch_all_orders()}
+        patches = []
+        for row in report.itertuples(index=False):
+            o = orders.get(row.order_id)
+            if not o: continue
+            comms = item_comms.get(row.order_id, [])
+            if len(o['items']) != len(comms) or len(row.items) != len(comms):
+                skipped.append(row.order_id)
+                continue
+            items = [dict(it, commission=c) for it, c in zip(row.items, comms)]
+            seen = {'base_version': row_version({'version': row.version}), 'base': {'financial.total_comm': row.old, 'items': row.items}}
+            patches.append((row.order_id, order_patch(row.order_id, {'financial.total_comm': row.new, 'items': items}, seen=seen,
+                                                       fields=('financial.total_comm', 'items'))))
+        if not patches: return False, skipped
+        res = submit_order_patches(patches)
+        return (res if isinstance(res, Conflict) else bool(res)), skipped
+    except: return False, skipped
+
+@timed
 def delete_order(order_id):
-    client = get_gspread_client()
-    if not client: return False
+    # Xóa mềm: chỉ ghi cờ vào dòng, không dời vị trí các dòng phía sau
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Orders")
-        cell = ws.find(order_id)
-        if cell:
-            ws.delete_rows(cell.row)
-            st.cache_data.clear()
-            return True
-        return False
+        old_items = order_items(order_id)
+        res = submit_order_patches([(order_id, order_patch(order_id, {'deleted': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}))])
+        if res is True: get_product_catalog().remove_items(old_items)
+        return res if isinstance(res, Conflict) else bool(res)
     except: return False
 
-def edit_order_info(order_id, new_cust, new_total, new_items, new_profit, new_comm):
-    client = get_gspread_client()
-    if not client: return False
+@timed
+def edit_order_info(order_id, new_cust, new_total, new_items, new_profit, new_comm, seen=None):
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Orders")
-        cell = ws.find(order_id)
-        if not cell: return False
-        r = cell.row
-        
-        ws.update_cell(r, 5, json.dumps(new_cust, ensure_ascii=False))
-        ws.update_cell(r, 6, json.dumps(new_items, ensure_ascii=False))
-        
-        old_fin_str = ws.cell(r, 7).value
-        try: fin = json.loads(old_fin_str)
-        except: fin = {}
-        fin['total'] = new_total
-        fin['debt'] = new_total - float(fin.get('paid', 0))
-        if fin['debt'] < 0: fin['debt'] = 0
-        fin['total_profit'] = new_profit
-        fin['total_comm'] = new_comm
-        ws.update_cell(r, 7, json.dumps(fin, ensure_ascii=False))
+        set_ = {"customer": new_cust, "items": new_items, "financial.total": new_total,
+                "financial.total_profit": new_profit, "financial.total_comm": new_comm}
+        old_items = order_items(order_id)
+        res = submit_order_patches([(order_id, order_patch(order_id, set_, seen=seen, fields=tuple(set_)))])
+        if not res: return res
+        get_product_catalog().replace_items(old_items, new_items)
         
         save_customer_db(new_cust.get('name'), new_cust.get('phone'), new_cust.get('address'))
-        st.cache_data.clear()
         return True
     except: return False
 
+@timed
 def add_new_order(order_data):
-    client = get_gspread_client()
-    if not client: return False
     try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("Orders")
-        except: 
-            ws = sh.add_worksheet("Orders", 1000, 20)
-            ws.append_row(["order_id", "date", "status", "payment_status", "customer", "items", "financial"])
-        
         row = [
             order_data.get('order_id'), order_data.get('date'), order_data.get('status'), order_data.get('payment_status'),
             json.dumps(order_data.get('customer', {}), ensure_ascii=False),
             json.dumps(order_data.get('items', []), ensure_ascii=False),
-            json.dumps(order_data.get('financial', {}), ensure_ascii=False)
+            json.dumps(order_data.get('financial', {}), ensure_ascii=False),
+            1
         ]
-        ws.append_row(row)
-        st.cache_data.clear()
+        if not queue_append("Orders", row): return False
+        get_product_catalog().add_items(order_data.get('items', []))
+        get_receivables_index().upsert([order_data])
         return True
     except: return False
 
+@timed
 def save_cash_log(date, type_, amount, method, note):
-    client = get_gspread_client()
-    if not client: return
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("Cashbook")
-        except: 
-            ws = sh.add_worksheet("Cashbook", 1000, 10)
-            ws.append_row(["Date", "Content", "Amount", "TM/CK", "Note"])
-        if not ws.get_all_values(): ws.append_row(["Date", "Content", "Amount", "TM/CK", "Note"])
-        ws.append_row([str(date), type_, amount, method, note])
-        st.cache_data.clear()
+    try: queue_append("Cashbook", [str(date), type_, amount, method, note])
     except: pass
 
+@timed
 def fetch_cashbook():
-    client = get_gspread_client()
-    if not client: return []
+    return [dict(r) for r in get_local_store().get("Cashbook")]
+
+@st.cache_resource(max_entries=2)
+def _cash_ledger(version):
+    return CashLedger(get_local_store().get("Cashbook"))
+
+@timed
+def get_cash_ledger():
+    # Dựng lại khi Cashbook đổi phiên bản; các phiên dùng chung một sổ chỉ đọc
+    store = get_local_store()
+    store.get("Cashbook")
+    return _cash_ledger(store.version_of("Cashbook"))
+
+@st.cache_resource(max_entries=2)
+def _order_columns(version, _orders):
+    return OrderColumns(parse_orders(_orders))
+
+@timed
+def get_order_columns(snap=None):
+    # Bảng cột cho Dashboard: dựng lại khi Orders đổi phiên bản, mọi phiên đọc chung một bản
+    snap = snap or get_local_store().snapshot(["Orders"])
+    return _order_columns(snap.versions["Orders"], snap.tables["Orders"])
+
+# --- ĐỐI SOÁT ĐƠN HÀNG / THU TIỀN / SỔ QUỸ ---
+@st.cache_resource(max_entries=2)
+def _reconciliation(orders_version, cash_version, _orders, _cashbook):
+    return reconcile.Reconciliation(_orders, _cashbook)
+
+@timed
+def get_reconciliation(snap=None):
+    # Tính lại khi Orders hoặc Cashbook đổi phiên bản (sau mỗi lần đồng bộ / ghi)
+    snap = snap or get_local_store().snapshot(["Orders", "Cashbook"])
+    return _reconciliation(snap.versions["Orders"], snap.versions["Cashbook"], snap.tables["Orders"], snap.tables["Cashbook"])
+
+def reconcile_patches(plan, method="TM"):
+    # [(mã đơn, patch, [phiếu thu bù])]; mốc là số đã trả lúc đối soát: ai vừa thu thêm thì patch xung đột
+    today = datetime.now().strftime("%Y-%m-%d")
+    out = []
+    for row in plan.itertuples(index=False):
+        set_ = {'financial.paid': row.paid, 'financial.debt': row.debt}
+        if row.new_status: set_['payment_status'] = row.new_status
+        seen = {'base_version': row.version, 'base': {'financial.paid': row.paid, 'payment_status': row.payment_status}}
+        patch = order_patch(row.order_id, set_, seen=seen, fields=('financial.paid', 'payment_status'))
+        cash = [append_op("Cashbook", [today, "Thu", float(row.cash), method, reconcile.RECEIPT_NOTE + row.order_id])] if row.cash > 0 else []
+        out.append((row.order_id, patch, cash))
+    return out
+
+@timed
+def apply_reconciliation(plan, method="TM"):
+    # Cả lô đi chung một batch_update
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("Cashbook")
-        return ws.get_all_records()
-    except: return []
+        fixes = reconcile_patches(plan, method)
+        if not fixes: return False
+        res = submit_order_patches([(oid, patch) for oid, patch, _ in fixes], [op for _, _, cash in fixes for op in cash])
+        return res if isinstance(res, Conflict) else bool(res)
+    except: return False
 
+def order_numbers(orders):
+    # Số thứ tự lớn nhất theo năm: {"26": 57} cho các mã dạng 057/DH.26
+    top = {}
+    for o in orders:
+        num, sep, year = str(o.get('order_id', '')).strip().partition("/DH.")
+        if not sep: continue
+        try: num = int(num)
+        except ValueError: continue
+        if num > top.get(year, 0): top[year] = num
+    return top
+
+def id_counters():
+    counters = {}
+    for r in get_local_store().get("Counters"):
+        try: counters[str(r.get('name', ''))] = int(float(r.get('value') or 0))
+        except (TypeError, ValueError): continue
+    return counters
+
+def save_id_counters(sheet):
+    # Trước khi xóa thật các đơn đã xóa mềm: lưu số lớn nhất mỗi năm vào Counters (cùng giao dịch với lệnh dọn)
+    if sheet != "Orders": return []
+    saved, ops = id_counters(), []
+    for year, num in order_numbers(get_local_store().get("Orders")).items():
+        name = f"DH.{year}"
+        if num <= saved.get(name, 0): continue
+        ops.append(update_op("Counters", "name", name, {"value": num}) if name in saved else append_op("Counters", [name, num]))
+    return ops
+
+@timed
 def gen_id():
-    orders = fetch_all_orders()
+    # Tính cả đơn đã xóa mềm; đơn đã bị dọn hẳn thì lấy theo mốc lưu trong Counters lúc dọn, để không cấp lại mã cũ
     year = datetime.now().strftime("%y")
-    max_num = 0
-    
-    for o in orders:
-        oid = str(o.get('order_id', '')).strip()
-        if "/DH." + year in oid:
-            try:
-                num_part = oid.split("/")[0]
-                num = int(num_part)
-                if num > max_num:
-                    max_num = num
-            except:
-                continue
-                
-    next_num = max_num + 1
-    return f"{next_num:03d}/DH.{year}"
+    max_num = max(order_numbers(get_local_store().get("Orders")).get(year, 0), id_counters().get(f"DH.{year}", 0))
+    return f"{max_num + 1:03d}/DH.{year}"
 
 # --- DATABASE CHO KHÁCH THÊM ---
+@timed
 def fetch_extra_customers():
-    client = get_gspread_client()
-    if not client: return []
-    try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("ExtraCustomers")
-        except: return []
-        return ws.get_all_records()
-    except: return []
+    return [dict(r) for r in get_local_store().get("ExtraCustomers")]
 
+@timed
 def save_extra_customer(id_, name, pre_tax, actual, not_done, vat_rate, pit_tax, refund, status):
-    client = get_gspread_client()
-    if not client: return False
     try:
-        sh = client.open_by_url(SHEET_URL)
-        try: ws = sh.worksheet("ExtraCustomers")
-        except:
-            ws = sh.add_worksheet("ExtraCustomers", 1000, 10)
-            ws.append_row(["id", "customer", "pre_tax", "actual", "not_done", "vat_rate", "pit_tax", "refund", "status"])
-        
-        ws.append_row([str(id_), name, float(pre_tax), float(actual), float(not_done), float(vat_rate), float(pit_tax), float(refund), status])
-        st.cache_data.clear()
-        return True
+        return queue_append("ExtraCustomers", [str(id_), name, float(pre_tax), float(actual), float(not_done), float(vat_rate), float(pit_tax), float(refund), status, 1])
     except: return False
 
+@timed
 def update_extra_customer_status(id_, status):
-    client = get_gspread_client()
-    if not client: return False
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("ExtraCustomers")
-        cell = ws.find(str(id_))
-        if cell:
-            ws.update_cell(cell.row, 9, status)
-            st.cache_data.clear()
-            return True
-        return False
+        rec = find_record("ExtraCustomers", "id", id_)
+        if not rec: return False
+        return queue_update("ExtraCustomers", "id", id_, {"status": status, "version": row_version(rec) + 1})
     except: return False
 
+@timed
 def update_extra_customers_batch(df_records):
-    client = get_gspread_client()
-    if not client: return False
     try:
-        sh = client.open_by_url(SHEET_URL)
-        ws = sh.worksheet("ExtraCustomers")
-        ws.clear()
-        ws.append_row(["id", "customer", "pre_tax", "actual", "not_done", "vat_rate", "pit_tax", "refund", "status"])
-        for r in df_records:
-            ws.append_row([str(r['id']), r['customer'], float(r['pre_tax']), float(r['actual']), float(r['not_done']), float(r['vat_rate']), float(r['pit_tax']), float(r['refund']), r['status']])
-        st.cache_data.clear()
-        return True
+        rows = [[str(r['id']), r['customer'], float(r['pre_tax']), float(r['actual']), float(r['not_done']), float(r['vat_rate']), float(r['pit_tax']), float(r['refund']), r['status'], row_version(r) + 1] for r in df_records]
+        return get_write_queue().submit({"sheet": "ExtraCustomers", "op": "replace", "header": EXTRA_COLS, "rows": rows})
     except: return False
 
 # --- PDF GENERATOR ---
-class PDFGen(FPDF):
-    def header(self): pass
+_PDF_CLASS = None
 
-def create_pdf(order, title):
-    pdf = PDFGen()
+def pdf_class():
+    # fpdf chỉ được nạp ở lần xuất PDF đầu tiên để khởi động app nhanh hơn
+    global _PDF_CLASS
+    if _PDF_CLASS is None:
+        from fpdf import FPDF
+        class PDFGen(FPDF):
+            def header(self): pass
+        _PDF_CLASS = PDFGen
+    return _PDF_CLASS
+
+def pdf_start(title):
+    # Khổ giấy, font, tiêu đề công ty và con dấu dùng chung cho mọi chứng từ
+    pdf = pdf_class()()
     pdf.add_page()
     SAFE_MODE = False
     if os.path.exists(FONT_FILENAME):
@@ -434,6 +667,11 @@ def create_pdf(order, title):
     pdf.set_font_size(16)
     pdf.cell(0, 8, txt(title), new_x="LMARGIN", new_y="NEXT", align='C')
     pdf.set_font_size(11)
+    return pdf, txt, SAFE_MODE
+
+@timed
+def create_pdf(order, title):
+    pdf, txt, SAFE_MODE = pdf_start(title)
     
     oid = order.get('order_id', '')
     is_delivery = "GIAO HÀNG" in title.upper()
@@ -548,10 +786,58 @@ def create_pdf(order, title):
         pdf.multi_cell(190, 5, txt("Rất mong nhận được sự hợp tác của Quý khách hàng!\nTrân trọng! "))
     return bytes(pdf.output())
 
+@timed
+def create_statement_pdf(statement):
+    # Bảng kê công nợ của một khách: các đơn còn nợ, tuổi nợ và tổng phải thu
+    pdf, txt, SAFE_MODE = pdf_start("BẢNG KÊ CÔNG NỢ")
+    pdf.cell(0, 6, txt(f"Tính đến ngày: {statement['today'].strftime('%d/%m/%Y')}"), new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.ln(1)
+    pdf.cell(0, 6, txt(f"Khách hàng: {statement['name']}"), new_x="LMARGIN", new_y="NEXT")
+    pdf.cell(0, 6, txt(f"Điện thoại: {statement['phone']}"), new_x="LMARGIN", new_y="NEXT")
+    pdf.cell(0, 6, txt(f"Địa chỉ: {statement['address']}"), new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(2)
+    pdf.multi_cell(0, 5, txt("Công ty TNHH SX KD TM An Lộc Phát xin gửi Quý khách hàng bảng kê các đơn hàng chưa thanh toán như sau:"))
+    pdf.ln(2)
+
+    pdf.set_fill_color(230, 230, 230)
+    widths = [10, 28, 24, 36, 32, 36, 24]
+    for w, head in zip(widths, ["STT", "Mã đơn", "Ngày", "Tổng đơn", "Đã trả", "Còn nợ", "Số ngày"]):
+        pdf.cell(w, 8, txt(head), 1, 0, 'C', 1)
+    pdf.ln(8)
+    for i, e in enumerate(statement['orders']):
+        odate = e['day'].strftime("%d/%m/%Y") if e['day'] else str(e['date'])
+        cells = [(str(i + 1), 'C'), (e['order_id'], 'C'), (odate, 'C'), (format_currency(e['total']), 'R'),
+                 (format_currency(e['paid']), 'R'), (format_currency(e['debt']), 'R'), (str(e['days']), 'C')]
+        for w, (value, align) in zip(widths, cells): pdf.cell(w, 8, txt(value), 1, 0, align)
+        pdf.ln(8)
+    pdf.cell(130, 8, txt("TỔNG CÔNG NỢ:"), 1, 0, 'R')
+    pdf.cell(60, 8, format_currency(statement['balance']), 1, 1, 'R')
+    pdf.ln(3)
+
+    pdf.cell(0, 6, txt("Phân tích theo tuổi nợ:"), new_x="LMARGIN", new_y="NEXT")
+    for label, amount in statement['buckets'].items():
+        pdf.cell(60, 7, txt(label), 1, 0, 'L')
+        pdf.cell(50, 7, format_currency(amount), 1, 1, 'R')
+    pdf.ln(3)
+
+    if SAFE_MODE: money_text = f"Tong cong: {format_currency(statement['balance'])} VND"
+    else:
+        try: money_text = read_money_vietnamese(statement['balance'])
+        except: money_text = f"{format_currency(statement['balance'])} đồng."
+    pdf.multi_cell(0, 6, txt(f"Bằng chữ: {money_text}"))
+    pdf.ln(3)
+    pdf.set_x(10)
+    pdf.cell(95, 5, txt("XÁC NHẬN CỦA KHÁCH HÀNG"), 0, 0, 'C')
+    pdf.cell(95, 5, txt("NGƯỜI LẬP"), 0, 1, 'C')
+    pdf.ln(20)
+    pdf.set_font_size(10)
+    pdf.set_x(10)
+    pdf.multi_cell(190, 5, txt("Rất mong Quý khách hàng sắp xếp thanh toán. Trân trọng!"))
+    return bytes(pdf.output())
+
 # --- LOGIN PAGE ---
 def login_page():
     st.title("🔐 Đăng Nhập Hệ Thống")
-    init_users()
     with st.form("login_form"):
         username = st.text_input("Tên đăng nhập")
         password = st.text_input("Mật khẩu", type="password")
@@ -566,7 +852,518 @@ def login_page():
                 st.rerun()
             else: st.error("Sai tên đăng nhập hoặc mật khẩu!")
 
+# --- TRẠNG THÁI ĐỒNG BỘ ---
+@st.fragment(run_every=3)
+def sync_status_badge():
+    sync = get_write_queue().status()
+    if sync['pending']:
+        st.caption(f"⏳ Đang chờ đồng bộ {sync['pending']} thay đổi lên Google Sheets...")
+    if sync['error']:
+        st.caption(f"⚠️ Đồng bộ lỗi, sẽ thử lại: {sync['error']}")
+    recent = [c for c in sync['conflicts'] if time.time() - c['ts'] < 600]
+    if recent:
+        st.caption(f"⚠️ {len(recent)} thay đổi không được ghi vì đơn đã bị sửa ở nơi khác: "
+                   + ", ".join(f"{c['key']} ({', '.join(c['fields'])})" for c in recent[-5:]))
+    elif not sync['pending']:
+        st.caption("✅ Dữ liệu đã đồng bộ")
+    dead = [d for d in sync['dead'] if time.time() - d['ts'] < 86400]
+    if dead:
+        st.caption(f"❌ {len(dead)} thay đổi bị Google Sheets từ chối và đã bỏ khỏi hàng đợi (lưu trong {JOURNAL_FILE}.dead): "
+                   + ", ".join(f"{op['sheet']} {op.get('key_value') or op['op']}" for d in dead[-5:] for op in d['ops'][:1])
+                   + f" — {dead[-1]['error']}")
+    store = get_local_store()
+    age, source = store.age()
+    if age is not None:
+        note = " (bản lưu trên máy)" if source == 'disk' else ""
+        text = f"{int(age)} giây" if age < 60 else (f"{int(age // 60)} phút" if age < 3600 else f"{age / 3600:.1f} giờ")
+        st.caption(f"🕒 Dữ liệu cập nhật {text} trước{note}")
+    load_errors = store.errors
+    if load_errors:
+        st.caption(f"⚠️ Không tải được {', '.join(load_errors)} từ Google Sheets, đang dùng dữ liệu gần nhất")
+    if st.session_state.get('role') == 'admin':
+        client = get_gspread_client()
+        if isinstance(client, QuotaAwareClient):
+            m = client.metrics()
+            st.caption(f"📶 API: {m['reads']} đọc · {m['writes']} ghi · chờ hạn mức {m['throttle_wait_s']:.1f}s · thử lại {m['retries']} · gộp {m['deduped_reads']}")
+            st.caption(f"🔎 Kiểm tra thay đổi {store.probes} lần · bỏ qua {store.skipped_reloads} lần tải lại")
+
+# --- BẢNG HIỆU NĂNG (ADMIN) ---
+def perf_panel(last_n=20):
+    with st.expander("⏱️ Hiệu năng (các lần tải gần nhất)"):
+        reruns = perf_recorder.snapshot(last_n)
+        if not reruns:
+            st.caption("Chưa có dữ liệu đo.")
+            return
+        summary = perf_recorder.summary(last_n)
+        st.caption(f"{summary['reruns']} lần tải · API/lần: TB {summary['api_calls_avg']:.1f}, p95 {summary['api_calls_p95']:.0f}")
+        df_ops = pd.DataFrame(summary['ops'])
+        st.dataframe(df_ops.style.format({"p50_ms": "{:.0f}", "p95_ms": "{:.0f}", "max_ms": "{:.0f}"}), hide_index=True, use_container_width=True)
+        df_runs = pd.DataFrame([{
+            "Lúc": datetime.fromtimestamp(r['ts']).strftime("%H:%M:%S"), "Trang": r['tags'].get('page', ''),
+            "ms": round(r['total_ms']), "API": r['api_calls'],
+            "API theo hàm": ", ".join(f"{k}×{v['count']}" for k, v in r['api'].items())
+        } for r in reversed(reruns)])
+        st.dataframe(df_runs, hide_index=True, use_container_width=True)
+        c1, c2 = st.columns(2)
+        c1.download_button("JSON", perf_recorder.export_json(), "perf.json", "application/json")
+        c2.download_button("CSV", perf_recorder.export_csv(), "perf.csv", "text/csv")
+
+# --- XUẤT EXCEL THEO YÊU CẦU ---
+EXPORTS = {
+    "orders": ("Lịch sử đơn hàng (kèm chi tiết hàng)", ["Orders"], "DonHang"),
+    "cashbook": ("Sổ quỹ theo kỳ", ["Cashbook"], "SoQuy"),
+    "debtors": ("Khách còn nợ", ["Orders"], "CongNo"),
+    "extra": ("Khách thêm", ["ExtraCustomers"], "KhachThem"),
+}
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_export(kind, versions, start=None, end=None):
+    # versions chỉ dùng làm khóa cache: dữ liệu đổi thì file được tạo lại
+    if kind == "orders": sheets = exports.orders_sheets(fetch_all_orders())
+    elif kind == "cashbook": sheets = exports.cashbook_sheets(fetch_cashbook(), start, end)
+    elif kind == "debtors": sheets = exports.debtors_sheets(fetch_all_orders())
+    else: sheets = exports.extra_sheets(fetch_extra_customers())
+    return exports.workbook_bytes(sheets)
+
+def export_versions(kind):
+    store = get_local_store()
+    return tuple(store.version_of(s) for s in EXPORTS[kind][1])
+
+def export_panel():
+    with st.expander("📥 Xuất Excel"):
+        kind = st.selectbox("Dữ liệu", list(EXPORTS), format_func=lambda k: EXPORTS[k][0], key="export_kind")
+        start = end = None
+        if kind == "cashbook":
+            start = st.date_input("Từ ngày", value=datetime.now().date().replace(day=1), key="export_from")
+            end = st.date_input("Đến ngày", value=datetime.now().date(), key="export_to")
+        ready = exports.latest_report(REPORTS_DIR, EXPORTS[kind][2]) if kind != "cashbook" else None
+        if ready:
+            stamp = datetime.fromtimestamp(os.path.getmtime(ready)).strftime('%d/%m %H:%M')
+            if st.button(f"Dùng file dựng sẵn ({stamp})", key="export_ready"): st.session_state.export_ready = ready
+            if st.session_state.get('export_ready') == ready:
+                with open(ready, "rb") as f: st.download_button("⬇️ Tải file dựng sẵn", f.read(), os.path.basename(ready), exports.XLSX_MIME, key="export_ready_download")
+        request = (kind, export_versions(kind), start, end)
+        if st.button("Tạo file", key="export_make"): st.session_state.export_request = request
+        # Chỉ hiện nút tải khi đã bấm tạo file cho đúng lựa chọn và phiên bản dữ liệu hiện tại
+        if st.session_state.get('export_request') == request:
+            with st.spinner("Đang tạo file..."): data = build_export(*request)
+            st.download_button("⬇️ Tải file", data, exports.export_filename(EXPORTS[kind][2]), exports.XLSX_MIME, key="export_download")
+
+def compact_panel():
+    with st.expander("🧹 Dọn đơn đã xóa"):
+        compactor = get_compactor()
+        n = compactor.tombstones("Orders")
+        st.caption(f"{n} đơn đã xóa mềm, tự dọn hằng ngày lúc {COMPACT_HOURS[0]}h–{COMPACT_HOURS[1]}h")
+        if n and st.button("Dọn ngay", key="compact_now"):
+            st.toast(f"Đã xếp lịch xóa {compactor.run_now()} dòng", icon="🧹")
+
+def receivables_panel():
+    index = receivables()
+    rows = index.aging()
+    if not rows:
+        st.success("Tuyệt vời! Không có công nợ.")
+        return
+    labels = [label for _, _, label in BUCKETS]
+    cols = st.columns(len(labels) + 1)
+    cols[0].metric("Tổng Công Nợ Phải Thu", format_currency(sum(r['balance'] for r in rows)))
+    for col, label in zip(cols[1:], labels): col.metric(label, format_currency(sum(r[label] for r in rows)))
+
+    # Tra nhanh khi gọi điện thu nợ: gõ SĐT hoặc tên khách
+    query = st.text_input("🔎 Tìm khách (SĐT hoặc tên)", key="ar_query")
+    if query:
+        keys = set(index.find(query))
+        rows = [r for r in rows if r['key'] in keys]
+    table = pd.DataFrame([[r['name'], r['phone'], r['orders'], r['oldest']] + [r[l] for l in labels] + [r['balance']] for r in rows],
+                         columns=["Khách hàng", "SĐT", "Số đơn", "Đơn cũ nhất"] + labels + ["Tổng nợ"])
+    money = {c: st.column_config.NumberColumn(c, format="%.0f") for c in labels + ["Tổng nợ"]}
+    event = st.dataframe(table, hide_index=True, use_container_width=True, column_config=money,
+                         selection_mode="single-row", on_select="rerun", key="ar_table")
+    if not event.selection.rows or event.selection.rows[0] >= len(rows):
+        st.caption("💡 Chọn một khách để xem bảng kê và in phiếu đối chiếu công nợ.")
+        return
+
+    statement = index.statement(rows[event.selection.rows[0]]['key'])
+    if not statement: return
+    st.write(f"**{statement['name']}** · {statement['phone']} · {statement['address']}")
+    detail = pd.DataFrame([[e['order_id'], e['date'], e['status'], e['total'], e['paid'], e['debt'], e['days'], e['bucket']]
+                           for e in statement['orders']],
+                          columns=["Mã ĐH", "Ngày", "Trạng thái", "Tổng đơn", "Đã trả", "Còn nợ", "Số ngày", "Tuổi nợ"])
+    st.dataframe(detail, hide_index=True, use_container_width=True,
+                 column_config={c: st.column_config.NumberColumn(c, format="%.0f") for c in ["Tổng đơn", "Đã trả", "Còn nợ"]})
+    # PDF chỉ tạo khi bấm, gắn với khách và phiên bản dữ liệu để không tải nhầm bản cũ
+    stamp = (statement['key'], get_local_store().version_of("Orders"))
+    if st.button("🖨️ Tạo bảng kê công nợ (PDF)", key="ar_pdf"):
+        st.session_state.ar_statement = (stamp, create_statement_pdf(statement))
+    made = st.session_state.get('ar_statement')
+    if made and made[0] == stamp:
+        st.download_button("⬇️ Tải bảng kê", made[1], f"CongNo_{statement['phone'] or statement['key']}.pdf", "application/pdf", key="ar_pdf_download")
+
+def commission_rules_panel():
+    rules = get_commission_rules()
+    st.caption('Mỗi dòng: nhân viên ("*" là mức mặc định), ngày bắt đầu áp dụng, tỉ lệ (0.6 hoặc 60). '
+               'Đơn dùng quy tắc mới nhất có hiệu lực tính đến ngày của đơn.')
+    shown = rules.assign(effective_from=rules['effective_from'].dt.strftime("%Y-%m-%d"))
+    edited = st.data_editor(shown, num_rows="dynamic", hide_index=True, key="comm_rules_editor", column_config={
+        "staff": st.column_config.TextColumn("Nhân viên"),
+        "effective_from": st.column_config.TextColumn("Áp dụng từ (YYYY-MM-DD)"),
+        "rate": st.column_config.NumberColumn("Tỉ lệ", format="%.2f")})
+    if st.button("💾 Lưu quy tắc", key="comm_rules_save"):
+        if save_commission_rules(edited.to_dict('records')): st.toast("Đã lưu quy tắc hoa hồng", icon="✅"); st.rerun()
+        else: st.error("Lỗi lưu quy tắc")
+
+    include_paid = st.checkbox("Tính lại cả đơn đã chi hoa hồng", key="comm_include_paid")
+    store = get_local_store()
+    version = (store.version_of("Orders"), store.version_of("CommissionRules"), include_paid)
+    if st.button("🔍 Chạy thử tính lại", key="comm_preview_run"):
+        with st.spinner("Đang tính..."): st.session_state.comm_preview = (version, *preview_commission_recompute(include_paid))
+    preview = st.session_state.get('comm_preview')
+    if not preview: return
+    if preview[0] != version:
+        st.info("Dữ liệu hoặc quy tắc đã thay đổi, hãy chạy thử lại.")
+        return
+    _, report, item_comms = preview
+    if report.empty:
+        st.success("Hoa hồng của các đơn đã khớp với quy tắc hiện tại.")
+        return
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Số đơn thay đổi", len(report))
+    c2.metric("Tổng hoa hồng mới", format_currency(report['new'].sum()))
+    c3.metric("Chênh lệch", format_currency(report['diff'].sum()))
+    by_staff = report.groupby('staff')[['old', 'new', 'diff']].sum().reset_index()
+    by_staff.columns = ["Nhân viên", "Hiện tại", "Sau tính lại", "Chênh lệch"]
+    st.dataframe(by_staff, hide_index=True, use_container_width=True)
+    detail = report[['order_id', 'date', 'staff', 'status', 'rate', 'old', 'new', 'diff']].copy()
+    detail.columns = ["Mã đơn", "Ngày", "Nhân viên", "TT hoa hồng", "Tỉ lệ", "Hiện tại", "Sau tính lại", "Chênh lệch"]
+    st.dataframe(detail, hide_index=True, use_container_width=True)
+    if st.button(f"✅ Áp dụng cho {len(report)} đơn", type="primary", key="comm_apply"):
+        res, skipped = apply_commission_recompute(report, item_comms)
+        if skipped:
+            # Đơn đã thêm/bớt mặt hàng sau khi chạy thử: không ghép hoa hồng theo vị trí, để lần chạy thử sau tính lại
+            st.toast(f"Bỏ qua {len(skipped)} đơn đã đổi mặt hàng sau khi chạy thử: {', '.join(skipped[:10])}", icon="⚠️")
+        if res:
+            st.session_state.pop('comm_preview', None)
+            st.toast(f"Đã cập nhật hoa hồng {len(report) - len(skipped)} đơn", icon="✅")
+            st.rerun()
+        elif isinstance(res, Conflict): st.error("⚠️ Có đơn vừa được sửa trong lúc xem trước. Hãy chạy thử lại.")
+        else: st.error("Lỗi cập nhật hoa hồng")
+
+def reconciliation_panel(snap=None):
+    rec = get_reconciliation(snap)
+    counts = rec.summary()
+    if not any(counts.values()) and not rec.missing_ids:
+        st.success(f"Đã đối soát {rec.orders} đơn và {rec.receipts} phiếu thu: số đã trả, công nợ, TT thanh toán và sổ quỹ khớp nhau.")
+        return
+    st.caption(f"Đối soát {rec.orders} đơn và {rec.receipts} phiếu thu. Trùng mã đơn, phiếu thu thừa và phiếu thu không rõ đơn cần kiểm tra tay.")
+    if rec.missing_ids: st.warning(f"{rec.missing_ids} dòng Orders không có mã đơn")
+    st.dataframe(pd.DataFrame({"Loại lệch": list(counts), "Số đơn": list(counts.values())}), hide_index=True, use_container_width=True)
+    kinds = [k for k, df in rec.issues.items() if len(df)]
+    if kinds:
+        kind = st.selectbox("Xem chi tiết", kinds, format_func=reconcile.ISSUES.get, key="recon_kind")
+        st.dataframe(rec.issues[kind].head(500), hide_index=True, use_container_width=True)
+    fixable = [k for k, issue in reconcile.FIXES.items() if len(rec.issues[issue])]
+    if not fixable: return
+    chosen = st.multiselect("Sửa tự động", fixable, default=[k for k in fixable if k != 'cashbook'],
+                            format_func=reconcile.FIX_LABELS.get, key="recon_fix")
+    method = st.radio("Hình thức phiếu thu bù:", ["TM", "CK"], horizontal=True, key="recon_method") if 'cashbook' in chosen else "TM"
+    plan = rec.fixes(chosen)
+    if len(plan) and st.button(f"🛠️ Sửa {len(plan)} đơn", type="primary", key="recon_apply"):
+        res = apply_reconciliation(plan, method)
+        if res: st.toast(f"Đã sửa {len(plan)} đơn", icon="✅"); st.rerun()
+        elif isinstance(res, Conflict): st.error("⚠️ Có đơn vừa được thu tiền/sửa trong lúc đối soát. Hãy thử lại.")
+        else: st.error("Lỗi ghi bản sửa")
+
 # --- MAIN APP ---
+# --- PHẦN GIAO DIỆN CHẠY LẠI RIÊNG (FRAGMENT) ---
+# Thao tác bên trong (chọn hình thức thu, gõ số tiền, sửa đơn, thêm hàng...) chỉ chạy lại phần của nó,
+# không nạp/nhóm lại toàn bộ đơn và không vẽ lại các bảng khác. Ghi được thì st.rerun() để cả trang cập nhật.
+def fragment(fn):
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        # Lần chạy riêng của fragment được ghi vào bảng hiệu năng như một lần chạy, gắn tên fragment
+        own = perf_recorder.current() is None
+        if own: perf_recorder.begin_rerun(user=st.session_state.user.get('username', ''), fragment=fn.__name__)
+        try: return fn(*args, **kwargs)
+        finally:
+            if own: perf_recorder.end_rerun()
+    return st.fragment(run)
+
+def rerun_fragment():
+    # Chỉ vẽ lại fragment đang chạy; khi đang chạy cả trang (vd. AppTest) thì chạy lại cả trang
+    try: st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException: st.rerun()
+
+def load_order(order_id):
+    # Đọc lại đơn từ bản cục bộ mỗi lần fragment chạy: tham số truyền vào là của lần vẽ cả trang trước đó
+    rec = find_record("Orders", "order_id", order_id)
+    if not rec or rec.get('deleted'): return None
+    try: return parse_order(rec)
+    except ValueError: return None
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def order_pdf(order, title):
+    # Cùng nội dung đơn thì dùng lại file đã tạo thay vì vẽ lại PDF ở mỗi lần chạy
+    return create_pdf(order, title)
+
+@fragment
+def order_detail_panel(oid, status_filter, next_status, btn_text, pdf_type, is_admin):
+    sel_order = load_order(oid)
+    if not sel_order:
+        st.info("Đơn hàng không còn tồn tại.")
+        return
+    seen = seen_before("order_detail", oid)
+    st.divider()
+    st.subheader(f"🛠️ Xử lý đơn hàng: {oid}")
+
+    cust = sel_order.get('customer', {})
+    items = sel_order.get('items', [])
+    fin = sel_order.get('financial', {})
+    total, paid = float(fin.get('total', 0)), float(fin.get('paid', 0))
+    debt = total - paid
+    if debt < 0: debt = 0
+    profit_val, comm_val = fin.get('total_profit', 0), fin.get('total_comm', 0)
+    comm_stat = fin.get('commission_status', 'Chưa chi')
+
+    col_d1, col_d2 = st.columns([2, 1])
+    with col_d1:
+        st.write(f"👤 {cust.get('name')} - {cust.get('phone')} | 📍 {cust.get('address')}")
+        st.write("📦 **Chi tiết hàng hóa:**")
+        df_items = pd.DataFrame(items)
+        if not df_items.empty:
+            cols = ["name", "unit", "qty", "price", "vat_rate", "total_line"]
+            if set(cols).issubset(df_items.columns):
+                df_show = df_items[cols].copy()
+                df_show.columns = ["Tên", "ĐVT", "SL", "Giá", "%VAT", "Thành tiền"]
+                df_show['Giá'] = df_show['Giá'].apply(format_currency)
+                df_show['Thành tiền'] = df_show['Thành tiền'].apply(format_currency)
+                st.dataframe(df_show, hide_index=True, use_container_width=True)
+
+    with col_d2:
+        st.info(f"💰 **TÀI CHÍNH**")
+        st.write(f"Tổng đơn: **{format_currency(total)}**")
+        st.write(f"Đã thanh toán: {format_currency(paid)}")
+        st.error(f"CÒN NỢ: **{format_currency(debt)}**")
+        if is_admin:
+            with st.expander("👁️ Admin View", expanded=True):
+                st.write(f"Lợi nhuận: {format_currency(profit_val)}")
+                st.write(f"Hoa hồng ({fin.get('staff')}): {format_currency(comm_val)}")
+                st.write(f"TT Hoa hồng: {comm_stat}")
+                if comm_stat != "Đã chi" and st.button("Chi Hoa Hồng Ngay", key=f"comm_{oid}"):
+                    if update_commission_status(oid, "Đã chi"): st.rerun()
+                    else: st.error("Lỗi cập nhật hoa hồng")
+
+    st.write("---")
+    c_act1, c_act2, c_act3, c_act4 = st.columns(4)
+    with c_act1:
+        if pdf_type:
+            st.download_button(f"🖨️ In {pdf_type}", order_pdf(sel_order, pdf_type), f"{oid}.pdf", "application/pdf", key=f"dl_{oid}", use_container_width=True)
+    with c_act2:
+        pdf_gh = order_pdf(sel_order, "PHIẾU GIAO HÀNG, KIÊM PHIẾU THU")
+        st.download_button("🚚 In Phiếu Giao", pdf_gh, f"GH_{oid}.pdf", "application/pdf", key=f"dl_gh_{oid}", use_container_width=True)
+
+    if is_admin:
+        with c_act3:
+            if next_status and st.button(f"{btn_text} ➡️", key=f"mv_{oid}", type="primary", use_container_width=True):
+                moved = update_order_status(oid, next_status, seen=seen)
+                if isinstance(moved, Conflict): st.error(f"⚠️ Đơn vừa được người khác cập nhật ({moved}). Vui lòng xem lại rồi thao tác lại.")
+                else: st.rerun()
+        with c_act4:
+            if st.button("🗑️ Xóa Đơn", key=f"del_{oid}", use_container_width=True):
+                if delete_order(oid): st.toast("Đã xóa!", icon="✅"); st.rerun()
+
+        st.write("---")
+        st.write("💳 **THANH TOÁN & CẬP NHẬT (Admin Only)**")
+        tab_pay, tab_edit = st.tabs(["💸 Thu Tiền", "✏️ Sửa Đơn Hàng"])
+        with tab_pay: payment_panel(oid, status_filter)
+        with tab_edit: edit_order_panel(oid)
+    else: st.info("🔒 Bạn chỉ có quyền xem chi tiết.")
+
+@fragment
+def payment_panel(oid, status_filter):
+    order = load_order(oid)
+    if not order: return
+    seen = seen_before("payment", oid)
+    fin = order.get('financial', {})
+    debt = max(0.0, float(fin.get('total', 0)) - float(fin.get('paid', 0)))
+    c_p1, c_p2 = st.columns(2)
+    pay_method = c_p1.radio("Hình thức:", ["Một phần", "Toàn bộ"], horizontal=True, key=f"pm_{oid}")
+    pay_val = float(debt) if pay_method == "Toàn bộ" else c_p2.number_input("Nhập số tiền thu:", 0.0, float(debt), float(debt), key=f"p_val_{oid}")
+    pay_via = c_p2.selectbox("Hình thức thanh toán:", ["TM", "CK"], key=f"via_{oid}")
+    st.write(f"👉 Xác nhận thu: **{format_currency(pay_val)}** ({pay_via})")
+    # Mã lần thu gắn vào nút: cú bấm thứ hai của một lần bấm đúp rơi vào nút cũ đã biến mất
+    pay_nonce = st.session_state.setdefault(f"pay_nonce_{oid}", uuid.uuid4().hex[:12])
+    if st.button("Xác nhận Thu Tiền", key=f"cf_pay_{oid}_{pay_nonce}"):
+        if pay_val > 0:
+            new_st = status_filter
+            is_fully_paid = (debt - pay_val) <= 10.0
+            pay_stat_new = "Đã TT" if is_fully_paid else "Cọc/Còn nợ"
+
+            if is_fully_paid and status_filter == "Công nợ":
+                new_st = "Hoàn thành"
+            st.session_state[f"pay_nonce_{oid}"] = uuid.uuid4().hex[:12]
+            posted = post_payment(oid, new_st, pay_stat_new, pay_val, pay_via, pay_nonce, seen=seen)
+            if posted is None: st.toast("Khoản thu này đã được ghi nhận trước đó", icon="ℹ️")
+            elif isinstance(posted, Conflict): st.error("⚠️ Đơn vừa được người khác thu tiền/cập nhật. Vui lòng kiểm tra lại số còn nợ rồi thu lại.")
+            elif posted: st.toast("Thành công!", icon="✅"); st.rerun()
+            else: st.error("Lỗi ghi nhận thanh toán")
+        else: st.warning("Số tiền phải > 0")
+
+@fragment
+def edit_order_panel(oid):
+    order = load_order(oid)
+    if not order: return
+    seen = seen_before("edit_order", oid)
+    cust, items, fin = order.get('customer', {}), order.get('items', []), order.get('financial', {})
+    with st.form(f"form_edit_{oid}"):
+        ce1, ce2 = st.columns(2)
+        new_name = ce1.text_input("Tên Khách", value=cust.get('name'))
+        new_phone = ce2.text_input("SĐT", value=cust.get('phone'))
+        new_addr = st.text_input("Địa chỉ", value=cust.get('address'))
+        st.write("📋 **Sửa Hàng Hóa & Giá:**")
+        edited_df = st.data_editor(pd.DataFrame(items), num_rows="dynamic", key=f"editor_{oid}")
+        if st.form_submit_button("Lưu Thay Đổi"):
+            new_items = edited_df.to_dict('records')
+            # Tỉ lệ theo quy tắc đang áp dụng tại ngày của đơn, tính từng mặt hàng như lúc tạo đơn
+            rate = commission_rate(fin.get('staff', ''), order.get('date'))
+            r_total, r_profit, r_comm = 0, 0, 0
+            for it in new_items:
+                q, p, v, c = float(it.get('qty',0)), float(it.get('price',0)), float(it.get('vat_rate',0)), float(it.get('cost',0))
+                it['total_line'] = q*p + (q*p*(v/100))
+                it['profit'] = (q*p) - (q*c)
+                it['commission'] = commission.item_commission(it['profit'], rate)
+                r_total += it['total_line']
+                r_profit += it['profit']
+                r_comm += it['commission']
+
+            edited = edit_order_info(oid, {"name": new_name, "phone": new_phone, "address": new_addr}, r_total, new_items, r_profit, r_comm, seen=seen)
+            if edited: st.toast("Cập nhật thành công!", icon="✅"); st.rerun()
+            elif isinstance(edited, Conflict): st.error(f"⚠️ Người khác vừa sửa {edited} của đơn này. Các thay đổi chưa được lưu, vui lòng tải lại đơn và sửa lại.")
+            else: st.error("Lỗi cập nhật đơn hàng")
+
+@fragment
+def quote_items_panel(name, phone, addr, staff):
+    st.subheader("2. Chi tiết hàng hóa & Giá")
+    # Gợi ý từ các mặt hàng đã bán: chọn một dòng để điền sẵn tên, ĐVT, giá vốn, giá bán, VAT
+    catalog = product_catalog()
+    cq1, cq2 = st.columns([1, 2])
+    query = cq1.text_input("🔎 Tìm hàng đã bán", key="item_query", placeholder="Gõ vài chữ đầu, không cần dấu")
+    matches = catalog.search(query, limit=15) if query else []
+    if matches:
+        label = lambda i: (f"{matches[i]['name']} · {matches[i]['unit']} · giá gần nhất {format_currency(matches[i]['last_price'])}"
+                           f" · TB {format_currency(round(matches[i]['avg_price']))} ({matches[i]['count']} lần)")
+        pick = cq2.selectbox("Gợi ý", range(len(matches)), format_func=label, index=None, key=f"item_pick_{query}")
+        if pick is not None and st.session_state.get('item_pick_applied') != (query, pick):
+            p = matches[pick]
+            st.session_state.update(i_name=p['name'], i_unit=p['unit'], i_cost=p['last_cost'], i_price=p['last_price'], i_vat=min(100.0, p['vat_rate']))
+            st.session_state.item_pick_applied = (query, pick)
+    elif query: cq2.caption("Chưa có mặt hàng nào khớp")
+
+    with st.form("add_item_form", clear_on_submit=True):
+        col1, col2, col3 = st.columns([3, 1, 1])
+        i_name = col1.text_input("Tên hàng / Quy cách", key="i_name")
+        i_unit = col2.text_input("ĐVT (Cái/M2)", key="i_unit")
+        i_qty = col3.number_input("Số lượng", 1.0, step=1.0)
+        col4, col5, col6 = st.columns(3)
+        i_cost = col4.number_input("Giá Vốn (Giá gốc)", 0.0, step=1000.0, key="i_cost")
+        i_price = col5.number_input("Giá Bán (Đơn giá)", 0.0, step=1000.0, key="i_price")
+        i_vat = col6.number_input("% VAT", 0.0, 100.0, step=1.0, key="i_vat")
+        if st.form_submit_button("➕ Thêm vào danh sách"):
+            if i_name:
+                total_sell = i_qty * i_price
+                total_cost = i_qty * i_cost
+                vat_amt = total_sell * (i_vat / 100)
+                profit = total_sell - total_cost
+        
+                comm_rate = commission_rate(staff)
+                item_comm = commission.item_commission(profit, comm_rate)
+   
+                st.session_state.cart.append({
+                    "name": i_name, "unit": i_unit, "qty": i_qty, "cost": i_cost,
+                    "price": i_price, "vat_rate": i_vat, "vat_amt": vat_amt,
+                    "profit": profit, "commission": item_comm,
+                    "total_line": total_sell + vat_amt
+                })
+                rerun_fragment()
+            else: st.error("Nhập tên hàng!")
+
+    if st.session_state.cart:
+        st.write("---")
+        view_df = pd.DataFrame(st.session_state.cart).copy()
+        for col in ['cost', 'price', 'vat_amt', 'profit', 'commission', 'total_line']:
+            view_df[col] = view_df[col].apply(format_currency)
+        view_df.columns = ["Tên hàng", "ĐVT", "SL", "Giá Vốn", "Giá Bán", "% VAT", "Tiền VAT", "Lợi Nhuận", "Hoa Hồng", "Giá Hoá Đơn"]
+        st.dataframe(view_df, use_container_width=True)
+        
+        total_final = sum(i['total_line'] for i in st.session_state.cart)
+        total_profit = sum(i['profit'] for i in st.session_state.cart)
+        total_comm = sum(i['commission'] for i in st.session_state.cart)
+        
+        m1, m2, m3 = st.columns(3)
+        m1.metric("TỔNG GIÁ TRỊ", format_currency(total_final))
+        m2.metric("TỔNG LỢI NHUẬN", format_currency(total_profit))
+        m3.metric("TỔNG HOA HỒNG", format_currency(total_comm))
+        
+        c_del, c_save = st.columns(2)
+        if c_del.button("🗑️ Xóa giỏ"):
+            st.session_state.cart = []
+            rerun_fragment()
+        if c_save.button("💾 LƯU BÁO GIÁ", type="primary"):
+            if not name: st.error("Thiếu tên khách!")
+            else:
+                new_order = {
+                    "order_id": gen_id(), 
+                    "date": datetime.now().strftime("%Y-%m-%d"),
+                    "status": "Báo giá", "payment_status": "Chưa TT",
+                    "customer": {"name": name, "phone": phone, "address": addr},
+                    "items": st.session_state.cart,
+                    "financial": {
+                        "total": total_final, "paid": 0, "debt": total_final, "staff": staff, 
+                        "total_profit": total_profit, "total_comm": total_comm, "commission_status": "Chưa chi"
+                    }
+                }
+                if add_new_order(new_order):
+                    save_customer_db(name, phone, addr)
+                    st.session_state.last_order = new_order
+                    st.session_state.cart = []
+                    st.rerun()
+
+@fragment
+def commission_payout_panel(df_base, is_admin):
+    # --- UPDATE: CHO PHÉP TÍCH CHỌN NHIỀU ĐƠN HÀNG VÀ CHI HÀNG LOẠT ---
+    st.write("**Bảng kê chi tiết các đơn hàng (Tích chọn để chi hoa hồng):**")
+    
+    # Sử dụng st.dataframe ở chế độ selection_mode="multi-row" để tích chọn checkbox nhiều dòng
+    event_multi = st.dataframe(
+        df_base, 
+        use_container_width=True, 
+        hide_index=True, 
+        selection_mode="multi-row", 
+        on_select="rerun", 
+        key="multi_select_commission"
+    )
+    
+    # Kiểm tra xem có dòng nào được chọn không
+    selected_rows = event_multi.selection.rows
+    
+    if selected_rows:
+        # Trích xuất danh sách các mã đơn hàng được chọn từ vị trí dòng
+        selected_order_ids = [df_base.iloc[r]["Mã đơn hàng"] for r in selected_rows]
+        selected_total_comm = sum([float(df_base.iloc[r]["Số tiền hoa hồng"]) for r in selected_rows])
+        
+        st.success(f"👉 Đang chọn **{len(selected_order_ids)}** đơn hàng. Tổng tiền hoa hồng: **{format_currency(selected_total_comm)}**")
+        
+        if is_admin:
+            if st.button("💸 Xác nhận Chi Hoa Hồng Cho Các Đơn Đã Chọn", type="primary", use_container_width=True):
+                with st.spinner("Đang cập nhật dữ liệu..."):
+                    if update_multiple_commissions(selected_order_ids, "Đã chi"):
+                        st.toast(f"✅ Đã chi hoa hồng thành công cho {len(selected_order_ids)} đơn hàng!")
+                        st.rerun()
+                    else:
+                        st.error("Gặp lỗi trong quá trình cập nhật trạng thái lên hệ thống.")
+        else:
+            st.warning("🔒 Chỉ tài khoản Admin mới quyền thực hiện nút bấm chi hoa hồng.")
+    else:
+        st.info("💡 Mẹo: Bạn có thể tích chọn ô đầu dòng của bảng trên để xử lý chi hoa hồng đồng thời cho nhiều đơn hàng.")
+
 def main_app():
     is_admin = st.session_state.role == 'admin'
     with st.sidebar:
@@ -574,6 +1371,7 @@ def main_app():
         if st.button("Đăng xuất"):
             st.session_state.logged_in = False
             st.rerun()
+        sync_status_badge()
         with st.expander("🔑 Đổi mật khẩu"):
             new_p1 = st.text_input("Mật khẩu mới", type="password")
             new_p2 = st.text_input("Nhập lại", type="password")
@@ -590,6 +1388,15 @@ def main_app():
         st.stop()
 
     menu = st.sidebar.radio("CHỨC NĂNG", ["1. Tạo Báo Giá", "2. Quản Lý Đơn Hàng (Pipeline)", "3. Khách Thêm", "4. Sổ Quỹ", "5. Dashboard & Báo Cáo"])
+    perf_recorder.tag(page=menu)
+    with span("prefetch"): get_local_store().prefetch(PAGE_SHEETS.get(menu, []))
+    get_compactor()
+    if is_admin:
+        with st.sidebar:
+            export_panel()
+            # Đếm đơn đã xóa cần bảng Orders: chỉ hiện ở trang đã nạp sẵn bảng này
+            if "Orders" in PAGE_SHEETS.get(menu, []): compact_panel()
+            perf_panel()
 
     if 'cart' not in st.session_state: st.session_state.cart = []
     if 'last_order' not in st.session_state: st.session_state.last_order = None
@@ -624,82 +1431,12 @@ def main_app():
         staff = st.selectbox("Nhân Viên Kinh Doanh", staff_options, index=default_idx, key="in_staff")
 
         st.divider()
-        st.subheader("2. Chi tiết hàng hóa & Giá")
-        with st.form("add_item_form", clear_on_submit=True):
-            col1, col2, col3 = st.columns([3, 1, 1])
-            i_name = col1.text_input("Tên hàng / Quy cách")
-            i_unit = col2.text_input("ĐVT (Cái/M2)")
-            i_qty = col3.number_input("Số lượng", 1.0, step=1.0)
-            col4, col5, col6 = st.columns(3)
-            i_cost = col4.number_input("Giá Vốn (Giá gốc)", 0.0, step=1000.0)
-            i_price = col5.number_input("Giá Bán (Đơn giá)", 0.0, step=1000.0)
-            i_vat = col6.number_input("% VAT", 0.0, 100.0, 0.0, step=1.0)
-            if st.form_submit_button("➕ Thêm vào danh sách"):
-                if i_name:
-                    total_sell = i_qty * i_price
-                    total_cost = i_qty * i_cost
-                    vat_amt = total_sell * (i_vat / 100)
-                    profit = total_sell - total_cost
-            
-                    comm_rate = 0.3
-                    if staff in ["Nam", "Dương"]: comm_rate = 0.6
-                    elif staff == "Vạn": comm_rate = 0.5
-                    commission = profit * comm_rate if profit > 0 else 0
-       
-                    st.session_state.cart.append({
-                        "name": i_name, "unit": i_unit, "qty": i_qty, "cost": i_cost,
-                        "price": i_price, "vat_rate": i_vat, "vat_amt": vat_amt,
-                        "profit": profit, "commission": commission,
-                        "total_line": total_sell + vat_amt
-                    })
-                    st.rerun()
-                else: st.error("Nhập tên hàng!")
-
-        if st.session_state.cart:
-            st.write("---")
-            view_df = pd.DataFrame(st.session_state.cart).copy()
-            for col in ['cost', 'price', 'vat_amt', 'profit', 'commission', 'total_line']:
-                view_df[col] = view_df[col].apply(format_currency)
-            view_df.columns = ["Tên hàng", "ĐVT", "SL", "Giá Vốn", "Giá Bán", "% VAT", "Tiền VAT", "Lợi Nhuận", "Hoa Hồng", "Giá Hoá Đơn"]
-            st.dataframe(view_df, use_container_width=True)
-            
-            total_final = sum(i['total_line'] for i in st.session_state.cart)
-            total_profit = sum(i['profit'] for i in st.session_state.cart)
-            total_comm = sum(i['commission'] for i in st.session_state.cart)
-            
-            m1, m2, m3 = st.columns(3)
-            m1.metric("TỔNG GIÁ TRỊ", format_currency(total_final))
-            m2.metric("TỔNG LỢI NHUẬN", format_currency(total_profit))
-            m3.metric("TỔNG HOA HỒNG", format_currency(total_comm))
-            
-            c_del, c_save = st.columns(2)
-            if c_del.button("🗑️ Xóa giỏ"):
-                st.session_state.cart = []
-                st.rerun()
-            if c_save.button("💾 LƯU BÁO GIÁ", type="primary"):
-                if not name: st.error("Thiếu tên khách!")
-                else:
-                    new_order = {
-                        "order_id": gen_id(), 
-                        "date": datetime.now().strftime("%Y-%m-%d"),
-                        "status": "Báo giá", "payment_status": "Chưa TT",
-                        "customer": {"name": name, "phone": phone, "address": addr},
-                        "items": st.session_state.cart,
-                        "financial": {
-                            "total": total_final, "paid": 0, "debt": total_final, "staff": staff, 
-                            "total_profit": total_profit, "total_comm": total_comm, "commission_status": "Chưa chi"
-                        }
-                    }
-                    if add_new_order(new_order):
-                        save_customer_db(name, phone, addr)
-                        st.session_state.last_order = new_order
-                        st.session_state.cart = []
-                        st.rerun()
+        quote_items_panel(name, phone, addr, staff)
 
         if st.session_state.last_order:
             oid = st.session_state.last_order['order_id']
             st.success(f"✅ Đã tạo: {oid}")
-            pdf_bytes = create_pdf(st.session_state.last_order, "BÁO GIÁ")
+            pdf_bytes = order_pdf(st.session_state.last_order, "BÁO GIÁ")
             st.download_button("🖨️ Tải PDF", pdf_bytes, f"BG_{oid}.pdf", "application/pdf", type="primary")
 
     # --- TAB 2: QUẢN LÝ ĐƠN HÀNG ---
@@ -729,7 +1466,8 @@ def main_app():
                     "TT Thanh Toán": o.get('payment_status'), "TT Hoa Hồng": fin.get('commission_status', 'Chưa chi')
                 })
             
-            event = st.dataframe(pd.DataFrame(table_data), use_container_width=True, hide_index=True, selection_mode="single-row", on_select="rerun", key=f"tbl_{status_filter}")
+            with span("build_dataframe"): df_table = pd.DataFrame(table_data)
+            event = st.dataframe(df_table, use_container_width=True, hide_index=True, selection_mode="single-row", on_select="rerun", key=f"tbl_{status_filter}")
             
             if event.selection.rows:
                 idx = event.selection.rows[0]
@@ -739,115 +1477,7 @@ def main_app():
                     st.rerun()
                     return
                 
-                sel_order = current_orders[idx]
-                oid = sel_order.get('order_id')
-                st.divider()
-                st.subheader(f"🛠️ Xử lý đơn hàng: {oid}")
-                
-                cust = sel_order.get('customer', {})
-                items = sel_order.get('items', [])
-                fin = sel_order.get('financial', {})
-                total, paid = float(fin.get('total', 0)), float(fin.get('paid', 0))
-                debt = total - paid
-                if debt < 0: debt = 0
-                profit_val, comm_val = fin.get('total_profit', 0), fin.get('total_comm', 0)
-                comm_stat = fin.get('commission_status', 'Chưa chi')
-
-                col_d1, col_d2 = st.columns([2, 1])
-                with col_d1:
-                    st.write(f"👤 {cust.get('name')} - {cust.get('phone')} | 📍 {cust.get('address')}")
-                    st.write("📦 **Chi tiết hàng hóa:**")
-                    df_items = pd.DataFrame(items)
-                    if not df_items.empty:
-                        cols = ["name", "unit", "qty", "price", "vat_rate", "total_line"]
-                        if set(cols).issubset(df_items.columns):
-                            df_show = df_items[cols].copy()
-                            df_show.columns = ["Tên", "ĐVT", "SL", "Giá", "%VAT", "Thành tiền"]
-                            df_show['Giá'] = df_show['Giá'].apply(format_currency)
-                            df_show['Thành tiền'] = df_show['Thành tiền'].apply(format_currency)
-                            st.dataframe(df_show, hide_index=True, use_container_width=True)
-
-                with col_d2:
-                    st.info(f"💰 **TÀI CHÍNH**")
-                    st.write(f"Tổng đơn: **{format_currency(total)}**")
-                    st.write(f"Đã thanh toán: {format_currency(paid)}")
-                    st.error(f"CÒN NỢ: **{format_currency(debt)}**")
-                    if is_admin:
-                        with st.expander("👁️ Admin View", expanded=True):
-                            st.write(f"Lợi nhuận: {format_currency(profit_val)}")
-                            st.write(f"Hoa hồng ({fin.get('staff')}): {format_currency(comm_val)}")
-                            st.write(f"TT Hoa hồng: {comm_stat}")
-                            if comm_stat != "Đã chi" and st.button("Chi Hoa Hồng Ngay", key=f"comm_{oid}"):
-                                update_commission_status(oid, "Đã chi")
-                                st.rerun()
-
-                st.write("---")
-                c_act1, c_act2, c_act3, c_act4 = st.columns(4)
-                with c_act1:
-                    if pdf_type:
-                        pdf_data = create_pdf(sel_order, pdf_type)
-                        st.download_button(f"🖨️ In {pdf_type}", pdf_data, f"{oid}.pdf", "application/pdf", key=f"dl_{oid}", use_container_width=True)
-                with c_act2:
-                    pdf_gh = create_pdf(sel_order, "PHIẾU GIAO HÀNG, KIÊM PHIẾU THU")
-                    st.download_button("🚚 In Phiếu Giao", pdf_gh, f"GH_{oid}.pdf", "application/pdf", key=f"dl_gh_{oid}", use_container_width=True)
-                
-                if is_admin:
-                    with c_act3:
-                        if next_status and st.button(f"{btn_text} ➡️", key=f"mv_{oid}", type="primary", use_container_width=True):
-                            update_order_status(oid, next_status)
-                            st.rerun()
-                    with c_act4:
-                        if st.button("🗑️ Xóa Đơn", key=f"del_{oid}", use_container_width=True):
-                            if delete_order(oid): st.success("Đã xóa!"); time.sleep(1); st.rerun()
-
-                    st.write("---")
-                    st.write("💳 **THANH TOÁN & CẬP NHẬT (Admin Only)**")
-                    tab_pay, tab_edit = st.tabs(["💸 Thu Tiền", "✏️ Sửa Đơn Hàng"])
-                    
-                    with tab_pay:
-                        c_p1, c_p2 = st.columns(2)
-                        pay_method = c_p1.radio("Hình thức:", ["Một phần", "Toàn bộ"], horizontal=True, key=f"pm_{oid}")
-                        pay_val = float(debt) if pay_method == "Toàn bộ" else c_p2.number_input("Nhập số tiền thu:", 0.0, float(debt), float(debt), key=f"p_val_{oid}")
-                        pay_via = c_p2.selectbox("Hình thức thanh toán:", ["TM", "CK"], key=f"via_{oid}")
-                        st.write(f"👉 Xác nhận thu: **{format_currency(pay_val)}** ({pay_via})")
-                        if st.button("Xác nhận Thu Tiền", key=f"cf_pay_{oid}"):
-                            if pay_val > 0:
-                                new_st = status_filter
-                                is_fully_paid = (debt - pay_val) <= 10.0
-                                pay_stat_new = "Đã TT" if is_fully_paid else "Cọc/Còn nợ"
-                                
-                                if is_fully_paid and status_filter == "Công nợ": 
-                                    new_st = "Hoàn thành" 
-                                update_order_status(oid, new_st, pay_stat_new, pay_val)
-                                save_cash_log(datetime.now().strftime("%Y-%m-%d"), "Thu", pay_val, pay_via, f"Thu tiền đơn {oid}")
-                                st.success("Thành công!"); time.sleep(1); st.rerun()
-                            else: st.warning("Số tiền phải > 0")
-
-                    with tab_edit:
-                        with st.form(f"form_edit_{oid}"):
-                            ce1, ce2 = st.columns(2)
-                            new_name = ce1.text_input("Tên Khách", value=cust.get('name'))
-                            new_phone = ce2.text_input("SĐT", value=cust.get('phone'))
-                            new_addr = st.text_input("Địa chỉ", value=cust.get('address'))
-                            st.write("📋 **Sửa Hàng Hóa & Giá:**")
-                            edited_df = st.data_editor(pd.DataFrame(items), num_rows="dynamic", key=f"editor_{oid}")
-                            if st.form_submit_button("Lưu Thay Đổi"):
-                                new_items = edited_df.to_dict('records')
-                                r_total, r_profit = 0, 0
-                                for it in new_items:
-                                    q, p, v, c = float(it.get('qty',0)), float(it.get('price',0)), float(it.get('vat_rate',0)), float(it.get('cost',0))
-                                    it['total_line'] = q*p + (q*p*(v/100))
-                                    it['profit'] = (q*p) - (q*c)
-                                    r_total += it['total_line']
-                                    r_profit += it['profit']
-                                
-                                c_staff = fin.get('staff', '')
-                                rate = 0.6 if c_staff in ["Nam", "Dương"] else (0.5 if c_staff == "Vạn" else 0.3)
-                                r_comm = r_profit * rate if r_profit > 0 else 0
-                                
-                                if edit_order_info(oid, {"name": new_name, "phone": new_phone, "address": new_addr}, r_total, new_items, r_profit, r_comm):
-                                    st.success("Cập nhật thành công!"); time.sleep(1); st.rerun()
-                else: st.info("🔒 Bạn chỉ có quyền xem chi tiết.")
+                order_detail_panel(current_orders[idx].get('order_id'), status_filter, next_status, btn_text, pdf_type, is_admin)
 
         with tabs[0]: render_tab_content("Báo giá", "Thiết kế", "✅ Duyệt -> Thiết Kế", "BÁO GIÁ")
         with tabs[1]: render_tab_content("Thiết kế", "Sản xuất", "✅ Duyệt TK -> Sản Xuất", None)
@@ -863,9 +1493,10 @@ def main_app():
         t_add, t_pipe, t_report, t_manage = st.tabs(["➕ Nhập Khách Mới", "🏭 Duyệt Trạng Thái", "📊 Báo Cáo Hoàn Tiền", "⚙️ Sửa & Xóa"])
         
         extra_data = fetch_extra_customers()
-        df_extra = pd.DataFrame(extra_data)
-        if df_extra.empty:
-            df_extra = pd.DataFrame(columns=["id", "customer", "pre_tax", "actual", "not_done", "vat_rate", "pit_tax", "refund", "status"])
+        with span("build_dataframe"): df_extra = pd.DataFrame(extra_data)
+        # Sheet cũ chưa có cột version; cột này chỉ dùng nội bộ, không hiển thị
+        df_extra = df_extra.reindex(columns=EXTRA_COLS)
+        extra_shown = EXTRA_COLS[:-1]
             
         with t_add:
             st.subheader("Nhập Dữ Liệu Khách Hàng Chiết Khấu")
@@ -886,7 +1517,7 @@ def main_app():
                     if ext_name:
                         new_id = f"KT-{int(time.time())}"
                         if save_extra_customer(new_id, ext_name, ext_pre_tax, ext_actual, calc_not_done, ext_vat_rate, calc_pit_tax, calc_refund, "Chưa chi"):
-                            st.success("Đã thêm thành công!"); time.sleep(0.5); st.rerun()
+                            st.toast("Đã thêm thành công!", icon="✅"); st.rerun()
                     else: st.error("Vui lòng điền tên khách hàng!")
                     
         with t_pipe:
@@ -898,7 +1529,7 @@ def main_app():
                 if df_unpaid.empty:
                     st.info("Hiện không có hồ sơ khách thêm nào ở trạng thái Chưa Chi.")
                 else:
-                    disp_unpaid = df_unpaid.copy()
+                    disp_unpaid = df_unpaid[extra_shown].copy()
                     for c in ['pre_tax', 'actual', 'not_done', 'pit_tax', 'refund']:
                         disp_unpaid[c] = disp_unpaid[c].apply(format_currency)
                     disp_unpaid.columns = ["Mã số", "Khách hàng", "Tiền trước thuế", "Thực làm", "Không làm", "Thuế suất (%)", "Thuế TNCN", "Còn chuyển lại", "Trạng thái"]
@@ -910,16 +1541,17 @@ def main_app():
                             selected_row = df_unpaid.iloc[idx]
                             st.write(f"👉 Bạn đã chọn hồ sơ của khách: **{selected_row['customer']}** - Số tiền: **{format_currency(selected_row['refund'])}**")
                             if st.button("✅ Phê Duyệt & Chuyển Trạng Thái Quá 'Đã Chi'", type="primary"):
-                                update_extra_customer_status(selected_row['id'], "Đã chi")
-                                save_cash_log(datetime.now().strftime("%Y-%m-%d"), "Chi", selected_row['refund'], "CK", f"Hoàn tiền khách thêm: {selected_row['customer']}")
-                                st.success("Đã duyệt chuyển trạng thái!"); time.sleep(0.5); st.rerun()
+                                posted = post_refund(selected_row['id'], selected_row['customer'], selected_row['refund'])
+                                if posted is None: st.toast("Hồ sơ này đã được duyệt chi trước đó", icon="ℹ️")
+                                elif posted: st.toast("Đã duyệt chuyển trạng thái!", icon="✅"); st.rerun()
+                                else: st.error("Lỗi duyệt chi")
                             
             with p_tabs[1]:
                 df_paid = df_extra[df_extra['status'] == 'Đã chi'].copy()
                 if df_paid.empty:
                     st.info("Chưa có lịch sử duyệt chi hồ sơ nào.")
                 else:
-                    disp_paid = df_paid.copy()
+                    disp_paid = df_paid[extra_shown].copy()
                     for c in ['pre_tax', 'actual', 'not_done', 'pit_tax', 'refund']:
                         disp_paid[c] = disp_paid[c].apply(format_currency)
                     disp_paid.columns = ["Mã số", "Khách hàng", "Tiền trước thuế", "Thực làm", "Không làm", "Thuế suất (%)", "Thuế TNCN", "Còn chuyển lại", "Trạng thái"]
@@ -943,7 +1575,7 @@ def main_app():
             st.subheader("Bảng Quản Lý Chỉnh Sửa & Xóa Trực Tiếp")
             if extra_data:
                 st.warning("Lưu ý: Sau khi sửa/xóa hàng trên bảng, hãy nhấn nút 'Lưu Thay Đổi Thao Tác' ở bên dưới để hệ thống đồng bộ!")
-                edited_extra_df = st.data_editor(pd.DataFrame(extra_data), num_rows="dynamic", key="extra_editor_table")
+                edited_extra_df = st.data_editor(df_extra, num_rows="dynamic", column_config={"version": None}, key="extra_editor_table")
                 
                 if st.button("💾 Lưu Thay Đổi Thao Tác"):
                     try:
@@ -958,7 +1590,7 @@ def main_app():
                             r['refund'] = r['not_done'] - r['pit_tax']
                             
                         if update_extra_customers_batch(records):
-                            st.success("Đã đồng bộ và cập nhật hệ thống thành công!"); time.sleep(0.5); st.rerun()
+                            st.toast("Đã đồng bộ và cập nhật hệ thống thành công!", icon="✅"); st.rerun()
                     except Exception as e:
                         st.error(f"Lỗi khi lưu dữ liệu chỉnh sửa: {e}")
             else:
@@ -967,32 +1599,40 @@ def main_app():
     # --- TAB 4: SỔ QUỸ (CHỈ TM) ---
     elif menu == "4. Sổ Quỹ":
         st.header("📊 Sổ Quỹ Tiền Mặt")
-        df = pd.DataFrame(fetch_cashbook())
-        if df.empty: df = pd.DataFrame(columns=["Date", "Content", "Amount", "TM/CK", "Note"])
-        if 'date' in df.columns: df.rename(columns={'date': 'Date', 'type': 'Content', 'amount': 'Amount', 'desc': 'Note'}, inplace=True)
-        for col in ["Date", "Content", "Amount", "TM/CK", "Note"]: 
-            if col not in df.columns: df[col] = ""
-        
-        df['TM/CK'] = df['TM/CK'].replace("", "TM").fillna("TM")
-        df['TM/CK_Norm'] = df['TM/CK'].astype(str).str.strip().str.upper()
-        df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce').fillna(0)
-        df_tm = df[df['TM/CK_Norm'] == 'TM'].copy()
-
-        if not df_tm.empty:
-            total_thu = df_tm[df_tm['Content'] == 'Thu']['Amount'].sum()
-            total_chi = df_tm[df_tm['Content'] == 'Chi']['Amount'].sum()
-            c1, c2, c3 = st.columns(3)
-            c1.metric("Tổng Thu (TM)", format_currency(total_thu))
-            c2.metric("Tổng Chi (TM)", format_currency(total_chi))
-            c3.metric("Tồn Quỹ Tiền Mặt", format_currency(total_thu - total_chi))
+        ledger = get_cash_ledger()
+
+        if not ledger.entries.empty:
+            first_day = ledger.entries['Day'].min()
+            first_day = first_day.date() if pd.notna(first_day) else datetime.now().date()
+            f1, f2 = st.columns(2)
+            d_from = f1.date_input("Từ ngày", value=first_day, key="cash_from")
+            d_to = f2.date_input("Đến ngày", value=datetime.now().date(), key="cash_to")
+            rows, totals = ledger.period(d_from, d_to)
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("Tồn Đầu Kỳ", format_currency(totals['opening']))
+            c2.metric("Tổng Thu (TM)", format_currency(totals['thu']))
+            c3.metric("Tổng Chi (TM)", format_currency(totals['chi']))
+            c4.metric("Tồn Cuối Kỳ", format_currency(totals['closing']))
+            st.caption(f"Tồn quỹ tiền mặt hiện tại: {format_currency(ledger.balance)}")
+            undated = totals['undated']
+            if len(undated):
+                st.warning(f"{len(undated)} dòng sổ quỹ không đọc được ngày nên không nằm trong kỳ "
+                           f"(Thu {format_currency(undated['Thu'].sum())}, Chi {format_currency(undated['Chi'].sum())}); "
+                           "tồn quỹ hiện tại đã tính các dòng này. Sửa cột Date trên Google Sheets để đưa vào đúng kỳ.")
             st.divider()
-            df_tm['Thu'] = df_tm.apply(lambda x: x['Amount'] if x['Content'] == 'Thu' else 0, axis=1)
-            df_tm['Chi'] = df_tm.apply(lambda x: x['Amount'] if x['Content'] == 'Chi' else 0, axis=1)
-            df_display = df_tm[['Date', 'Thu', 'Chi', 'Note']].copy()
-            df_display['Thu'] = df_display['Thu'].apply(lambda x: format_currency(x) if x > 0 else "")
-            df_display['Chi'] = df_display['Chi'].apply(lambda x: format_currency(x) if x > 0 else "")
-            df_display.columns = ["Ngày tháng", "Thu", "Chi", "Nội dung/Ghi chú"]
+            with span("build_dataframe"):
+                df_display = pd.DataFrame({
+                    "Ngày tháng": rows['Date'],
+                    "Thu": np.where(rows['Thu'] > 0, rows['Thu'].map(format_currency), ""),
+                    "Chi": np.where(rows['Chi'] > 0, rows['Chi'].map(format_currency), ""),
+                    "Tồn quỹ": rows['Tồn'].map(format_currency),
+                    "Nội dung/Ghi chú": rows['Note'],
+                })
             st.dataframe(df_display, use_container_width=True, hide_index=True)
+            with st.expander("📅 Số dư theo tháng"):
+                df_month = ledger.monthly.copy()
+                df_month.index = df_month.index.strftime("%m/%Y")
+                st.dataframe(df_month.map(format_currency), use_container_width=True)
         else:
             st.info("Chưa có giao dịch Tiền mặt nào.")
 
@@ -1009,55 +1649,47 @@ def main_app():
                 if st.form_submit_button("💾 Lưu Sổ Quỹ"):
                     if amount > 0:
                         save_cash_log(d, type_option, amount, "TM", note)
-                        st.success("Đã lưu!"); time.sleep(1); st.rerun()
+                        st.toast("Đã lưu!", icon="✅"); st.rerun()
                     else: st.warning("Nhập số tiền > 0")
         else: st.warning("🔒 Chỉ Admin được ghi sổ.")
 
     # --- TAB 5: DASHBOARD & BÁO CÁO ---
     elif menu == "5. Dashboard & Báo Cáo":
+        import plotly.express as px  # Thư viện vẽ biểu đồ đẹp, chỉ nạp khi mở Dashboard
         st.header("📊 Dashboard & Báo Cáo Quản Trị")
-        orders = fetch_all_orders()
-        cashbook = fetch_cashbook()
-        df_orders = pd.DataFrame(orders)
-        df_cash = pd.DataFrame(cashbook)
+        # Mọi tab đọc Orders và Cashbook từ cùng một lần chụp nên các số liệu luôn khớp phiên bản với nhau
+        snap = get_local_store().snapshot(PAGE_SHEETS[menu])
+        with span("build_dataframe"):
+            cols = get_order_columns(snap)
         
-        if df_orders.empty:
+        if not len(cols):
             st.info("Chưa có dữ liệu đơn hàng.")
         else:
-            df_orders['total_revenue'] = df_orders['financial'].apply(lambda x: float(x.get('total', 0)))
-            df_orders['total_profit'] = df_orders['financial'].apply(lambda x: float(x.get('total_profit', 0)))
-            df_orders['total_comm'] = df_orders['financial'].apply(lambda x: float(x.get('total_comm', 0)))
-            df_orders['staff'] = df_orders['financial'].apply(lambda x: x.get('staff', 'Unknown'))
-            df_orders['cust_name'] = df_orders['customer'].apply(lambda x: x.get('name', 'Unknown'))
-            df_orders['comm_status'] = df_orders['financial'].apply(lambda x: x.get('commission_status', 'Chưa chi'))
             
             t1, t2, t3, t4, t5 = st.tabs(["1. Tổng Quan", "2. Báo Cáo Lãi/Lỗ (P&L)", "3. Phân Tích Doanh Thu", "4. Công Nợ", "5. Hoa Hồng"])
             
             with t1:
                 st.subheader("Trạng Thái Đơn Hàng")
-                status_counts = df_orders['status'].value_counts().reset_index()
-                status_counts.columns = ['Status', 'Count']
-                fig = px.pie(status_counts, values='Count', names='Status', title='Tỷ lệ đơn hàng theo trạng thái', hole=0.4)
-                st.plotly_chart(fig, use_container_width=True)
+                status_counts = cols.status_counts()
+                with span("render_chart"):
+                    fig = px.pie(status_counts, values='Count', names='Status', title='Tỷ lệ đơn hàng theo trạng thái', hole=0.4)
+                    st.plotly_chart(fig, use_container_width=True)
                 
                 k1, k2, k3 = st.columns(3)
-                k1.metric("Tổng đơn hàng", len(df_orders))
-                k2.metric("Đang sản xuất", len(df_orders[df_orders['status'] == 'Sản xuất']))
-                k3.metric("Hoàn thành", len(df_orders[df_orders['status'] == 'Hoàn thành']))
+                k1.metric("Tổng đơn hàng", len(cols))
+                k2.metric("Đang sản xuất", cols.count('Sản xuất'))
+                k3.metric("Hoàn thành", cols.count('Hoàn thành'))
+                if is_admin and st.toggle("🔍 Đối soát đơn hàng / thu tiền / sổ quỹ", key="recon_open"):
+                    reconciliation_panel(snap)
 
             with t2:
                 if is_admin:
                     st.subheader("Báo Cáo Kết Quả Kinh Doanh (Ước tính)")
-                    revenue = df_orders['total_revenue'].sum()
-                    total_cogs = 0
-                    for o in orders:
-                        items = o.get('items', [])
-                        for i in items:
-                            try: total_cogs += float(i.get('qty', 0)) * float(i.get('cost', 0))
-                            except: pass
-                            
+                    revenue = cols.sum('total')
+                    total_cogs = cols.sum('cogs')
                     gross_profit = revenue - total_cogs
                     total_expenses = 0
+                    df_cash = pd.DataFrame(snap.tables["Cashbook"])
                     if not df_cash.empty:
                         if 'amount' in df_cash.columns and 'type' in df_cash.columns:
                              df_cash['amt'] = pd.to_numeric(df_cash['amount'], errors='coerce').fillna(0)
@@ -1078,46 +1710,28 @@ def main_app():
             with t3:
                 st.subheader("Phân Tích Doanh Thu")
                 st.write("###### Theo Nhân Viên")
-                staff_perf = df_orders.groupby('staff')['total_revenue'].sum().reset_index().sort_values('total_revenue', ascending=False)
-                fig_staff = px.bar(staff_perf, x='staff', y='total_revenue', labels={'total_revenue': 'Doanh thu', 'staff': 'Nhân viên'})
-                st.plotly_chart(fig_staff, use_container_width=True)
+                staff_perf = cols.revenue_by_staff()
+                with span("render_chart"):
+                    fig_staff = px.bar(staff_perf, x='staff', y='total_revenue', labels={'total_revenue': 'Doanh thu', 'staff': 'Nhân viên'})
+                    st.plotly_chart(fig_staff, use_container_width=True)
                 
                 st.write("###### Top 10 Khách Hàng")
-                cust_perf = df_orders.groupby('cust_name')['total_revenue'].sum().reset_index().sort_values('total_revenue', ascending=False).head(10)
+                cust_perf = cols.top_customers(10)
                 st.dataframe(cust_perf.style.format({"total_revenue": "{:,.0f}"}), use_container_width=True)
 
                 st.write("###### Top Sản Phẩm Bán Chạy")
-                all_items = []
-                for o in orders:
-                    for i in o.get('items', []):
-                        all_items.append({"Product": i.get('name'), "Revenue": float(i.get('total_line', 0))})
-                
-                if all_items:
-                    df_products = pd.DataFrame(all_items)
-                    prod_perf = df_products.groupby('Product')['Revenue'].sum().reset_index().sort_values('Revenue', ascending=False).head(10)
-                    st.bar_chart(prod_perf.set_index('Product'))
+                prod_perf = cols.top_products(10)
+                if not prod_perf.empty:
+                    with span("render_chart"): st.bar_chart(prod_perf.set_index('Product'))
 
             with t4:
-                st.subheader("Danh Sách Khách Nợ")
-                df_orders['debt'] = df_orders['financial'].apply(lambda x: float(x.get('debt', 0)))
-                debtors = df_orders[df_orders['debt'] > 0][['order_id', 'date', 'cust_name', 'total_revenue', 'debt']].copy()
-                
-                if not debtors.empty:
-                    st.metric("Tổng Công Nợ Phải Thu", format_currency(debtors['debt'].sum()))
-                    debtors.columns = ["Mã ĐH", "Ngày", "Khách hàng", "Tổng đơn", "Còn nợ"]
-                    debtors['Tổng đơn'] = debtors['Tổng đơn'].apply(format_currency)
-                    debtors['Còn nợ'] = debtors['Còn nợ'].apply(format_currency)
-                    st.dataframe(debtors, use_container_width=True)
-                else:
-                    st.success("Tuyệt vời! Không có công nợ.")
+                st.subheader("Công Nợ Theo Khách Hàng")
+                receivables_panel()
 
             with t5:
                 st.subheader("Theo Dõi Hoa Hồng Nhân Viên")
                 
-                comm_summary = df_orders.groupby(['staff', 'comm_status'])['total_comm'].sum().unstack(fill_value=0).reset_index()
-                if 'Chưa chi' not in comm_summary.columns: comm_summary['Chưa chi'] = 0.0
-                if 'Đã chi' not in comm_summary.columns: comm_summary['Đã chi'] = 0.0
-                comm_summary['Tổng hoa hồng'] = comm_summary['Chưa chi'] + comm_summary['Đã chi']
+                comm_summary = cols.commission_by_staff()
                 
                 st.dataframe(
                     comm_summary,
@@ -1131,21 +1745,21 @@ def main_app():
                 )
                 
                 m1, m2, m3 = st.columns(3)
-                m1.metric("Tổng Hoa Hồng", format_currency(df_orders['total_comm'].sum()))
-                total_paid = df_orders[df_orders['comm_status'] == 'Đã chi']['total_comm'].sum()
-                total_pending = df_orders[df_orders['comm_status'] != 'Đã chi']['total_comm'].sum()
+                m1.metric("Tổng Hoa Hồng", format_currency(cols.sum('comm')))
+                total_paid = cols.sum('comm', cols.mask(comm_paid=True))
+                total_pending = cols.sum('comm', cols.mask(comm_paid=False))
                 m2.metric("Đã Thanh Toán", format_currency(total_paid))
                 m3.metric("Chưa Thanh Toán", format_currency(total_pending))
+                # Quy tắc chỉ được nạp khi mở mục này
+                if is_admin and st.toggle("⚙️ Quy tắc hoa hồng & tính lại hàng loạt", key="comm_rules_open"):
+                    commission_rules_panel()
                 
                 st.divider()
                 
                 # BẢNG KÊ CHI TIẾT: Đơn đã HOÀN THÀNH mà CHƯA CHI HOA HỒNG
                 st.subheader("📋 Đơn Hàng Hoàn Thành Chưa Chi Hoa Hồng")
                 
-                df_pending_details = df_orders[
-                    (df_orders['status'] == 'Hoàn thành') & 
-                    (df_orders['comm_status'] != 'Đã chi')
-                ].copy()
+                df_pending_details = cols.pending_commissions('Hoàn thành')
                 
                 if df_pending_details.empty:
                     st.success("🎉 Không có đơn hàng nào đã hoàn thành mà chưa chi hoa hồng!")
@@ -1161,59 +1775,26 @@ def main_app():
                     disp_staff_total["Tổng chưa chi (Đơn hoàn thành)"] = disp_staff_total["Tổng chưa chi (Đơn hoàn thành)"].apply(format_currency)
                     st.dataframe(disp_staff_total, hide_index=True, use_container_width=True)
                     
-                    # --- UPDATE: CHO PHÉP TÍCH CHỌN NHIỀU ĐƠN HÀNG VÀ CHI HÀNG LOẠT ---
-                    st.write("**Bảng kê chi tiết các đơn hàng (Tích chọn để chi hoa hồng):**")
-                    
-                    # Sử dụng st.dataframe ở chế độ selection_mode="multi-row" để tích chọn checkbox nhiều dòng
-                    event_multi = st.dataframe(
-                        df_base, 
-                        use_container_width=True, 
-                        hide_index=True, 
-                        selection_mode="multi-row", 
-                        on_select="rerun", 
-                        key="multi_select_commission"
-                    )
-                    
-                    # Kiểm tra xem có dòng nào được chọn không
-                    selected_rows = event_multi.selection.rows
-                    
-                    if selected_rows:
-                        # Trích xuất danh sách các mã đơn hàng được chọn từ vị trí dòng
-                        selected_order_ids = [df_base.iloc[r]["Mã đơn hàng"] for r in selected_rows]
-                        selected_total_comm = sum([float(df_base.iloc[r]["Số tiền hoa hồng"]) for r in selected_rows])
-                        
-                        st.success(f"👉 Đang chọn **{len(selected_order_ids)}** đơn hàng. Tổng tiền hoa hồng: **{format_currency(selected_total_comm)}**")
-                        
-                        if is_admin:
-                            if st.button("💸 Xác nhận Chi Hoa Hồng Cho Các Đơn Đã Chọn", type="primary", use_container_width=True):
-                                with st.spinner("Đang cập nhật dữ liệu..."):
-                                    if update_multiple_commissions(selected_order_ids, "Đã chi"):
-                                        st.success(f"✅ Đã chi hoa hồng thành công cho {len(selected_order_ids)} đơn hàng!")
-                                        time.sleep(1)
-                                        st.rerun()
-                                    else:
-                                        st.error("Gặp lỗi trong quá trình cập nhật trạng thái lên hệ thống.")
-                        else:
-                            st.warning("🔒 Chỉ tài khoản Admin mới quyền thực hiện nút bấm chi hoa hồng.")
-                    else:
-                        st.info("💡 Mẹo: Bạn có thể tích chọn ô đầu dòng của bảng trên để xử lý chi hoa hồng đồng thời cho nhiều đơn hàng.")
-                    
-                    # --- XUẤT FILE EXCEL ---
-                    try:
-                        buffer = io.BytesIO()
-                        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                            df_base.to_excel(writer, sheet_name="Chi Tiết Đơn Chưa Chi", index=False)
-                            staff_pending_total.to_excel(writer, sheet_name="Tổng Hợp Theo Nhân Viên", index=False)
-                        
-                        buffer.seek(0)
+                    commission_payout_panel(df_base, is_admin)
+
+                    # --- XUẤT FILE EXCEL (chỉ tạo khi bấm) ---
+                    comm_version = get_local_store().version_of("Orders")
+                    if st.button("📥 Xuất bảng kê ra file Excel", key="comm_export"):
+                        try:
+                            st.session_state.comm_export = (comm_version, exports.workbook_bytes([
+                                exports.frame_sheet("Chi Tiết Đơn Chưa Chi", df_base),
+                                exports.frame_sheet("Tổng Hợp Theo Nhân Viên", staff_pending_total),
+                            ]))
+                        except Exception as ex:
+                            st.error(f"Không thể tạo file Excel: {ex}")
+                    comm_file = st.session_state.get('comm_export')
+                    if comm_file and comm_file[0] == comm_version:
                         st.download_button(
-                            label="📥 Xuất bảng kê ra file Excel",
-                            data=buffer,
+                            label="⬇️ Tải file Excel",
+                            data=comm_file[1],
                             file_name=f"HoaHong_ChuaChi_HoanThanh_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                            mime=exports.XLSX_MIME
                         )
-                    except Exception as ex:
-                        st.error(f"Không thể tạo file Excel: {ex}")
 
 if __name__ == "__main__":
     if 'logged_in' not in st.session_state:
@@ -1222,11 +1803,16 @@ if __name__ == "__main__":
         st.session_state.user = {}
         st.session_state.role = ""
 
-    if not st.session_state.logged_in:
-        login_page()
-    else:
-        try:
-            main_app()
-        except Exception as e:
-            st.error("⚠️ Đã xảy ra lỗi ứng dụng:")
-            st.code(traceback.format_exc())
+    perf_recorder.begin_rerun(user=st.session_state.user.get('username', ''))
+    try:
+        if not st.session_state.logged_in:
+            perf_recorder.tag(page="login")
+            login_page()
+        else:
+            try:
+                main_app()
+            except Exception as e:
+                st.error("⚠️ Đã xảy ra lỗi ứng dụng:")
+                st.code(traceback.format_exc())
+    finally:
+        perf_recorder.end_rerun()
@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# --- TÀI KHOẢN NGƯỜI DÙNG ---
+# Bảng Users được tải một lần vào RAM, đánh chỉ mục theo tên đăng nhập. Mật khẩu lưu dạng
+# pbkdf2_sha256$<số vòng>$<salt>$<hash>; dòng còn mật khẩu thường được tự băm và ghi lại.
+
+HASH_PREFIX = "pbkdf2_sha256"
+ITERATIONS = 200_000
+
+
+def hash_password(password, salt=None, iterations=ITERATIONS):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", str(password).encode("utf-8"), salt, iterations)
+    return f"{HASH_PREFIX}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def is_hashed(value):
+    parts = str(value).split("$")
+    return len(parts) == 4 and parts[0] == HASH_PREFIX
+
+
+def verify_password(password, stored):
+    if not is_hashed(stored):
+        return hmac.compare_digest(str(password).encode("utf-8"), str(stored).encode("utf-8"))
+    _, iterations, salt, digest = stored.split("$")
+    try: candidate = hash_password(password, bytes.fromhex(salt), int(iterations))
+    except ValueError: return False
+    return hmac.compare_digest(candidate.split("$")[-1], digest)
+
+
+class UserDirectory:
+    def __init__(self, loader, save_password, refresh_interval=60):
+        # loader() trả về danh sách dict username/password/role (chuỗi) hoặc None nếu mất kết nối
+        self.loader = loader
+        self.save_password = save_password
+        # Đăng nhập sai chỉ được tải lại bảng tối đa một lần mỗi refresh_interval giây
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self._users = None
+        self._loaded_at = 0
+
+    def _ensure(self, force=False):
+        with self.lock:
+            if self._users is not None and (not force or time.time() - self._loaded_at < self.refresh_interval): return False
+            self._loaded_at = time.time()
+        try: rows = self.loader()
+        except Exception: return False
+        if rows is None: return False
+        users, migrate = {}, []
+        for r in rows:
+            name = str(r.get('username', '')).strip()
+            if not name: continue
+            password = str(r.get('password', '')).strip()
+            if not is_hashed(password):
+                password = hash_password(password)
+                migrate.append((name, password))
+            users[name] = {'username': name, 'password': password, 'role': str(r.get('role', '')).strip()}
+        with self.lock: self._users = users
+        for name, password in migrate: self.save_password(name, password)
+        return True
+
+    def _public(self, user):
+        return {k: v for k, v in user.items() if k != 'password'}
+
+    def check(self, username, password):
+        username = str(username).strip()
+        self._ensure()
+        for attempt in range(2):
+            with self.lock: user = (self._users or {}).get(username)
+            if user and verify_password(password, user['password']): return self._public(user)
+            # Có thể admin vừa sửa tay bảng Users: tải lại nhưng có giới hạn tần suất
+            if attempt or not self._ensure(force=True): break
+        # Băm giả để tên đăng nhập không tồn tại mất cùng thời gian như sai mật khẩu
+        if not user: hash_password(password)
+        return None
+
+    def set_password(self, username, new_password):
+        self._ensure()
+        with self.lock:
+            user = (self._users or {}).get(username)
+            if not user: return False
+            user['password'] = hash_password(new_password)
+            hashed = user['password']
+        self.save_password(username, hashed)
+        return True
@@ -0,0 +1,109 @@
+import json
+import random
+from datetime import date, timedelta
+
+# --- SINH DỮ LIỆU GIẢ LẬP ---
+# Tạo bộ dữ liệu Orders / Customers / Cashbook / ExtraCustomers / Users có cấu trúc giống
+# dữ liệu thật (JSON customer/items/financial, công nợ, sổ quỹ...) theo số lượng đơn hàng.
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+
+HO = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Phan", "Vũ", "Võ", "Đặng", "Bùi", "Đỗ"]
+TEN = ["An", "Bình", "Châu", "Dũng", "Giang", "Hà", "Hải", "Hoa", "Khánh", "Lan", "Minh", "Phúc", "Quân", "Thảo", "Tuấn", "Vy"]
+CONG_TY = ["Cty TNHH", "Cửa hàng", "Nhà hàng", "Quán cà phê", "Shop", "Spa", "Trường mầm non"]
+DUONG = ["Phạm Văn Thuận", "Đồng Khởi", "Võ Thị Sáu", "Nguyễn Ái Quốc", "Bùi Hữu Nghĩa", "30/4", "Hà Huy Giáp"]
+PRODUCTS = [
+    ("Danh thiếp couche 300", "Hộp", 35_000, 60_000), ("Tờ rơi A5 in 2 mặt", "Tờ", 400, 900),
+    ("Decal nhựa trong", "M2", 60_000, 120_000), ("Bạt hiflex khung sắt", "M2", 45_000, 90_000),
+    ("Standee cuốn nhôm", "Cái", 250_000, 450_000), ("Menu ép plastic", "Cuốn", 30_000, 70_000),
+    ("Tem nhãn decal giấy", "Tờ", 3_000, 8_000), ("Hộp giấy ivory", "Cái", 2_500, 6_000),
+    ("Bảng hiệu alu chữ nổi", "M2", 900_000, 1_600_000), ("Catalogue 16 trang", "Cuốn", 18_000, 35_000),
+    ("Phiếu bảo hành", "Cuốn", 12_000, 25_000), ("Túi giấy kraft", "Cái", 3_500, 7_500),
+]
+STAFF = [("Nam", 0.6), ("Dương", 0.6), ("Vạn", 0.5), ("Khác", 0.3)]
+STATUSES = [("Báo giá", 8), ("Thiết kế", 5), ("Sản xuất", 6), ("Giao hàng", 4), ("Công nợ", 12), ("Hoàn thành", 65)]
+
+ORDER_COLS = ["order_id", "date", "status", "payment_status", "customer", "items", "financial"]
+CUSTOMER_COLS = ["phone", "name", "address", "last_order"]
+CASH_COLS = ["Date", "Content", "Amount", "TM/CK", "Note"]
+EXTRA_COLS = ["id", "customer", "pre_tax", "actual", "not_done", "vat_rate", "pit_tax", "refund", "status"]
+USER_COLS = ["username", "password", "role"]
+
+
+def _customer(rng):
+    name = f"{rng.choice(CONG_TY)} {rng.choice(HO)} {rng.choice(TEN)}" if rng.random() < 0.6 else f"{rng.choice(HO)} {rng.choice(TEN)}"
+    phone = "09" + "".join(str(rng.randint(0, 9)) for _ in range(8))
+    address = f"{rng.randint(1, 500)} {rng.choice(DUONG)}, Biên Hòa, Đồng Nai"
+    return {"name": name, "phone": phone, "address": address}
+
+
+def _items(rng, rate):
+    items = []
+    for name, unit, cost, price in rng.sample(PRODUCTS, rng.randint(1, 4)):
+        qty = float(rng.choice([1, 2, 5, 10, 50, 100, 500, 1000]) if unit in ("Tờ", "Cái") else rng.randint(1, 20))
+        price = float(round(price * rng.uniform(0.85, 1.2), -2))
+        vat = float(rng.choice([0, 0, 8, 10]))
+        total_sell, total_cost = qty * price, qty * cost
+        vat_amt = total_sell * vat / 100
+        profit = total_sell - total_cost
+        items.append({
+            "name": name, "unit": unit, "qty": qty, "cost": float(cost), "price": price, "vat_rate": vat,
+            "vat_amt": vat_amt, "profit": profit, "commission": profit * rate if profit > 0 else 0,
+            "total_line": total_sell + vat_amt,
+        })
+    return items
+
+
+def generate_dataset(n_orders, seed=42, start=date(2024, 1, 1)):
+    rng = random.Random(seed)
+    n_customers = max(20, n_orders // 8)
+    customers = [_customer(rng) for _ in range(n_customers)]
+    span_days = max(30, (date.today() - start).days)
+    statuses, weights = zip(*STATUSES)
+
+    orders, cash = [], []
+    counters = {}
+    for i in range(n_orders):
+        d = start + timedelta(days=int(span_days * i / max(1, n_orders)))
+        yy = d.strftime("%y")
+        counters[yy] = counters.get(yy, 0) + 1
+        oid = f"{counters[yy]:03d}/DH.{yy}"
+        staff, rate = rng.choice(STAFF)
+        items = _items(rng, rate)
+        total = sum(it["total_line"] for it in items)
+        profit = sum(it["profit"] for it in items)
+        status = rng.choices(statuses, weights)[0]
+        if status == "Hoàn thành": paid = total
+        elif status in ("Giao hàng", "Công nợ"): paid = rng.choice([0, round(total * 0.5, -3)])
+        else: paid = rng.choice([0, 0, round(total * 0.3, -3)])
+        pay_status = "Đã TT" if total - paid <= 10 else ("Cọc/Còn nợ" if paid > 0 else "Chưa TT")
+        fin = {
+            "total": total, "paid": paid, "debt": max(0, total - paid), "staff": staff,
+            "total_profit": profit, "total_comm": profit * rate if profit > 0 else 0,
+            "commission_status": "Đã chi" if status == "Hoàn thành" and rng.random() < 0.7 else "Chưa chi",
+        }
+        cust = rng.choice(customers)
+        orders.append([
+            oid, d.isoformat(), status, pay_status, json.dumps(cust, ensure_ascii=False),
+            json.dumps(items, ensure_ascii=False), json.dumps(fin, ensure_ascii=False),
+        ])
+        if paid > 0:
+            cash.append([d.isoformat(), "Thu", paid, rng.choice(["TM", "CK"]), f"Thu tiền đơn {oid}"])
+        if rng.random() < 0.15:
+            cash.append([d.isoformat(), "Chi", float(rng.choice([50_000, 120_000, 300_000, 1_500_000])), "TM", rng.choice(["Mua mực in", "Tiền điện", "Vận chuyển", "Mua giấy"])])
+
+    extra = []
+    for i in range(max(5, n_orders // 20)):
+        pre_tax = float(rng.randint(5, 200) * 100_000)
+        actual = float(round(pre_tax * rng.uniform(0.5, 0.9), -3))
+        not_done = pre_tax - actual
+        pit = 0.1 * not_done
+        extra.append([f"KT-{1_700_000_000 + i}", f"{rng.choice(HO)} {rng.choice(TEN)}", pre_tax, actual, not_done, 10.0, pit, not_done - pit, rng.choice(["Chưa chi", "Đã chi"])])
+
+    return {
+        "Orders": [ORDER_COLS] + orders,
+        "Customers": [CUSTOMER_COLS] + [[c["phone"], c["name"], c["address"], start.isoformat()] for c in customers],
+        "Cashbook": [CASH_COLS] + cash,
+        "ExtraCustomers": [EXTRA_COLS] + extra,
+        "Users": [USER_COLS, ["Nam", "bench", "admin"], ["Duong", "bench", "staff"], ["Van", "bench", "staff"]],
+    }
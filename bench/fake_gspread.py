@@ -0,0 +1,264 @@
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import gspread
+from gspread.utils import a1_to_rowcol, numericise_all
+
+# --- GSPREAD GIẢ LẬP TRONG BỘ NHỚ ---
+# Mô phỏng các lệnh app.py dùng để đo hiệu năng mà không cần gọi Google Sheets thật.
+# Mỗi lệnh được đếm và có thể thêm độ trễ mạng giả lập (latency + jitter, tính bằng giây).
+
+
+WRITE_CALLS = {'update_cell', 'update', 'batch_update', 'append_row', 'append_rows', 'delete_rows', 'clear'}
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeResponse:
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._body = {"error": {"code": code, "message": message, "status": "INVALID_ARGUMENT"}}
+
+    def json(self):
+        return self._body
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row, self.col, self.value = row, col, value
+
+
+class FakeWorksheet:
+    _ids = itertools.count(1)
+
+    def __init__(self, spreadsheet, title, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = next(self._ids)
+        self.spreadsheet_id = spreadsheet.id
+        self.row_count, self.col_count = rows, cols
+        self.rows = []
+
+    def _call(self, name):
+        self.spreadsheet.client._call(name)
+        # Như API thật: handle của sheet đã bị xóa (hoặc xóa rồi tạo lại) báo lỗi 400
+        if self.spreadsheet._sheets.get(self.title) is not self:
+            raise gspread.exceptions.APIError(FakeResponse(400, f"No grid with id: {self.id}"))
+        if name in WRITE_CALLS: self.spreadsheet.touch()
+
+    def _str(self, v):
+        return "" if v is None else str(v)
+
+    def _grid(self):
+        width = max((len(r) for r in self.rows), default=0)
+        return [[self._str(v) for v in r] + [""] * (width - len(r)) for r in self.rows]
+
+    # --- ĐỌC ---
+    def get_all_records(self, **kwargs):
+        self._call('get_all_records')
+        grid = self._grid()
+        if not grid: return []
+        keys = grid[0]
+        return [dict(zip(keys, numericise_all(row))) for row in grid[1:]]
+
+    def get_all_values(self, **kwargs):
+        self._call('get_all_values')
+        return self._grid()
+
+    def col_values(self, col, **kwargs):
+        self._call('col_values')
+        values = [self._str(r[col - 1]) if len(r) >= col else "" for r in self.rows]
+        while values and values[-1] == "": values.pop()
+        return values
+
+    def row_values(self, row, **kwargs):
+        self._call('row_values')
+        return [self._str(v) for v in self.rows[row - 1]] if len(self.rows) >= row else []
+
+    def cell(self, row, col, **kwargs):
+        self._call('cell')
+        r = self.rows[row - 1] if len(self.rows) >= row else []
+        return FakeCell(row, col, self._str(r[col - 1]) if len(r) >= col else None)
+
+    def find(self, query, **kwargs):
+        self._call('find')
+        for i, r in enumerate(self.rows):
+            for j, v in enumerate(r):
+                if self._str(v) == str(query): return FakeCell(i + 1, j + 1, self._str(v))
+        return None
+
+    # --- GHI ---
+    def _set(self, row, col, value):
+        while len(self.rows) < row: self.rows.append([])
+        r = self.rows[row - 1]
+        while len(r) < col: r.append("")
+        r[col - 1] = value
+
+    def update_cell(self, row, col, value):
+        self._call('update_cell')
+        self._set(row, col, value)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._call('update')
+        r0, c0 = a1_to_rowcol(range_name.split(':')[0]) if range_name else (1, 1)
+        for i, row in enumerate(values):
+            for j, v in enumerate(row): self._set(r0 + i, c0 + j, v)
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update')
+        for d in data:
+            r0, c0 = a1_to_rowcol(d['range'].split('!')[-1].split(':')[0])
+            for i, row in enumerate(d['values']):
+                for j, v in enumerate(row): self._set(r0 + i, c0 + j, v)
+
+    def append_row(self, values, **kwargs):
+        self._call('append_row')
+        self.rows.append(list(values))
+
+    def append_rows(self, values, **kwargs):
+        self._call('append_rows')
+        self.rows.extend(list(v) for v in values)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._call('delete_rows')
+        del self.rows[start_index - 1:(end_index or start_index)]
+
+    def clear(self):
+        self._call('clear')
+        self.rows = []
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, url):
+        self.client = client
+        self.url = url
+        self.id = url.rstrip('/').split('/')[-2] if '/d/' in url else url
+        self.title = "Fake"
+        self._sheets = {}
+        self.revision = 0
+
+    def touch(self):
+        # Giống modifiedTime trên Drive: đổi sau mỗi lần ghi, kể cả khi nạp lại dữ liệu bằng load() (mô phỏng sửa tay)
+        self.revision += 1
+
+    def get_lastUpdateTime(self):
+        self.client._call('get_lastUpdateTime')
+        return (EPOCH + timedelta(seconds=self.revision)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    def load(self, tables):
+        # tables: {tên sheet: [dòng tiêu đề, dòng 1, ...]}
+        for title, rows in tables.items():
+            ws = self._sheets.get(title) or FakeWorksheet(self, title)
+            ws.rows = [list(r) for r in rows]
+            self._sheets[title] = ws
+        self.touch()
+
+    def worksheet(self, title):
+        self.client._call('worksheet')
+        if title not in self._sheets: raise gspread.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def worksheets(self):
+        self.client._call('worksheets')
+        return list(self._sheets.values())
+
+    def values_batch_get(self, ranges, params=None):
+        self.client._call('values_batch_get')
+        value_ranges = []
+        for rng in ranges:
+            title, _, part = rng.partition('!')
+            title = title.strip("'").replace("''", "'")
+            if title not in self._sheets:
+                raise gspread.exceptions.APIError(FakeResponse(400, f"Unable to parse range: {rng}"))
+            grid = self._sheets[title]._grid()
+            if part and part.split(':')[0].isalpha():
+                # Cả cột, vd. A:A hoặc A:B
+                first, _, last = part.partition(':')
+                c1, c2 = a1_to_rowcol(first + "1")[1], a1_to_rowcol((last or first) + "1")[1]
+                grid = [list(r[c1 - 1:c2]) for r in grid]
+                for cells in grid:
+                    while cells and cells[-1] == "": cells.pop()
+                while grid and not grid[-1]: grid.pop()
+            elif part and part.split(':')[0].isdigit():
+                # Cả dòng, vd. 1:1
+                row = int(part.split(':')[0])
+                cells = list(grid[row - 1]) if len(grid) >= row else []
+                # Như API thật: bỏ các ô trống ở cuối dòng
+                while cells and cells[-1] == "": cells.pop()
+                grid = [cells] if cells else []
+            value_ranges.append({'range': rng, 'majorDimension': 'ROWS', 'values': grid})
+        return {'spreadsheetId': self.id, 'valueRanges': value_ranges}
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        self.client._call('add_worksheet')
+        self.touch()
+        ws = self._sheets[title] = FakeWorksheet(self, title, rows, cols)
+        return ws
+
+    def batch_update(self, body):
+        self.client._call('spreadsheet_batch_update')
+        by_id = {ws.id: ws for ws in self._sheets.values()}
+        for req in body.get('requests', []):
+            for r in req.values():
+                sheet_id = (r.get('range') or r.get('start') or r).get('sheetId')
+                # Cả lô bị từ chối, không áp dụng gì
+                if sheet_id is not None and sheet_id not in by_id:
+                    raise gspread.exceptions.APIError(FakeResponse(400, f"No grid with id: {sheet_id}"))
+        self.touch()
+        for req in body.get('requests', []):
+            if 'deleteDimension' in req:
+                rng = req['deleteDimension']['range']
+                del by_id[rng['sheetId']].rows[rng['startIndex']:rng['endIndex']]
+            elif 'updateCells' in req and 'range' in req['updateCells']:
+                # Chỉ hỗ trợ xóa giá trị cả sheet (range chỉ có sheetId, không kèm rows)
+                by_id[req['updateCells']['range']['sheetId']].rows = []
+            elif 'updateCells' in req:
+                start = req['updateCells']['start']
+                ws = by_id[start['sheetId']]
+                for i, row in enumerate(req['updateCells']['rows']):
+                    for j, cell in enumerate(row['values']):
+                        ws._set(start['rowIndex'] + i + 1, start['columnIndex'] + j + 1, _cell_value(cell))
+            elif 'appendCells' in req:
+                ws = by_id[req['appendCells']['sheetId']]
+                while ws.rows and not any(ws._str(v) for v in ws.rows[-1]): ws.rows.pop()
+                ws.rows.extend([_cell_value(c) for c in row['values']] for row in req['appendCells']['rows'])
+
+
+def _cell_value(cell):
+    v = next(iter(cell.get('userEnteredValue', {}).values()), "")
+    # Sheets hiển thị 5.0 thành 5
+    return int(v) if isinstance(v, float) and v.is_integer() else v
+
+
+class FakeClient:
+    def __init__(self, latency=0.0, jitter=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._spreadsheets = {}
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay: time.sleep(delay)
+
+    def reset_counters(self):
+        with self._lock: self.calls.clear()
+
+    def total_calls(self):
+        with self._lock: return sum(self.calls.values())
+
+    def spreadsheet(self, url):
+        if url not in self._spreadsheets: self._spreadsheets[url] = FakeSpreadsheet(self, url)
+        return self._spreadsheets[url]
+
+    def open_by_url(self, url):
+        self._call('open_by_url')
+        return self.spreadsheet(url)
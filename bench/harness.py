@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+
+import gspread
+from google.oauth2 import service_account
+
+from bench.fake_gspread import FakeClient
+
+# --- KẾT NỐI APP VỚI BACKEND GIẢ LẬP ---
+# Thay gspread.authorize bằng FakeClient để app.py chạy qua Streamlit AppTest như thật.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "app.py")
+SHEET_URL = "https://docs.google.com/spreadsheets/d/1Oq3fo2vK-LGHMZq3djZ3mmX5TZMGVZeJVu-MObC5_cU/edit"
+MENU = ["1. Tạo Báo Giá", "2. Quản Lý Đơn Hàng (Pipeline)", "3. Khách Thêm", "4. Sổ Quỹ", "5. Dashboard & Báo Cáo"]
+
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+
+def install_fake_backend(tables, latency=0.0, jitter=0.0):
+    client = FakeClient(latency=latency, jitter=jitter, seed=1)
+    client.spreadsheet(SHEET_URL).load(tables)
+    gspread.authorize = lambda creds: client
+    service_account.Credentials.from_service_account_info = staticmethod(lambda info, scopes=None: None)
+    # Nhật ký hàng đợi ghi của lần đo không được lẫn với dữ liệu thật
+    os.environ["SYNC_DIR"] = tempfile.mkdtemp(prefix="bench-sync-")
+    return client
+
+
+def reset_app_caches(keep_disk=False):
+    # keep_disk=True giống khởi động lại tiến trình: RAM trống nhưng còn bản lưu SQLite
+    import streamlit as st
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    snapshot = os.path.join(os.environ.get("SYNC_DIR", ".sync"), "snapshot.sqlite3")
+    if not keep_disk and os.path.exists(snapshot): os.remove(snapshot)
+
+
+def make_app(user="Nam", role="admin", timeout=600):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_FILE, default_timeout=timeout)
+    at.secrets["service_account"] = {"type": "service_account"}
+    at.session_state.logged_in = True
+    at.session_state.user = {"username": user, "password": "", "role": role}
+    at.session_state.role = role
+    return at
+
+
+def open_page(at, page):
+    try: radio = at.sidebar.radio[0]
+    except (KeyError, IndexError):
+        at.run()
+        radio = at.sidebar.radio[0]
+    radio.set_value(page).run()
+    if at.exception: raise RuntimeError(f"{page}: {at.exception[0].value}")
+    return at
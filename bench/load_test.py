@@ -0,0 +1,175 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import streamlit as st
+
+from bench.datagen import SIZES, generate_dataset
+from bench.harness import MENU, install_fake_backend, make_app, reset_app_caches
+from perf import percentile
+
+# --- KIỂM TRA TẢI NHIỀU PHIÊN ĐỒNG THỜI ---
+# Mỗi phiên là một AppTest riêng chạy trong một luồng, cùng dùng chung cache/hàng đợi ghi
+# của tiến trình như khi nhiều nhân viên mở app cùng lúc. Ví dụ:
+#   python -m bench.load_test --sessions 1 4 8 --duration 30 --latency 0.05
+#
+# Giới hạn: AppTest dùng Runtime toàn cục, chạy rerun song song trong nhiều luồng sẽ lỗi
+# ("Runtime hasn't been created", lỗi biên dịch script), còn chạy ở nhiều tiến trình thì mỗi phiên
+# có cache/hàng đợi ghi riêng. Vì vậy các lần rerun được xếp hàng qua RUN_LOCK: KHÔNG đo được tranh
+# chấp giữa các rerun chạy cùng lúc (khóa LocalStore, cache_resource, GIL). Độ trễ báo cáo là thời gian
+# chờ tới lượt + thời gian chạy một mình; chỉ hàng đợi ghi nền là chạy song song thật với các rerun.
+SERIALIZED_NOTE = ("Lưu ý: các lần rerun chạy lần lượt (RUN_LOCK), không đo tranh chấp giữa các phiên chạy cùng lúc; "
+                   "'chờ' là thời gian xếp hàng tới lượt, không phải thời gian chờ khóa trong app.")
+
+PIPELINE = MENU[1]
+DASHBOARD = MENU[4]
+ACTIONS = [("select_order", 40), ("advance_status", 20), ("record_payment", 20), ("open_dashboard", 20)]
+STAGES = ["Báo giá", "Thiết kế", "Sản xuất", "Giao hàng", "Công nợ"]
+
+_real_dataframe = st.dataframe
+RUN_LOCK = threading.Lock()
+
+
+def _scripted_dataframe(data=None, *args, **kwargs):
+    # AppTest chưa hỗ trợ chọn dòng trong st.dataframe: đọc dòng cần chọn từ session_state
+    event = _real_dataframe(data, *args, **kwargs)
+    picks = st.session_state.get("_loadtest_select") or {}
+    key = kwargs.get("key")
+    if kwargs.get("on_select") == "rerun" and key in picks:
+        rows = [r for r in picks[key] if data is not None and r < len(data)]
+        return SimpleNamespace(selection=SimpleNamespace(rows=rows, columns=[]))
+    return event
+
+
+class Session:
+    def __init__(self, idx, rng):
+        self.idx = idx
+        self.rng = rng
+        self.at = make_app(user="Nam", role="admin")
+        self.page = None
+        self.reruns = []
+
+    def _rerun(self, fn):
+        t0 = time.perf_counter()
+        with RUN_LOCK:
+            t1 = time.perf_counter()
+            fn()
+            t2 = time.perf_counter()
+        self.reruns.append(((t1 - t0) * 1000, (t2 - t1) * 1000))
+        if self.at.exception: raise RuntimeError(self.at.exception[0].value)
+
+    def goto(self, page):
+        self.at.session_state["_loadtest_select"] = {}
+        if self.page is None: self._rerun(self.at.run)
+        self._rerun(lambda: self.at.sidebar.radio[0].set_value(page).run())
+        self.page = page
+
+    def select(self, stage):
+        if self.page != PIPELINE: self.goto(PIPELINE)
+        self.at.session_state["_loadtest_select"] = {f"tbl_{stage}": [self.rng.randint(0, 30)]}
+        self._rerun(self.at.run)
+
+    def click(self, prefix):
+        buttons = [b for b in self.at.button if (b.key or "").startswith(prefix)]
+        if not buttons: return False
+        self._rerun(lambda: buttons[0].click().run())
+        return True
+
+    def step(self, action):
+        if action == "open_dashboard":
+            self.goto(DASHBOARD)
+        elif action == "select_order":
+            self.select(self.rng.choice(STAGES))
+        elif action == "advance_status":
+            self.select(self.rng.choice(STAGES[:-1]))
+            self.click("mv_")
+        elif action == "record_payment":
+            self.select(self.rng.choice(["Giao hàng", "Công nợ"]))
+            self.click("cf_pay_")
+
+
+def run_level(client, n_sessions, duration, seed):
+    reset_app_caches()
+    results, reruns, errors = [], [], []
+    lock = threading.Lock()
+    names, weights = zip(*ACTIONS)
+    start_barrier = threading.Barrier(n_sessions)
+    client.reset_counters()
+
+    def worker(i):
+        rng = random.Random(seed + i)
+        sess = Session(i, rng)
+        try: sess.goto(PIPELINE)
+        except Exception as e:
+            with lock: errors.append(f"start: {e}")
+        start_barrier.wait()
+        end = time.time() + duration
+        while time.time() < end:
+            action = rng.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try: sess.step(action)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{action}: {e}")
+                    reruns.extend(sess.reruns)
+                # Phiên lỗi được mở lại như người dùng tải lại trang
+                sess = Session(i, rng)
+                continue
+            with lock: results.append((action, (time.perf_counter() - t0) * 1000))
+        with lock: reruns.extend(sess.reruns)
+
+    t_start = time.time()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(n_sessions)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.time() - t_start
+
+    lat = [wait + run for wait, run in reruns]
+    per_action = {}
+    for action, ms in results: per_action.setdefault(action, []).append(ms)
+    calls = client.total_calls()
+    return {
+        'serialized': True,
+        'sessions': n_sessions, 'actions': len(results), 'reruns': len(reruns), 'errors': len(errors), 'error_samples': errors[:5],
+        'throughput_per_s': len(reruns) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(lat, 50), 'p95_ms': percentile(lat, 95), 'p99_ms': percentile(lat, 99),
+        'wait_p95_ms': percentile([w for w, _ in reruns], 95), 'run_p95_ms': percentile([r for _, r in reruns], 95),
+        'api_calls': calls, 'api_calls_per_rerun': calls / len(reruns) if reruns else 0.0,
+        'api_by_method': dict(client.calls),
+        'per_action': {a: {'n': len(v), 'p50_ms': percentile(v, 50), 'p95_ms': percentile(v, 95)} for a, v in per_action.items()},
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Chạy nhiều phiên giả lập song song và đo độ trễ mỗi lần rerun")
+    p.add_argument("--sessions", nargs="+", type=int, default=[1, 2, 4, 8], help="Các mức số phiên đồng thời")
+    p.add_argument("--duration", type=float, default=20.0, help="Số giây chạy cho mỗi mức")
+    p.add_argument("--size", default="1k", help="1k / 10k / 100k hoặc số đơn hàng")
+    p.add_argument("--latency", type=float, default=0.05, help="Độ trễ giả lập mỗi lệnh API (giây)")
+    p.add_argument("--jitter", type=float, default=0.02)
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = p.parse_args(argv)
+
+    st.dataframe = _scripted_dataframe
+    report = []
+    print(SERIALIZED_NOTE)
+    print(f"{'phiên':>5} | {'rerun':>6} | {'/giây':>6} | {'p50':>7} | {'p95':>7} | {'p99':>7} | {'chờ p95':>7} | {'API':>6} | API/rerun | lỗi")
+    for n in args.sessions:
+        # Mỗi mức dùng bộ dữ liệu mới để kết quả không phụ thuộc mức trước
+        client = install_fake_backend(generate_dataset(SIZES.get(args.size) or int(args.size)), args.latency, args.jitter)
+        r = run_level(client, n, args.duration, args.seed)
+        report.append(r)
+        print(f"{n:>5} | {r['reruns']:>6} | {r['throughput_per_s']:>6.2f} | {r['p50_ms']:>7.0f} | {r['p95_ms']:>7.0f} | {r['p99_ms']:>7.0f}"
+              f" | {r['wait_p95_ms']:>7.0f} | {r['api_calls']:>6} | {r['api_calls_per_rerun']:>9.2f} | {r['errors']}", flush=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
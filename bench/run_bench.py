@@ -0,0 +1,95 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from bench.datagen import SIZES, generate_dataset
+from bench.harness import MENU, install_fake_backend, make_app, open_page, reset_app_caches
+
+# --- ĐO HIỆU NĂNG TỪNG MỤC MENU ---
+# Ví dụ:
+#   python -m bench.run_bench --sizes 1k 10k --latency 0.05 --json bench.json
+#   python -m bench.run_bench --sizes 1k --baseline bench.json   (báo lỗi nếu chậm hơn / gọi API nhiều hơn)
+
+
+def bench_page(client, page, repeat):
+    at = make_app()
+    open_page(at, MENU[0])
+    # Lần "cold": xóa cache để trang phải tải lại toàn bộ dữ liệu
+    reset_app_caches()
+    client.reset_counters()
+    start = time.perf_counter()
+    open_page(at, page)
+    cold = {'wall_ms': (time.perf_counter() - start) * 1000, 'api_calls': client.total_calls(), 'by_method': dict(client.calls)}
+
+    # Lần "restart": RAM trống nhưng còn bản lưu trên đĩa, trang hiện ngay và làm mới ngầm
+    reset_app_caches(keep_disk=True)
+    client.reset_counters()
+    start = time.perf_counter()
+    at.run()
+    restart = {'wall_ms': (time.perf_counter() - start) * 1000}
+
+    walls, calls = [], []
+    for _ in range(repeat):
+        client.reset_counters()
+        start = time.perf_counter()
+        at.run()
+        walls.append((time.perf_counter() - start) * 1000)
+        calls.append(client.total_calls())
+    warm = {'wall_ms': statistics.median(walls), 'api_calls': max(calls)}
+    return {'cold': cold, 'restart': restart, 'warm': warm}
+
+
+def run(sizes, latency, jitter, repeat, pages):
+    results = {}
+    for size in sizes:
+        tables = generate_dataset(SIZES.get(size) or int(size))
+        client = install_fake_backend(tables, latency, jitter)
+        for page in pages:
+            results[f"{size}|{page}"] = bench_page(client, page, repeat)
+            r = results[f"{size}|{page}"]
+            print(f"{size:>5} | {page:<32} | cold {r['cold']['wall_ms']:9.0f} ms {r['cold']['api_calls']:4d} API"
+                  f" | restart {r['restart']['wall_ms']:7.0f} ms | warm {r['warm']['wall_ms']:9.0f} ms {r['warm']['api_calls']:4d} API", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, r in results.items():
+        base = baseline.get(key)
+        if not base: continue
+        for mode in ('cold', 'restart', 'warm'):
+            if mode not in base: continue
+            now, old = r[mode], base[mode]
+            if now['wall_ms'] > old['wall_ms'] * (1 + tolerance) + 50:
+                regressions.append(f"{key} [{mode}] thời gian {old['wall_ms']:.0f} → {now['wall_ms']:.0f} ms")
+            if 'api_calls' in old and now['api_calls'] > old['api_calls']:
+                regressions.append(f"{key} [{mode}] số lần gọi API {old['api_calls']} → {now['api_calls']}")
+    return regressions
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Đo thời gian và số lần gọi API của từng mục menu với dữ liệu giả lập")
+    p.add_argument("--sizes", nargs="+", default=["1k", "10k"], help="1k / 10k / 100k hoặc số đơn hàng cụ thể")
+    p.add_argument("--pages", nargs="+", type=int, default=[1, 2, 3, 4, 5], help="Số thứ tự mục menu cần đo")
+    p.add_argument("--latency", type=float, default=0.0, help="Độ trễ giả lập mỗi lệnh API (giây)")
+    p.add_argument("--jitter", type=float, default=0.0)
+    p.add_argument("--repeat", type=int, default=3, help="Số lần chạy lại khi đã có cache")
+    p.add_argument("--json", help="Ghi kết quả ra file JSON")
+    p.add_argument("--baseline", help="File JSON kết quả cũ để so sánh")
+    p.add_argument("--tolerance", type=float, default=0.25, help="Mức chậm hơn cho phép so với baseline (0.25 = 25%%)")
+    args = p.parse_args(argv)
+
+    results = run(args.sizes, args.latency, args.jitter, args.repeat, [MENU[i - 1] for i in args.pages])
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions: print("REGRESSION:", line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from bench.harness import ROOT
+
+# --- ĐO THỜI GIAN KHỞI ĐỘNG ---
+# Mỗi lần đo chạy một tiến trình Python mới, import app.py (không chạy giao diện) rồi báo
+# thời gian import, bộ nhớ RSS và các thư viện nặng đã bị nạp. Ví dụ:
+#   python -m bench.startup --repeat 5 --json startup.json
+
+HEAVY = ["plotly.express", "fpdf", "num2words", "openpyxl", "pandas", "numpy", "gspread", "google.oauth2"]
+
+PROBE = r"""
+import json, resource, sys, time
+t0 = time.perf_counter()
+import streamlit
+t1 = time.perf_counter()
+import app
+t2 = time.perf_counter()
+print(json.dumps({
+    'streamlit_ms': (t1 - t0) * 1000, 'app_ms': (t2 - t1) * 1000, 'total_ms': (t2 - t0) * 1000,
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'loaded': [m for m in HEAVY if m in sys.modules],
+}))
+"""
+
+LAZY = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+print(json.dumps({{'ms': (time.perf_counter() - t0) * 1000}}))
+"""
+
+
+def _run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure(repeat):
+    runs = [_run(f"HEAVY = {HEAVY!r}\n" + PROBE) for _ in range(repeat)]
+    result = {k: statistics.median(r[k] for r in runs) for k in ('streamlit_ms', 'app_ms', 'total_ms', 'rss_mb')}
+    result['loaded'] = runs[-1]['loaded']
+    # Chi phí trả sau khi người dùng mở Dashboard / xuất PDF lần đầu
+    result['lazy_ms'] = {m: statistics.median(_run(LAZY.format(module=m))['ms'] for _ in range(repeat))
+                         for m in ("plotly.express", "fpdf", "num2words")}
+    return result
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Đo thời gian import và bộ nhớ khi khởi động app.py")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = p.parse_args(argv)
+    r = measure(args.repeat)
+    print(f"streamlit {r['streamlit_ms']:.0f} ms | app.py {r['app_ms']:.0f} ms | tổng {r['total_ms']:.0f} ms | RSS {r['rss_mb']:.0f} MB")
+    print("đã nạp:", ", ".join(r['loaded']))
+    print("nạp sau:", " | ".join(f"{m} {ms:.0f} ms" for m, ms in r['lazy_ms'].items()))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(r, f, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import bisect
+import threading
+from collections import Counter
+
+# --- DANH MỤC SẢN PHẨM ---
+# Dựng một lần từ các mặt hàng đã bán trong Orders, sau đó cập nhật theo từng đơn khi lưu/sửa/xóa.
+# Khóa là tên đã bỏ dấu, viết thường. Mỗi sản phẩm có một mục chỉ mục cho mỗi từ trong tên
+# (hậu tố bắt đầu từ từ đó) nên gõ "hiflex" vẫn ra "Bạt hiflex 3m2"; tra bằng tìm nhị phân.
+
+
+def _num(value):
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+
+class ProductCatalog:
+    def __init__(self, normalize):
+        self._normalize = normalize
+        self.lock = threading.Lock()
+        # Danh sách bản ghi Orders đã dùng để dựng: khác đối tượng nghĩa là bảng vừa được nạp lại
+        self.source = None
+        self._products = {}
+        self._index = []
+
+    def key(self, name):
+        return " ".join(self._normalize(name).lower().split())
+
+    def _suffixes(self, key):
+        words = key.split()
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def _add(self, item):
+        key = self.key(item.get('name'))
+        if not key: return None
+        p = self._products.get(key)
+        new = p is None
+        if new:
+            p = self._products[key] = {'key': key, 'name': "", 'units': Counter(), 'vat_rate': 0.0, 'last_price': 0.0,
+                                       'last_cost': 0.0, 'n': 0, 'sum_price': 0.0, 'sum_cost': 0.0}
+        # Đơn xử lý theo thứ tự ghi nên mặt hàng sau cùng là giá gần nhất
+        p['name'] = str(item.get('name')).strip()
+        if item.get('unit'): p['units'][str(item['unit']).strip()] += 1
+        p['vat_rate'] = _num(item.get('vat_rate'))
+        p['last_price'], p['last_cost'] = _num(item.get('price')), _num(item.get('cost'))
+        p['n'] += 1
+        p['sum_price'] += p['last_price']
+        p['sum_cost'] += p['last_cost']
+        return key if new else None
+
+    def _remove(self, item):
+        key = self.key(item.get('name'))
+        p = self._products.get(key)
+        if not p: return
+        p['n'] -= 1
+        p['sum_price'] -= _num(item.get('price'))
+        p['sum_cost'] -= _num(item.get('cost'))
+        if item.get('unit'): p['units'][str(item['unit']).strip()] -= 1
+        if p['n'] > 0: return
+        del self._products[key]
+        for suffix in self._suffixes(key):
+            i = bisect.bisect_left(self._index, (suffix, key))
+            if i < len(self._index) and self._index[i] == (suffix, key): del self._index[i]
+
+    def ensure(self, source, load_orders):
+        # Dựng lại toàn bộ chỉ khi dữ liệu nguồn đổi đối tượng (nạp lại từ Sheets)
+        with self.lock:
+            if self.source is source: return False
+            self._products, self._index = {}, []
+            for o in load_orders():
+                for it in o.get('items') or []: self._add(it)
+            self._index = sorted((s, k) for k in self._products for s in self._suffixes(k))
+            self.source = source
+            return True
+
+    def add_items(self, items):
+        with self.lock:
+            for it in items or []:
+                key = self._add(it)
+                if key:
+                    for suffix in self._suffixes(key): bisect.insort(self._index, (suffix, key))
+
+    def remove_items(self, items):
+        with self.lock:
+            for it in items or []: self._remove(it)
+
+    def replace_items(self, old_items, new_items):
+        self.remove_items(old_items)
+        self.add_items(new_items)
+
+    def _view(self, p):
+        n = max(p['n'], 1)
+        unit = p['units'].most_common(1)[0][0] if +p['units'] else ""
+        return {'name': p['name'], 'unit': unit, 'vat_rate': p['vat_rate'], 'last_price': p['last_price'],
+                'last_cost': p['last_cost'], 'avg_price': p['sum_price'] / n, 'avg_cost': p['sum_cost'] / n, 'count': p['n']}
+
+    def get(self, name):
+        with self.lock:
+            p = self._products.get(self.key(name))
+            return self._view(p) if p else None
+
+    def search(self, prefix, limit=10):
+        q = self.key(prefix)
+        if not q: return []
+        with self.lock:
+            keys, i = {}, bisect.bisect_left(self._index, (q,))
+            while i < len(self._index) and self._index[i][0].startswith(q):
+                keys[self._index[i][1]] = True
+                i += 1
+            # Khớp từ đầu tên trước, sau đó mặt hàng bán nhiều hơn
+            ranked = sorted(keys, key=lambda k: (not k.startswith(q), -self._products[k]['n'], k))
+            return [self._view(self._products[k]) for k in ranked[:limit]]
+
+    def __len__(self):
+        return len(self._products)
@@ -0,0 +1,434 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime
+
+import importer
+import reconcile
+from rowversion import make_patch
+
+# --- CHẠY NỀN KHÔNG CẦN GIAO DIỆN ---
+# Dùng lại các hàm dữ liệu/PDF của app.py mà không mở server Streamlit, cho các việc nặng chạy
+# theo lịch ban đêm thay vì trong lúc người dùng đang thao tác. Ví dụ crontab:
+#   0 2 * * *  cd /srv/inan && python cli.py warm && python cli.py export all && python cli.py check
+# Thông tin đăng nhập Google lấy từ .streamlit/secrets.toml giống app. File Excel dựng sẵn được
+# ghi vào REPORTS_DIR, app cho tải thẳng các file này ở mục "Xuất Excel".
+
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+PDF_TITLES = {"Báo giá": "BÁO GIÁ", "Giao hàng": "PHIẾU GIAO HÀNG", "Công nợ": "PHIẾU GIAO HÀNG, KIÊM PHIẾU THU"}
+
+
+def load_app():
+    import app
+    # Hàng đợi ghi của CLI dùng nhật ký riêng: app đang chạy không đẩy trùng các thao tác này
+    app.JOURNAL_FILE = os.path.join(app.SYNC_DIR, 'journal-cli.jsonl')
+    if not app.get_gspread_client(): raise SystemExit("Không kết nối được Google Sheets (kiểm tra .streamlit/secrets.toml)")
+    return app
+
+
+def wait_for_sync(app, timeout):
+    queue = app.get_write_queue()
+    if queue.flush(timeout): return 0
+    print(f"Chưa đẩy xong lên Google Sheets: {queue.status()}", file=sys.stderr)
+    return 1
+
+
+def _num(value):
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+
+def _date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+# --- LỆNH ---
+def cmd_warm(app, args):
+    # Tải mới mọi sheet trong một lần đọc và ghi bản lưu SQLite cho lần khởi động app kế tiếp
+    store = app.get_local_store()
+    sheets = args.sheets or list(app.SHEET_LAYOUTS)
+    start = time.perf_counter()
+    store.invalidate()
+    store.prefetch(sheets)
+    for sheet in sheets: print(f"{sheet:>16}: {len(store.get(sheet))} dòng")
+    print(f"Xong sau {time.perf_counter() - start:.1f}s, lưu tại {app.SNAPSHOT_FILE}")
+    return 0
+
+
+def cmd_export(app, args):
+    kinds = list(app.EXPORTS) if args.kind == "all" else [args.kind]
+    end = args.to or date.today()
+    start = args.since or end.replace(day=1)
+    os.makedirs(args.out, exist_ok=True)
+    for kind in kinds:
+        t0 = time.perf_counter()
+        data = app.build_export(kind, (), start, end)
+        path = os.path.join(args.out, app.exports.export_filename(app.EXPORTS[kind][2]))
+        with open(path + ".tmp", "wb") as f: f.write(data)
+        os.replace(path + ".tmp", path)
+        print(f"{kind:>9}: {path} ({len(data) / 1024:.0f} KB, {time.perf_counter() - t0:.1f}s)")
+    return 0
+
+
+def cmd_pdfs(app, args):
+    os.makedirs(args.out, exist_ok=True)
+    count = 0
+    if args.what == "statements":
+        index = app.receivables()
+        for row in index.aging():
+            if row['balance'] < args.min_balance: continue
+            statement = index.statement(row['key'])
+            name = f"CongNo_{statement['phone'] or statement['key']}.pdf"
+            with open(os.path.join(args.out, name), "wb") as f: f.write(app.create_statement_pdf(statement))
+            count += 1
+    else:
+        for order in app.fetch_all_orders():
+            if args.ids and str(order.get('order_id')) not in args.ids: continue
+            if args.status and order.get('status') != args.status: continue
+            title = args.title or PDF_TITLES.get(order.get('status'), "BÁO GIÁ")
+            name = str(order.get('order_id')).replace("/", "-") + ".pdf"
+            with open(os.path.join(args.out, name), "wb") as f: f.write(app.create_pdf(order, title))
+            count += 1
+    print(f"Đã tạo {count} file PDF trong {args.out}")
+    return 0
+
+
+def integrity_problems(app):
+    # Trả về {loại lỗi: [mô tả từng dòng]} cho dữ liệu Orders và Cashbook.
+    # Mã đơn, công nợ, TT thanh toán và phiếu thu lấy từ đối soát (reconcile.py); ở đây chỉ thêm các kiểm tra còn lại
+    problems = app.get_reconciliation().problems()
+    add = lambda kind, text: problems.setdefault(kind, []).append(text)
+    store = app.get_local_store()
+    records = store.get("Orders")
+    for r in records:
+        oid = r.get('order_id')
+        if r.get('deleted'): continue
+        try: o = app.parse_order(r)
+        except ValueError:
+            add("JSON hỏng", str(oid))
+            continue
+        fin = o['financial']
+        total, paid = _num(fin.get('total')), _num(fin.get('paid'))
+        if paid - total > 1: add("Trả dư", f"{oid}: đã trả {paid:,.0f} > tổng {total:,.0f}")
+        items = o['items']
+        if items:
+            lines = sum(_num(it.get('total_line')) for it in items)
+            if abs(lines - total) > 1: add("Tổng đơn khác tổng mặt hàng", f"{oid}: {total:,.0f} / {lines:,.0f}")
+            comm = sum(_num(it.get('commission')) for it in items)
+            if abs(comm - _num(fin.get('total_comm'))) > 1: add("Hoa hồng khác tổng mặt hàng", f"{oid}: {_num(fin.get('total_comm')):,.0f} / {comm:,.0f}")
+        if not o['customer'].get('name'): add("Thiếu tên khách", str(oid))
+
+    for i, r in enumerate(store.get("Cashbook"), start=2):
+        if str(r.get('Content', '')).strip() not in ("Thu", "Chi"): add("Sổ quỹ: loại không phải Thu/Chi", f"dòng {i}: {r.get('Content')!r}")
+        try: float(r.get('Amount') or 0)
+        except (TypeError, ValueError): add("Sổ quỹ: số tiền không hợp lệ", f"dòng {i}: {r.get('Amount')!r}")
+        try: datetime.strptime(str(r.get('Date', ''))[:10], "%Y-%m-%d")
+        except ValueError: add("Sổ quỹ: ngày không hợp lệ", f"dòng {i}: {r.get('Date')!r}")
+    return problems
+
+
+def cmd_check(app, args):
+    problems = integrity_problems(app)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(problems, f, ensure_ascii=False, indent=1)
+    print_problems(problems, args.samples)
+    if not problems: print("Không phát hiện lỗi dữ liệu")
+    return 1 if problems else 0
+
+
+def print_problems(problems, samples):
+    for kind, rows in problems.items():
+        print(f"{kind}: {len(rows)}")
+        for text in rows[:samples]: print(f"    {text}")
+
+
+def cmd_reconcile(app, args):
+    # Đối soát số đã trả với TT thanh toán và phiếu thu; --fix ghi bản sửa theo lô như import
+    t0 = time.perf_counter()
+    rec = app.get_reconciliation()
+    problems = rec.problems()
+    print(f"Đối soát {rec.orders} đơn, {rec.receipts} phiếu thu ({time.perf_counter() - t0:.2f}s)")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(problems, f, ensure_ascii=False, indent=1)
+    print_problems(problems, args.samples)
+    if not problems:
+        print("Đơn hàng, thu tiền và sổ quỹ khớp nhau")
+        return 0
+    plan = rec.fixes(args.fix or [])
+    if plan.empty: return 1
+    print(f"{len(plan)} đơn cần sửa ({', '.join(reconcile.FIX_LABELS[k] for k in args.fix)})")
+    if args.dry_run: return 1
+    fixes = app.reconcile_patches(plan, args.method)
+
+    def build(batch, before):
+        # Mỗi đơn một giao dịch: đơn đã đổi so với lúc đối soát thì bỏ cả phiếu thu bù của nó.
+        # Không cần khóa lô: chạy lại sẽ đối soát lại từ dữ liệu mới
+        ops = []
+        for oid, patch, cash in batch:
+            op = app.order_patch_op(oid, patch)
+            if op and not isinstance(op, app.Conflict): ops.append([op] + cash)
+        return ops
+    return write_chunks(app, fixes, build, args.chunk, args.timeout)
+
+
+def cmd_commissions(app, args):
+    report, items = app.preview_commission_recompute(args.include_paid)
+    if report.empty:
+        print("Hoa hồng các đơn đã khớp với quy tắc hiện tại")
+        return 0
+    by_staff = report.groupby('staff')[['old', 'new', 'diff']].sum()
+    print(f"{len(report)} đơn thay đổi")
+    print(by_staff.to_string(float_format=lambda v: f"{v:,.0f}"))
+    if not args.apply:
+        print("Chạy thử: thêm --apply để ghi")
+        return 0
+    res, skipped = app.apply_commission_recompute(report, items)
+    if skipped: print(f"Bỏ qua {len(skipped)} đơn đã thêm/bớt mặt hàng sau khi chạy thử: {', '.join(skipped)}", file=sys.stderr)
+    if not res:
+        print(f"Không ghi được: {res or 'lỗi'}", file=sys.stderr)
+        return 1
+    return wait_for_sync(app, args.timeout)
+
+
+# --- NHẬP DỮ LIỆU / SỬA DỮ LIỆU CŨ ---
+# Mỗi lô là một giao dịch của hàng đợi ghi (một batch_update) với khóa "import:<loại>:<mã file>:<số lô>".
+# Khóa được lưu cùng nhật ký nên chạy lại đúng lệnh sau khi bị ngắt sẽ bỏ qua các lô đã gửi, lô đang chờ
+# trong nhật ký được đẩy tiếp. Dòng đã có trên Sheets (trùng mã đơn / SĐT / phiếu thu chi) không ghi lại.
+# Sửa đơn đã có đi theo patch có mốc version, mỗi đơn một giao dịch riêng (build_ops trả về dạng danh sách):
+# đơn vừa được thu tiền/sửa ở nơi khác chỉ bỏ đơn đó, và lần chạy lại sẽ thử lại đơn đó kể cả khi lô đã gửi.
+def _flat(ops):
+    return [op for o in ops for op in (o if isinstance(o, list) else [o])]
+
+
+def write_chunks(app, rows, build_ops, chunk, timeout, key_prefix=None):
+    queue = app.get_write_queue()
+    done = skipped = conflicts = 0
+    for n, start in enumerate(range(0, len(rows), chunk)):
+        key = f"{key_prefix}:{n}" if key_prefix else None
+        sent = bool(key) and queue.seen(key)
+        t0 = time.perf_counter()
+        ops = build_ops(rows[start:start + chunk], rows[:start])
+        groups = [o for o in ops if isinstance(o, list)]
+        rest = [] if sent else [o for o in ops if not isinstance(o, list)]
+        if sent and not groups:
+            skipped += 1
+            continue
+        since = time.time()
+        for g in groups: queue.submit_many(g)
+        if rest or (key and not sent): queue.submit_many(rest, key)
+        if not queue.flush(timeout):
+            print(f"Lô {n + 1} chưa đẩy xong ({queue.status()['error'] or 'quá thời gian'}); chạy lại lệnh để tiếp tục", file=sys.stderr)
+            return 1
+        lost = [c['key'] for c in queue.status()['conflicts'] if c['ts'] >= since]
+        conflicts += len(lost)
+        done += len(_flat(groups)) + len(rest)
+        print(f"Lô {n + 1}: {len(_flat(groups)) + len(rest)} thao tác ({time.perf_counter() - t0:.1f}s)")
+        if lost: print(f"    Bỏ qua {len(lost)} dòng vừa bị sửa ở nơi khác: {', '.join(lost[:10])}", file=sys.stderr)
+    if skipped: print(f"Bỏ qua {skipped} lô đã nhập ở lần chạy trước")
+    print(f"Xong: {done} thao tác")
+    if conflicts:
+        print(f"{conflicts} dòng xung đột chưa được ghi; chạy lại lệnh để thử lại với dữ liệu mới", file=sys.stderr)
+        return 1
+    return 0
+
+
+def order_update(app, old, values):
+    # Patch có mốc là bản đang thấy: thanh toán / sửa đơn chen vào trong lúc chạy sẽ làm patch xung đột thay vì bị ghi đè
+    patch = make_patch(values, None, {f: old.get(f) for f in values}, app.row_version(old))
+    op = app.order_patch_op(old['order_id'], patch)
+    return [op] if op and not isinstance(op, app.Conflict) else None
+
+
+def _phone_key(value):
+    return str(value or "").strip().lstrip('0')
+
+
+def order_ops(app, orders, update, before=()):
+    store = app.get_local_store()
+    existing = {str(r.get('order_id', '')).strip(): r for r in store.get("Orders")}
+    phones = {_phone_key(c.get('phone')) for c in store.get("Customers")}
+    ops = []
+    for o in orders:
+        cells = [o['date'], o['status'], o['payment_status'], json.dumps(o['customer'], ensure_ascii=False),
+                 json.dumps(o['items'], ensure_ascii=False), json.dumps(o['financial'], ensure_ascii=False)]
+        old = existing.get(o['order_id'])
+        if old is None: ops.append(app.append_op("Orders", [o['order_id']] + cells + [1]))
+        elif update:
+            values = dict(zip(app.ORDER_COLS[1:7], [o['date'], o['status'], o['payment_status'], o['customer'], o['items'], o['financial']]))
+            try: current = app.parse_order(old)
+            except ValueError: current = {}
+            if any(current.get(f) != v for f, v in values.items()):
+                op = order_update(app, old, values)
+                if op: ops.append(op)
+        # Khách mới trong đơn cũng được thêm vào danh bạ như khi lưu báo giá
+        p = _phone_key(o['customer']['phone'])
+        if p and p not in phones:
+            phones.add(p)
+            c = o['customer']
+            ops.append(app.append_op("Customers", [c['phone'], c['name'], c['address'], o['date']]))
+    return ops
+
+
+def customer_ops(app, customers, update, before=()):
+    existing = {_phone_key(c.get('phone')): c for c in app.get_local_store().get("Customers")}
+    ops = []
+    for c in customers:
+        old = existing.get(_phone_key(c['phone']))
+        if old is None:
+            existing[_phone_key(c['phone'])] = c
+            ops.append(app.append_op("Customers", [c['phone'], c['name'], c['address'], c['last_order']]))
+        elif update: ops.append(app.update_op("Customers", "phone", old['phone'], {'name': c['name'], 'address': c['address']}))
+    return ops
+
+
+def cash_fingerprint(r):
+    try: amount = round(float(r.get('Amount') or 0), 2)
+    except (TypeError, ValueError): amount = r.get('Amount')
+    return (str(r.get('Date', ''))[:10], str(r.get('Content', '')).strip(), amount,
+            str(r.get('TM/CK') or "TM").strip().upper(), str(r.get('Note', '')).strip())
+
+
+def cash_ops(app, entries, update, before=()):
+    # Sổ quỹ không có mã dòng: phiếu giống hệt một phiếu đã có (ngày, loại, tiền, hình thức, nội dung) được coi là đã nhập.
+    # Các phiếu ở lô trước của cùng file đã nằm trên Sheets nên được trừ ra, hai phiếu giống nhau trong file vẫn giữ đủ
+    existing = Counter(cash_fingerprint(r) for r in app.get_local_store().get("Cashbook"))
+    existing.subtract(cash_fingerprint(e) for e in before)
+    ops = []
+    for e in entries:
+        fp = cash_fingerprint(e)
+        if existing[fp] > 0:
+            existing[fp] -= 1
+            continue
+        ops.append(app.append_op("Cashbook", [e['Date'], e['Content'], e['Amount'], e['TM/CK'], e['Note']]))
+    return ops
+
+
+IMPORTS = {
+    "orders": ("Orders", lambda app, tables: importer.build_orders(tables, rules=app.get_commission_rules()), order_ops),
+    "customers": ("Customers", lambda app, tables: importer.build_customers(tables), customer_ops),
+    "cashbook": ("Cashbook", lambda app, tables: importer.build_cashbook(tables), cash_ops),
+}
+
+
+def cmd_import(app, args):
+    sheet, build, make_ops = IMPORTS[args.kind]
+    t0 = time.perf_counter()
+    try: tables = importer.read_tables(args.file)
+    except importer.RowError as e:
+        print(e, file=sys.stderr)
+        return 1
+    rows, errors = build(app, tables)
+    print(f"Đọc {len(rows)} dòng hợp lệ, {len(errors)} lỗi ({time.perf_counter() - t0:.1f}s)")
+    for where, msg in errors[:args.samples]: print(f"    {where}: {msg}")
+    if errors and not args.skip_invalid:
+        print("Chưa ghi gì: sửa file hoặc thêm --skip-invalid để bỏ qua các dòng lỗi", file=sys.stderr)
+        return 1
+    app.get_local_store().prefetch([sheet, "Customers"])
+    if args.dry_run:
+        ops = _flat(make_ops(app, rows, args.update))
+        print(f"Chạy thử: sẽ ghi {sum(op['op'] == 'append' for op in ops)} dòng mới, {sum(op['op'] == 'update' for op in ops)} dòng cập nhật")
+        return 0
+    with open(args.file, "rb") as f: digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    mode = "u" if args.update else "a"
+    return write_chunks(app, rows, lambda batch, before: make_ops(app, batch, args.update, before), args.chunk, args.timeout,
+                        f"import:{args.kind}:{mode}:{digest}:{args.chunk}")
+
+
+def cmd_migrate(app, args):
+    # Đưa các đơn cũ về đúng cấu trúc: SĐT chuẩn, ô financial đủ trường dạng số và công nợ = tổng - đã trả
+    records = app.get_local_store().get("Orders")
+    fixes = []
+    for r in records:
+        if r.get('deleted'): continue
+        try: o = app.parse_order(r)
+        except ValueError: continue
+        cust = dict(o['customer'], phone=importer.phone(o['customer'].get('phone')))
+        fin = importer.financial_shape(o['financial'])
+        values = {}
+        if cust != o['customer']: values['customer'] = cust
+        if fin != o['financial']: values['financial'] = fin
+        if values: fixes.append((r, values))
+    print(f"{len(fixes)} / {len(records)} đơn cần sửa")
+    if not fixes or args.dry_run: return 0
+    build = lambda batch, before: [op for op in (order_update(app, r, v) for r, v in batch) if op]
+    return write_chunks(app, fixes, build, args.chunk, args.timeout)
+
+
+def cmd_compact(app, args):
+    removed = app.get_compactor().run_now()
+    print(f"Xếp lịch xóa {removed} dòng đã xóa mềm")
+    return wait_for_sync(app, args.timeout) if removed else 0
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Việc chạy nền cho hệ thống quản lý in ấn (không cần giao diện)")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    w = sub.add_parser("warm", help="Tải mới dữ liệu và ghi bản lưu cho lần khởi động app kế tiếp")
+    w.add_argument("--sheets", nargs="+", help="Chỉ tải các sheet này")
+
+    e = sub.add_parser("export", help="Dựng sẵn file Excel")
+    e.add_argument("kind", choices=["all", "orders", "cashbook", "debtors", "extra"])
+    e.add_argument("--since", type=_date, help="Sổ quỹ từ ngày (YYYY-MM-DD), mặc định đầu tháng")
+    e.add_argument("--to", type=_date, help="Sổ quỹ đến ngày (YYYY-MM-DD), mặc định hôm nay")
+    e.add_argument("--out", default=None, help="Thư mục ghi file, mặc định REPORTS_DIR của app")
+
+    d = sub.add_parser("pdfs", help="In hàng loạt chứng từ PDF")
+    d.add_argument("what", choices=["orders", "statements"])
+    d.add_argument("--status", help="Chỉ các đơn ở trạng thái này (vd. \"Giao hàng\")")
+    d.add_argument("--ids", nargs="+", help="Chỉ các mã đơn này")
+    d.add_argument("--title", help="Tiêu đề chứng từ, mặc định theo trạng thái đơn")
+    d.add_argument("--min-balance", type=float, default=1.0, help="Bảng kê: chỉ khách nợ từ số tiền này")
+    d.add_argument("--out", default="pdf", help="Thư mục ghi file")
+
+    c = sub.add_parser("check", help="Kiểm tra tính nhất quán dữ liệu, trả mã lỗi 1 nếu có vấn đề")
+    c.add_argument("--samples", type=int, default=5, help="Số dòng ví dụ in ra cho mỗi loại lỗi")
+    c.add_argument("--json", help="Ghi toàn bộ kết quả ra file JSON")
+
+    r = sub.add_parser("reconcile", help="Đối soát số đã trả của đơn với TT thanh toán và phiếu thu trong sổ quỹ, trả mã lỗi 1 nếu lệch")
+    r.add_argument("--fix", nargs="+", choices=list(reconcile.FIXES), help="Sửa tự động: debt (công nợ), status (TT thanh toán), cashbook (ghi phiếu thu bù)")
+    r.add_argument("--method", choices=["TM", "CK"], default="TM", help="Hình thức của phiếu thu bù")
+    r.add_argument("--dry-run", action="store_true", help="Chỉ đếm số đơn sẽ sửa")
+    r.add_argument("--samples", type=int, default=5)
+    r.add_argument("--json", help="Ghi toàn bộ kết quả ra file JSON")
+    r.add_argument("--chunk", type=int, default=500)
+    r.add_argument("--timeout", type=float, default=300)
+
+    m = sub.add_parser("commissions", help="Tính lại hoa hồng theo bảng quy tắc (mặc định chỉ chạy thử)")
+    m.add_argument("--include-paid", action="store_true", help="Tính lại cả đơn đã chi hoa hồng")
+    m.add_argument("--apply", action="store_true", help="Ghi kết quả lên Google Sheets")
+    m.add_argument("--timeout", type=float, default=120)
+
+    i = sub.add_parser("import", help="Nhập hàng loạt từ Excel/CSV, ghi theo từng lô, chạy lại để tiếp tục khi bị ngắt")
+    i.add_argument("kind", choices=list(IMPORTS))
+    i.add_argument("file", help="File .xlsx hoặc .csv (nhận cả file do mục Xuất Excel tạo ra)")
+    i.add_argument("--update", action="store_true", help="Ghi đè dòng đã có (cùng mã đơn / SĐT) thay vì bỏ qua")
+    i.add_argument("--skip-invalid", action="store_true", help="Bỏ qua dòng lỗi, vẫn nhập các dòng hợp lệ")
+    i.add_argument("--dry-run", action="store_true", help="Chỉ kiểm tra và đếm, không ghi")
+    i.add_argument("--chunk", type=int, default=500, help="Số dòng mỗi lô (mỗi lô một lần ghi)")
+    i.add_argument("--samples", type=int, default=20, help="Số lỗi in ra")
+    i.add_argument("--timeout", type=float, default=300, help="Thời gian chờ tối đa cho mỗi lô (giây)")
+
+    g = sub.add_parser("migrate", help="Chuẩn hóa SĐT và ô financial của các đơn đã có trên Sheets")
+    g.add_argument("--dry-run", action="store_true")
+    g.add_argument("--chunk", type=int, default=500)
+    g.add_argument("--timeout", type=float, default=300)
+
+    k = sub.add_parser("compact", help="Xóa thật các đơn đã xóa mềm ngay bây giờ")
+    k.add_argument("--timeout", type=float, default=120)
+
+    args = p.parse_args(argv)
+    app = load_app()
+    if args.command == "export" and not args.out: args.out = app.REPORTS_DIR
+    handler = {"warm": cmd_warm, "export": cmd_export, "pdfs": cmd_pdfs, "check": cmd_check,
+               "reconcile": cmd_reconcile, "commissions": cmd_commissions, "import": cmd_import, "migrate": cmd_migrate, "compact": cmd_compact}[args.command]
+    return handler(app, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
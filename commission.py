@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+# --- HOA HỒNG NHÂN VIÊN ---
+# Tỉ lệ lấy từ bảng quy tắc (nhân viên, ngày hiệu lực, tỉ lệ) thay vì viết cứng trong form.
+# Nhân viên "*" là mức mặc định cho người không có quy tắc riêng. Hoa hồng từng mặt hàng là
+# lợi nhuận × tỉ lệ (mặt hàng lỗ thì 0); tổng của đơn là tổng các mặt hàng.
+
+RULE_COLS = ["staff", "effective_from", "rate"]
+DEFAULT_STAFF = "*"
+DEFAULT_RULES = [
+    ["Nam", "2000-01-01", 0.6],
+    ["Dương", "2000-01-01", 0.6],
+    ["Vạn", "2000-01-01", 0.5],
+    [DEFAULT_STAFF, "2000-01-01", 0.3],
+]
+
+
+def _day(value):
+    return pd.to_datetime(pd.Series(value, dtype=object).astype(str), errors='coerce', format='mixed').dt.normalize().astype('datetime64[ns]')
+
+
+def rules_frame(records):
+    df = pd.DataFrame(records or DEFAULT_RULES, columns=None if records else RULE_COLS)
+    for col in RULE_COLS:
+        if col not in df.columns: df[col] = None
+    df = df[RULE_COLS].copy()
+    df['staff'] = df['staff'].astype(str).str.strip()
+    df['effective_from'] = _day(df['effective_from'])
+    df['rate'] = pd.to_numeric(df['rate'], errors='coerce')
+    # Cho phép nhập phần trăm (60) thay vì tỉ lệ (0.6)
+    df.loc[df['rate'] > 1, 'rate'] /= 100
+    df = df.dropna(subset=['effective_from', 'rate'])
+    return df.sort_values('effective_from', kind='mergesort').reset_index(drop=True)
+
+
+def rates_for(rules, staff, days):
+    # Tỉ lệ áp dụng cho từng cặp (nhân viên, ngày): quy tắc gần nhất có hiệu lực trước ngày đó
+    f = pd.DataFrame({'staff': pd.Series(staff, dtype=object).astype(str).str.strip().to_numpy(), 'day': _day(days).to_numpy()})
+    f['day'] = f['day'].fillna(pd.Timestamp.now().normalize())
+    f['pos'] = np.arange(len(f))
+    f = f.sort_values('day', kind='mergesort')
+    r = rules.rename(columns={'effective_from': 'day'})
+    r = r.assign(staff=r['staff'].astype(object))
+    f['staff'] = f['staff'].astype(object)
+    own = pd.merge_asof(f, r, on='day', by='staff', direction='backward')
+    default = pd.merge_asof(f[['day']], r[r['staff'] == DEFAULT_STAFF][['day', 'rate']], on='day', direction='backward')
+    rate = own['rate'].fillna(default['rate']).fillna(0.0).to_numpy()
+    out = np.empty(len(f))
+    out[f['pos'].to_numpy()] = rate
+    return out
+
+
+def rate_for(rules, staff, day=None):
+    return float(rates_for(rules, [staff], [day or pd.Timestamp.now()])[0])
+
+
+def item_commission(profit, rate):
+    return profit * rate if profit > 0 else 0
+
+
+def recompute(orders, rules, include_paid=False):
+    # Một lượt vector trên bảng mặt hàng của mọi đơn. Trả về (báo cáo theo đơn, hoa hồng từng mặt hàng)
+    # items: danh sách mặt hàng lúc chạy thử, dùng làm mốc khi ghi
+    cols = ['order_id', 'version', 'date', 'staff', 'status', 'rate', 'old', 'new', 'diff', 'items']
+    heads, owner, profit = [], [], []
+    for o in orders:
+        fin = o.get('financial') or {}
+        if not include_paid and fin.get('commission_status') == "Đã chi": continue
+        idx = len(heads)
+        heads.append((o.get('order_id'), o.get('version'), o.get('date'), fin.get('staff', ''),
+                      fin.get('commission_status', 'Chưa chi'), fin.get('total_comm', 0), list(o.get('items') or [])))
+        for it in o.get('items') or []:
+            owner.append(idx)
+            profit.append(it.get('profit', 0))
+    if not heads: return pd.DataFrame(columns=cols), {}
+
+    report = pd.DataFrame(heads, columns=['order_id', 'version', 'date', 'staff', 'status', 'old', 'items'])
+    report['old'] = pd.to_numeric(report['old'], errors='coerce').fillna(0.0)
+    report['rate'] = rates_for(rules, report['staff'], report['date'])
+    owner = np.asarray(owner, dtype=np.int64)
+    profit = pd.to_numeric(pd.Series(profit, dtype=object), errors='coerce').fillna(0.0).to_numpy()
+    item_comm = np.clip(profit, 0, None) * report['rate'].to_numpy()[owner]
+    report['new'] = np.bincount(owner, weights=item_comm, minlength=len(report))
+    report['diff'] = report['new'] - report['old']
+
+    changed = np.flatnonzero(np.abs(report['diff'].to_numpy()) >= 0.5)
+    split = np.split(item_comm, np.flatnonzero(np.diff(owner)) + 1) if len(owner) else []
+    per_order = {}
+    for pos, part in zip(np.unique(owner), split): per_order[pos] = part
+    items = {report.at[i, 'order_id']: per_order.get(i, np.empty(0)).tolist() for i in changed}
+    return report.iloc[changed][cols].reset_index(drop=True), items
@@ -0,0 +1,821 @@
+import json
+import numbers
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque, namedtuple
+
+import gspread
+from gspread.utils import rowcol_to_a1
+
+from rowversion import VERSION_FIELD, merge_patch, row_version
+from sheets_client import _status_of
+
+# --- TRẠNG THÁI CỤC BỘ & HÀNG ĐỢI GHI (WRITE-BEHIND) ---
+# Mọi phiên Streamlit dùng chung một bản sao dữ liệu trong RAM. Thao tác ghi được áp dụng
+# ngay vào bản sao này, ghi nhật ký xuống đĩa, rồi luồng nền mới đẩy lên Google Sheets theo lô.
+
+
+def apply_op(records, op):
+    kind = op.get('op')
+    if kind == 'append':
+        records.append(dict(zip(op['header'], op['row'])))
+    elif kind == 'update':
+        key, kv = op['key'], str(op['key_value'])
+        for r in records:
+            if str(r.get(key, '')) == kv: r.update(op['values'])
+    elif kind == 'delete':
+        key, kv = op['key'], str(op['key_value'])
+        records[:] = [r for r in records if str(r.get(key, '')) != kv]
+    elif kind == 'replace':
+        records[:] = [dict(zip(op['header'], row)) for row in op['rows']]
+    elif kind == 'compact':
+        records[:] = [r for r in records if not r.get(op['flag'])]
+    return records
+
+
+def coalesce_ops(ops):
+    # Gộp các thao tác của một worksheet thành: thay toàn bộ / cập nhật ô / xóa dòng / thêm dòng
+    header = ops[0]['header']
+    plan = {'header': header, 'key': None, 'replace': None, 'updates': {}, 'deletes': [], 'appends': [], 'compact': None}
+
+    def pending_row(key, kv):
+        idx = header.index(key)
+        for rows in (plan['appends'], plan['replace'] or []):
+            for row in rows:
+                if idx < len(row) and str(row[idx]) == kv: return rows, row
+        return None, None
+
+    for op in ops:
+        kind = op['op']
+        if kind == 'replace':
+            plan.update(replace=[list(r) for r in op['rows']], updates={}, deletes=[], appends=[])
+        elif kind == 'append':
+            row = list(op['row'])
+            plan['appends'].append(row + [""] * (len(header) - len(row)))
+        elif kind == 'update':
+            plan['key'] = op['key']
+            kv = str(op['key_value'])
+            _, row = pending_row(op['key'], kv)
+            if row is not None:
+                for field, val in op['values'].items(): row[header.index(field)] = val
+            else:
+                plan['updates'].setdefault(kv, {}).update(op['values'])
+        elif kind == 'delete':
+            plan['key'] = op['key']
+            kv = str(op['key_value'])
+            rows, row = pending_row(op['key'], kv)
+            if row is not None: rows.remove(row)
+            else:
+                plan['updates'].pop(kv, None)
+                if kv not in plan['deletes']: plan['deletes'].append(kv)
+        elif kind == 'compact':
+            # Dòng đánh dấu xóa được xóa thật lúc đẩy lên, theo cột cờ đọc từ Sheets
+            plan.update(key=op['key'], compact=op['flag'])
+            idx = header.index(op['flag'])
+            for rows in (plan['appends'], plan['replace'] or []):
+                rows[:] = [r for r in rows if not (idx < len(r) and r[idx] not in ("", None))]
+    return plan
+
+
+Snapshot = namedtuple('Snapshot', 'version loaded_at tables versions')
+
+
+class DiskSnapshot:
+    # Bản lưu dữ liệu gốc từ Sheets (chưa áp thao tác chờ ghi) trong SQLite để khởi động nhanh
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tables (sheet TEXT PRIMARY KEY, loaded_at REAL, records TEXT, revision TEXT)")
+            # Bản lưu tạo trước khi có cột revision
+            if 'revision' not in [c[1] for c in db.execute("PRAGMA table_info(tables)")]:
+                db.execute("ALTER TABLE tables ADD COLUMN revision TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self):
+        try:
+            with self._connect() as db:
+                rows = db.execute("SELECT sheet, loaded_at, records, revision FROM tables").fetchall()
+        except sqlite3.Error: return {}
+        out = {}
+        for sheet, loaded_at, payload, revision in rows:
+            try: out[sheet] = (loaded_at, json.loads(payload), revision)
+            except ValueError: continue
+        return out
+
+    def save(self, sheet, loaded_at, payload, revision=None):
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO tables (sheet, loaded_at, records, revision) VALUES (?, ?, ?, ?)",
+                           (sheet, loaded_at, payload, revision))
+        except sqlite3.Error: pass
+
+
+class LocalStore:
+    def __init__(self, loader, ttl=30, batch_loader=None, disk=None, probe=None, probe_interval=10, max_age=600):
+        self.loader = loader
+        self.batch_loader = batch_loader
+        self.ttl = ttl
+        self.disk = disk
+        # probe() trả về dấu phiên bản của cả file (vd. modifiedTime trên Drive); bảng hết hạn chỉ
+        # được tải lại khi dấu này đổi, tối đa max_age giây thì vẫn tải lại để phòng Drive cập nhật trễ
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.max_age = max_age
+        self._marker = (None, 0)
+        self.probes = 0
+        self.skipped_reloads = 0
+        self.pending_ops = lambda sheet: []
+        self.lock = threading.RLock()
+        self._tables = {}
+        self._dirty = {}
+        self._flush_gen = {}
+        self._refreshing = set()
+        self.errors = {}
+        # Tăng mỗi khi dữ liệu trong RAM thay đổi (nạp lại hoặc ghi cục bộ), chung và theo từng sheet
+        self.version = 0
+        self._versions = {}
+        if disk:
+            # Dữ liệu trên đĩa giữ nguyên thời điểm tải nên sẽ được làm mới ngầm ở lần đọc đầu
+            for sheet, (loaded_at, records, revision) in disk.load().items():
+                self._tables[sheet] = {'records': records, 'loaded_at': loaded_at, 'fetched_at': loaded_at, 'revision': revision, 'source': 'disk'}
+                self._bump(sheet)
+
+    def _bump(self, sheet):
+        self.version += 1
+        self._versions[sheet] = self.version
+
+    def version_of(self, sheet):
+        # Dùng làm khóa cache cho dữ liệu dựng từ một sheet (sổ quỹ, chỉ mục...)
+        with self.lock: return self._versions.get(sheet, 0)
+
+    def _fresh(self, sheet):
+        t = self._tables.get(sheet)
+        return bool(t) and (bool(self._dirty.get(sheet)) or time.time() - t['loaded_at'] < self.ttl)
+
+    def _encode(self, records):
+        # Chụp dữ liệu gốc trước khi áp thao tác chờ ghi; làm ngoài khóa vì có thể tốn thời gian
+        return json.dumps(records, ensure_ascii=False, default=str) if self.disk else None
+
+    def _revision(self):
+        # Dấu phiên bản được dùng lại trong probe_interval giây; None nếu không kiểm tra được
+        if not self.probe: return None
+        value, checked_at = self._marker
+        if value is not None and time.time() - checked_at < self.probe_interval: return value
+        try: value = self.probe()
+        except Exception: value = None
+        self.probes += 1
+        self._marker = (value, time.time())
+        return value
+
+    def _install(self, sheet, records, gen, payload=None, revision=None):
+        # Gọi khi đang giữ khóa. Trả về False nếu có lượt đẩy lên Sheets xen giữa lúc tải
+        if self._fresh(sheet): return True
+        if self._flush_gen.get(sheet, 0) != gen: return False
+        for op in self.pending_ops(sheet): apply_op(records, op)
+        loaded_at = time.time()
+        self._tables[sheet] = {'records': records, 'loaded_at': loaded_at, 'fetched_at': loaded_at, 'revision': revision, 'source': 'sheets'}
+        self._bump(sheet)
+        if payload is not None: self.disk.save(sheet, loaded_at, payload, revision)
+        return True
+
+    def get(self, sheet):
+        with self.lock:
+            t = self._tables.get(sheet)
+            if t:
+                # Hết hạn thì vẫn trả dữ liệu cũ ngay và làm mới ở luồng nền
+                if not self._fresh(sheet): self._revalidate([sheet])
+                return t['records']
+        return self._load(sheet)
+
+    def _load(self, sheet, revision=None):
+        for _ in range(3):
+            gen = self._flush_gen.get(sheet, 0)
+            # Lấy dấu phiên bản trước khi tải: sửa đổi xen giữa sẽ làm lần kiểm tra sau thấy dấu mới
+            revision = revision or self._revision()
+            try:
+                records = self.loader(sheet)
+                self.errors.pop(sheet, None)
+            except Exception as e:
+                records = None
+                self.errors[sheet] = str(e)
+            payload = self._encode(records) if records is not None else None
+            with self.lock:
+                t = self._tables.get(sheet)
+                if records is None:
+                    # Lỗi mạng: giữ dữ liệu cũ nếu có
+                    return t['records'] if t else []
+                if self._install(sheet, records, gen, payload, revision): return self._tables[sheet]['records']
+        return self._tables.get(sheet, {}).get('records', [])
+
+    def _load_batch(self, sheets, revision=None):
+        with self.lock:
+            gens = {s: self._flush_gen.get(s, 0) for s in sheets}
+        revision = revision or self._revision()
+        try: tables = self.batch_loader(sheets)
+        except Exception as e:
+            for s in sheets: self.errors[s] = str(e)
+            return
+        if tables is None: return
+        payloads = {s: self._encode(tables.get(s, [])) for s in sheets}
+        with self.lock:
+            for s in sheets:
+                self.errors.pop(s, None)
+                # Sheet bị đẩy dữ liệu xen giữa sẽ được get() nạp lại riêng
+                self._install(s, tables.get(s, []), gens[s], payloads[s], revision)
+
+    def _revalidate(self, sheets):
+        # Gọi khi đang giữ khóa; mỗi sheet chỉ có một lượt làm mới chạy cùng lúc
+        todo = [s for s in sheets if s not in self._refreshing]
+        if not todo: return
+        self._refreshing.update(todo)
+        threading.Thread(target=self._refresh, args=(todo,), name="sheets-refresh", daemon=True).start()
+
+    def _unchanged(self, sheets, revision):
+        # Bảng có cùng dấu phiên bản được gia hạn thay vì tải lại toàn bộ
+        now = time.time()
+        with self.lock:
+            same = [s for s in sheets if s in self._tables and self._tables[s].get('revision') == revision
+                    and now - self._tables[s].get('fetched_at', 0) < self.max_age]
+            for s in same: self._tables[s]['loaded_at'] = now
+            self.skipped_reloads += len(same)
+        return same
+
+    def _refresh(self, sheets):
+        try:
+            revision = self._revision()
+            todo = [s for s in sheets if s not in self._unchanged(sheets, revision)] if revision is not None else sheets
+            if not todo: return
+            if self.batch_loader: self._load_batch(todo, revision)
+            else:
+                for s in todo: self._load(s, revision)
+        finally:
+            with self.lock: self._refreshing.difference_update(sheets)
+
+    def prefetch(self, sheets):
+        # Nạp mọi sheet còn thiếu trong một lần values_batch_get thay vì worksheet + get_all_records từng sheet;
+        # sheet đã có nhưng hết hạn được làm mới ngầm
+        with self.lock:
+            missing = [s for s in sheets if s not in self._tables]
+            self._revalidate([s for s in sheets if s in self._tables and not self._fresh(s)])
+        if missing and self.batch_loader: self._load_batch(missing)
+
+    def age(self, sheets=None):
+        # Số giây kể từ lần tải cũ nhất trong các sheet và nguồn dữ liệu ('sheets' / 'disk')
+        with self.lock:
+            tables = [self._tables[s] for s in (sheets or list(self._tables)) if s in self._tables]
+            if not tables: return None, None
+            oldest = min(tables, key=lambda t: t['loaded_at'])
+            return time.time() - oldest['loaded_at'], oldest['source']
+
+    def snapshot(self, sheets):
+        # Bộ dữ liệu nhiều bảng cùng một phiên bản; các bảng được sao chép nông nên đọc thoải mái.
+        # versions: phiên bản từng bảng lúc chụp, dùng làm khóa cache cho dữ liệu dựng từ snapshot
+        self.prefetch(sheets)
+        for s in sheets: self.get(s)
+        with self.lock:
+            tables = {s: [dict(r) for r in self._tables.get(s, {}).get('records', [])] for s in sheets}
+            return Snapshot(self.version, time.time(), tables, {s: self._versions.get(s, 0) for s in sheets})
+
+    def apply(self, op):
+        with self.lock:
+            self._dirty[op['sheet']] = self._dirty.get(op['sheet'], 0) + 1
+            t = self._tables.get(op['sheet'])
+            if t: apply_op(t['records'], op)
+            self._bump(op['sheet'])
+
+    def mark_flushed(self, sheet, count):
+        with self.lock:
+            self._dirty[sheet] = max(0, self._dirty.get(sheet, 0) - count)
+            self._flush_gen[sheet] = self._flush_gen.get(sheet, 0) + 1
+
+    def invalidate(self, sheet=None):
+        with self.lock:
+            for name in ([sheet] if sheet else list(self._tables)):
+                if not self._dirty.get(name): self._tables.pop(name, None)
+
+
+def _cell(value):
+    # Giá trị ghi nguyên văn như append_rows (RAW): chuỗi giữ số 0 đầu, số vẫn là số
+    if value is None or value == "": return {}
+    if isinstance(value, bool): return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, numbers.Number):
+        if value != value: return {}
+        return {'userEnteredValue': {'numberValue': float(value)}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+def _row_data(values):
+    return {'values': [_cell(v) for v in values]}
+
+
+def _column_letter(col):
+    return ''.join(ch for ch in rowcol_to_a1(1, col) if ch.isalpha())
+
+
+def _txn(op):
+    return op.get('txn') or op['seq']
+
+
+def _permanent(err):
+    # Lỗi do chính thao tác (400/403/404, tiêu đề thiếu cột...): gửi lại y nguyên cũng không qua được.
+    # Lỗi mạng, 429, 5xx thì chỉ cần chờ rồi thử lại
+    code = _status_of(err)
+    if code is not None: return code in (400, 403, 404)
+    return isinstance(err, (ValueError, KeyError, IndexError, TypeError))
+
+
+class WriteQueue:
+    KEEP_KEYS = 5000
+    # Giao dịch bị Sheets từ chối chừng này lần liền (khi gửi riêng) thì chuyển ra danh sách lỗi
+    MAX_ATTEMPTS = 3
+    # Sheet ẩn giữ mã lô vừa ghi, được cập nhật trong cùng batch_update với dữ liệu. Mỗi nhật ký
+    # (app, cli.py, máy khác) có một dòng riêng [khóa nhật ký, mã lô] để không đọc nhầm mã lô của nhau
+    MARKER_SHEET = "_sync"
+
+    def __init__(self, get_client, sheet_url, store, layouts, journal_path, debounce=0.5, derive=None):
+        self.get_client = get_client
+        self.sheet_url = sheet_url
+        self.store = store
+        self.layouts = layouts
+        self.journal_path = journal_path
+        self.keys_path = journal_path + ".keys"
+        self.dead_path = journal_path + ".dead"
+        self.marker_key = f"{socket.gethostname()}:{os.path.abspath(journal_path)}"
+        self._marker_row = None
+        self.debounce = debounce
+        self.last_error = None
+        self.last_flush = None
+        # derive: {sheet: hàm tính lại trường phụ thuộc} dùng khi gộp lại patch lúc đẩy lên Sheets
+        self.derive = derive or {}
+        self.conflicts = deque(maxlen=50)
+        # Thao tác bị từ chối hẳn: bỏ khỏi hàng đợi để không chặn các lần ghi sau, lưu lại trong file .dead
+        self.dead = deque(maxlen=100)
+        self._attempts = {}
+        self._isolate = False
+        # (mã lô, các seq) của lô đã gửi mà chưa biết Google đã nhận hay chưa
+        self._sent = None
+        self._hide_marker = False
+        # Dùng chung khóa với LocalStore để tránh khóa chéo khi nạp lại dữ liệu
+        self._cond = threading.Condition(store.lock)
+        self._pending = []
+        self._seq = 0
+        self._keys = OrderedDict()
+        self._keys_written = 0
+        self._sh = None
+        self._ws = {}
+        self._header_checked = set()
+        store.pending_ops = self.pending_for
+        self._replay_journal()
+        self._thread = threading.Thread(target=self._run, name="sheets-write-queue", daemon=True)
+        self._thread.start()
+
+    # --- API CHO GIAO DIỆN ---
+    def submit(self, op):
+        return self.submit_many([op])
+
+    def submit_many(self, ops, key=None):
+        # Các thao tác được ghi nhật ký, áp dụng cục bộ và đẩy lên Sheets cùng nhau (một batch_update).
+        # key là khóa chống trùng: gửi lại cùng key (bấm đúp, thử lại) trả về False và không ghi gì.
+        with self._cond:
+            if key and key in self._keys: return False
+            now, txn = time.time(), key or f"txn-{self._seq + 1}"
+            stamped = []
+            for op in ops:
+                self._seq += 1
+                op = dict(op, seq=self._seq, ts=now)
+                if len(ops) > 1 or key: op.update(txn=txn, txn_size=len(ops))
+                stamped.append(op)
+            self._journal_append(stamped, key)
+            for op in stamped: self.store.apply(op)
+            self._pending.extend(stamped)
+            if key: self._remember(key)
+            self._cond.notify()
+        return True
+
+    def transact(self, build, key=None):
+        # build() đọc bản ghi hiện tại và trả về danh sách thao tác (hoặc một giá trị "sai" để hủy).
+        # Chạy trong khóa nên không phiên nào chen vào giữa lúc đọc và lúc ghi (compare-and-swap).
+        with self._cond:
+            if key and key in self._keys: return None
+            ops = build()
+            if not isinstance(ops, list): return ops
+            return self.submit_many(ops, key) or None
+
+    def seen(self, key):
+        with self._cond: return key in self._keys
+
+    def pending_for(self, sheet):
+        with self._cond:
+            return [op for op in self._pending if op['sheet'] == sheet]
+
+    def status(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'error': self.last_error, 'last_flush': self.last_flush,
+                    'conflicts': list(self.conflicts), 'dead': list(self.dead)}
+
+    def flush(self, timeout=30):
+        end = time.time() + timeout
+        with self._cond:
+            self._cond.notify()
+        while time.time() < end:
+            if not self.status()['pending']: return True
+            time.sleep(0.05)
+        return False
+
+    # --- NHẬT KÝ TRÊN ĐĨA ---
+    def _remember(self, key):
+        self._keys[key] = True
+        while len(self._keys) > self.KEEP_KEYS: self._keys.popitem(last=False)
+
+    def _replay_journal(self):
+        if os.path.exists(self.dead_path):
+            with open(self.dead_path, encoding='utf-8') as f:
+                for line in f:
+                    try: self.dead.append(json.loads(line))
+                    except ValueError: continue
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip(): self._remember(line.strip())
+                    self._keys_written += 1
+        if not os.path.exists(self.journal_path): return
+        ops = []
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except ValueError: continue
+                # Dòng đánh dấu lô đã gửi: tắt máy ngay sau batch_update thì lúc chạy lại phải kiểm tra trước khi gửi lại
+                if 'batch' in entry: self._sent = (entry['batch'], set(entry['seqs']))
+                else: ops.append(entry)
+        # Giao dịch bị ghi dở (mất điện giữa chừng) thì bỏ cả nhóm
+        sizes = {}
+        for op in ops:
+            if op.get('txn'): sizes[op['txn']] = sizes.get(op['txn'], 0) + 1
+        for op in ops:
+            if op.get('txn') and sizes[op['txn']] < op.get('txn_size', 1):
+                self._keys.pop(op['txn'], None)
+                continue
+            self._pending.append(op)
+            self._seq = max(self._seq, op.get('seq', 0))
+            if op.get('txn'): self._remember(op['txn'])
+            self.store.apply(op)
+
+    def _journal_append(self, ops, key=None):
+        os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(op, ensure_ascii=False, default=str) + "\n" for op in ops))
+            f.flush()
+            os.fsync(f.fileno())
+        if key:
+            with open(self.keys_path, 'a', encoding='utf-8') as f:
+                f.write(key + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._keys_written += 1
+
+    def _journal_batch(self, batch_id, seqs):
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'batch': batch_id, 'seqs': sorted(seqs)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self):
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for op in self._pending: f.write(json.dumps(op, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+        if self._keys_written > 2 * self.KEEP_KEYS:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write("".join(k + "\n" for k in self._keys))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.keys_path)
+            self._keys_written = len(self._keys)
+
+    # --- LUỒNG NỀN ---
+    def _run(self):
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._pending: self._cond.wait()
+            time.sleep(self.debounce)
+            if self._flush(): failures = 0
+            else:
+                failures += 1
+                time.sleep(min(60, 2 ** failures))
+
+    def _worksheet(self, sheet):
+        if self._sh is None:
+            client = self.get_client()
+            if not client: raise RuntimeError("Không có kết nối Google Sheets")
+            self._sh = client.open_by_url(self.sheet_url)
+        if sheet not in self._ws:
+            header, rows, cols = self.layouts.get(sheet, (None, 1, 1))
+            try: ws = self._sh.worksheet(sheet)
+            except gspread.WorksheetNotFound:
+                ws = self._sh.add_worksheet(sheet, rows, cols)
+                if header:
+                    ws.append_row(header)
+                    self._header_checked.add(sheet)
+                else: self._hide_marker = True
+            self._ws[sheet] = ws
+        return self._ws[sheet]
+
+    def _flush(self):
+        if self._sent:
+            applied = self._recover()
+            if applied is None: return False
+            if applied: return True
+        with self._cond:
+            batch = list(self._pending)
+            # Đang dò thao tác lỗi: chỉ gửi giao dịch cũ nhất
+            if self._isolate and batch: batch = [op for op in batch if _txn(op) == _txn(batch[0])]
+        if not batch: return True
+        by_sheet = {}
+        for op in batch: by_sheet.setdefault(op['sheet'], []).append(op)
+        batch_id = uuid.uuid4().hex
+        try:
+            self._journal_batch(batch_id, [op['seq'] for op in batch])
+            self._sent = (batch_id, {op['seq'] for op in batch})
+            dropped = self._flush_all(by_sheet, batch_id)
+        except Exception as e:
+            self.last_error = str(e)
+            self._sh, self._ws = None, {}
+            # Sheets đã từ chối thì chắc chắn chưa ghi gì; lỗi mạng/5xx thì lần sau đọc dấu lô rồi mới gửi lại
+            if _permanent(e):
+                self._sent = None
+                self._reject(batch, e)
+            return False
+        self._acknowledge(batch, dropped)
+        return True
+
+    def _recover(self):
+        # Trả về True nếu lô gửi trước đã nằm trên Sheets, False nếu chưa, None nếu chưa đọc được
+        batch_id, seqs = self._sent
+        try:
+            self._worksheet(self.MARKER_SHEET)
+            resp = self._sh.values_batch_get(["'%s'!A:B" % self.MARKER_SHEET])
+            rows = (resp.get('valueRanges') or [{}])[0].get('values') or []
+        except Exception as e:
+            self.last_error = str(e)
+            self._sh, self._ws = None, {}
+            return None
+        self._sent = None
+        self._marker_row = self._find_marker(rows)
+        if self._marker_row is None or rows[self._marker_row][1:2] != [batch_id]: return False
+        with self._cond: batch = [op for op in self._pending if op['seq'] in seqs]
+        # Không biết patch nào đã bị bỏ vì xung đột: tải lại các sheet của lô
+        self._acknowledge(batch, {op['sheet'] for op in batch})
+        return True
+
+    def _find_marker(self, rows):
+        for i, row in enumerate(rows):
+            if row and str(row[0]) == self.marker_key: return i
+        return None
+
+    def _acknowledge(self, batch, dropped):
+        by_sheet = {}
+        for op in batch: by_sheet[op['sheet']] = by_sheet.get(op['sheet'], 0) + 1
+        with self._cond:
+            done = {op['seq'] for op in batch}
+            self._pending = [op for op in self._pending if op['seq'] not in done]
+            self._sent = None
+            self._isolate = False
+            for txn in {_txn(op) for op in batch}: self._attempts.pop(txn, None)
+            self._rewrite_journal()
+            self.last_error = None
+            self.last_flush = time.time()
+        for sheet, count in by_sheet.items(): self.store.mark_flushed(sheet, count)
+        # Thao tác bị bỏ vì xung đột vẫn nằm trong bản cục bộ: tải lại bản thật từ Sheets
+        for sheet in dropped: self.store.invalidate(sheet)
+
+    def _reject(self, batch, err):
+        head = _txn(batch[0])
+        if any(_txn(op) != head for op in batch):
+            # Chưa biết thao tác nào hỏng: lần sau gửi riêng từng giao dịch, cũ nhất trước
+            self._isolate = True
+            return
+        n = self._attempts[head] = self._attempts.get(head, 0) + 1
+        if n < self.MAX_ATTEMPTS: return
+        entry = {'txn': head, 'error': str(err), 'ts': time.time(),
+                 'ops': [{k: op.get(k) for k in ('sheet', 'op', 'key_value', 'values', 'row')} for op in batch]}
+        with self._cond:
+            seqs = {op['seq'] for op in batch}
+            self._pending = [op for op in self._pending if op['seq'] not in seqs]
+            self._attempts.pop(head, None)
+            self._isolate = False
+            self._rewrite_journal()
+            with open(self.dead_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            self.dead.append(entry)
+        sheets = {}
+        for op in batch: sheets[op['sheet']] = sheets.get(op['sheet'], 0) + 1
+        # Bản cục bộ vẫn chứa thao tác bị từ chối: cho sheet hết "bẩn" rồi tải lại từ Sheets
+        for sheet, count in sheets.items():
+            self.store.mark_flushed(sheet, count)
+            self.store.invalidate(sheet)
+
+    def _flush_all(self, by_sheet, batch_id):
+        # Mọi sheet được đẩy trong một spreadsheets.batchUpdate: Google áp dụng cả lô hoặc không gì cả,
+        # nên phiếu thu và cập nhật đơn hàng không thể chỉ ghi được một nửa. Mã lô được ghi vào sheet
+        # đánh dấu trong cùng lô để biết chắc lô đã được nhận khi lệnh bị hết giờ
+        plans = {sheet: coalesce_ops(ops) for sheet, ops in by_sheet.items()}
+        sheets = {sheet: self._worksheet(sheet) for sheet in plans}
+        marker = self._worksheet(self.MARKER_SHEET)
+
+        # Một lần đọc: cột khóa (và cột version) của sheet cần sửa/xóa, dòng tiêu đề của sheet chưa kiểm tra
+        ranges, wanted = [], []
+        for sheet, plan in plans.items():
+            title = "'%s'" % sheet.replace("'", "''")
+            # Thay toàn bộ: tiêu đề, sửa/xóa theo dòng đã được gộp vào các dòng mới
+            if plan['replace'] is not None: continue
+            if plan['updates'] or plan['deletes'] or plan['compact']:
+                col = _column_letter(plan['header'].index(plan['key']) + 1)
+                ranges.append(f"{title}!{col}:{col}")
+                wanted.append((sheet, 'keys'))
+                if plan['compact']:
+                    col = _column_letter(plan['header'].index(plan['compact']) + 1)
+                    ranges.append(f"{title}!{col}:{col}")
+                    wanted.append((sheet, 'flags'))
+                if VERSION_FIELD in plan['header'] and any(op.get('patch') for op in by_sheet[sheet]):
+                    col = _column_letter(plan['header'].index(VERSION_FIELD) + 1)
+                    ranges.append(f"{title}!{col}:{col}")
+                    wanted.append((sheet, 'versions'))
+            if sheet not in self._header_checked:
+                ranges.append(f"{title}!1:1")
+                wanted.append((sheet, 'header'))
+        if self._marker_row is None:
+            ranges.append("'%s'!A:B" % self.MARKER_SHEET)
+            wanted.append((self.MARKER_SHEET, 'marker'))
+        read = self._batch_read(ranges, wanted)
+        if (self.MARKER_SHEET, 'marker') in read: self._marker_row = self._find_marker(read[(self.MARKER_SHEET, 'marker')])
+        plans, dropped = self._rebase(by_sheet, plans, read)
+
+        requests = []
+        for sheet, plan in plans.items():
+            header, sheet_id = plan['header'], sheets[sheet].id
+            if plan['replace'] is not None:
+                # Xóa giá trị cả sheet rồi thêm lại từ dòng 1, cùng một lô nên không bao giờ để sheet trống
+                rows = [header] + plan['replace'] + plan['appends']
+                requests.append({'updateCells': {'range': {'sheetId': sheet_id}, 'fields': 'userEnteredValue'}})
+                requests.append({'appendCells': {'sheetId': sheet_id, 'rows': [_row_data(r) for r in rows], 'fields': 'userEnteredValue'}})
+                continue
+            current = list((read.get((sheet, 'header')) or [[]])[0])
+            while current and current[-1] == "": current.pop()
+            if current and len(current) < len(header) and current == header[:len(current)]:
+                # Sheet cũ thiếu cột mới thêm trong bố cục (vd. version): bổ sung tiêu đề
+                requests.append({'updateCells': {
+                    'start': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': len(current)},
+                    'rows': [_row_data(header[len(current):])], 'fields': 'userEnteredValue'}})
+            if plan['updates'] or plan['deletes'] or plan['compact']:
+                keys = read.get((sheet, 'keys'), [])
+                for kv, values in plan['updates'].items():
+                    if kv not in keys: continue
+                    r = keys.index(kv)
+                    for field, val in values.items():
+                        requests.append({'updateCells': {
+                            'start': {'sheetId': sheet_id, 'rowIndex': r, 'columnIndex': header.index(field)},
+                            'rows': [_row_data([val])], 'fields': 'userEnteredValue'}})
+                doomed = {keys.index(kv) for kv in plan['deletes'] if kv in keys}
+                if plan['compact']:
+                    doomed.update(r for r, flag in enumerate(read.get((sheet, 'flags'), [])) if r and flag)
+                    doomed.update(keys.index(kv) for kv, values in plan['updates'].items() if values.get(plan['compact']) and kv in keys)
+                for r in sorted(doomed, reverse=True):
+                    requests.append({'deleteDimension': {'range': {'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': r, 'endIndex': r + 1}}})
+            if plan['appends']:
+                if (sheet, 'header') in read and not read[(sheet, 'header')]: plan['appends'].insert(0, header)
+                requests.append({'appendCells': {'sheetId': sheet_id, 'rows': [_row_data(r) for r in plan['appends']], 'fields': 'userEnteredValue'}})
+        stamp = [_row_data([self.marker_key, batch_id])]
+        if self._marker_row is None:
+            requests.append({'appendCells': {'sheetId': marker.id, 'rows': stamp, 'fields': 'userEnteredValue'}})
+        else:
+            requests.append({'updateCells': {'start': {'sheetId': marker.id, 'rowIndex': self._marker_row, 'columnIndex': 0},
+                                             'rows': stamp, 'fields': 'userEnteredValue'}})
+        if self._hide_marker:
+            requests.append({'updateSheetProperties': {'properties': {'sheetId': marker.id, 'hidden': True}, 'fields': 'hidden'}})
+        self._sh.batch_update({'requests': requests})
+        self._hide_marker = False
+        self._header_checked.update(s for s, what in wanted if what == 'header' and s in plans)
+        self._header_checked.update(s for s, plan in plans.items() if plan['replace'] is not None)
+        return dropped
+
+    def _batch_read(self, ranges, wanted):
+        read = {}
+        if ranges:
+            resp = self._sh.values_batch_get(ranges)
+            for w, vr in zip(wanted, resp.get('valueRanges', [])): read[w] = vr.get('values', [])
+        for w in list(read):
+            if w[1] in ('keys', 'versions', 'flags'): read[w] = [str(r[0]) if r else "" for r in read[w]]
+        return read
+
+    def _rebase(self, by_sheet, plans, read):
+        # Dòng có version trên Sheets khác version lúc tạo patch nghĩa là đã bị sửa từ nơi khác
+        # (tiến trình khác, sửa tay): đọc lại dòng đó rồi gộp lại các patch theo thứ tự.
+        # Trường không đụng nhau vẫn được ghi; patch xung đột bị bỏ cùng cả giao dịch của nó
+        # (vd. phiếu thu đi kèm) và được ghi vào self.conflicts.
+        stale = []
+        for sheet, plan in plans.items():
+            if (sheet, 'versions') not in read: continue
+            keys, versions = read[(sheet, 'keys')], read[(sheet, 'versions')]
+            expect = {}
+            for op in by_sheet[sheet]:
+                if op.get('patch') and op['op'] == 'update': expect.setdefault(op['key_value'], op.get('expect', 0))
+            for kv, exp in expect.items():
+                if kv not in plan['updates'] or kv not in keys: continue
+                r = keys.index(kv)
+                if row_version({VERSION_FIELD: versions[r] if r < len(versions) else ""}) != exp: stale.append((sheet, kv, r))
+        if not stale: return plans, set()
+        resp = self._sh.values_batch_get(["'%s'!%d:%d" % (sheet.replace("'", "''"), r + 1, r + 1) for sheet, _, r in stale])
+        current = {}
+        for (sheet, kv, _), vr in zip(stale, resp.get('valueRanges', [])):
+            header = plans[sheet]['header']
+            row = (vr.get('values') or [[]])[0]
+            current[(sheet, kv)] = dict(zip(header, list(row) + [""] * (len(header) - len(row))))
+
+        txn_of = lambda op: op.get('txn') or op['seq']
+        dropped = set()
+        while True:
+            merged, conflicted = {}, False
+            for (sheet, kv), rec in current.items():
+                rec, changed = dict(rec), {}
+                for op in by_sheet[sheet]:
+                    if op['op'] != 'update' or op['key_value'] != kv or txn_of(op) in dropped: continue
+                    values, fields = merge_patch(rec, op['patch'], self.derive.get(sheet)) if op.get('patch') else (op['values'], [])
+                    if fields:
+                        dropped.add(txn_of(op))
+                        self.conflicts.append({'sheet': sheet, 'key': kv, 'fields': fields, 'ts': time.time()})
+                        conflicted = True
+                        continue
+                    rec.update(values)
+                    changed.update(values)
+                merged[(sheet, kv)] = changed
+            # Bỏ một giao dịch có thể làm đổi dòng khác trong cùng giao dịch: gộp lại từ đầu
+            if not conflicted: break
+
+        touched = set()
+        if dropped:
+            for sheet, ops in by_sheet.items():
+                kept = [op for op in ops if txn_of(op) not in dropped]
+                if len(kept) < len(ops): touched.add(sheet)
+                if kept: plans[sheet] = coalesce_ops(kept)
+                else: plans.pop(sheet)
+        for (sheet, kv), changed in merged.items():
+            if sheet in plans and kv in plans[sheet]['updates']: plans[sheet]['updates'][kv] = changed
+        return plans, touched
+
+
+class Compactor:
+    # Xóa mềm chỉ ghi cờ vào dòng nên vị trí các dòng không đổi. Các dòng đã đánh dấu được
+    # xóa thật theo lịch vào giờ vắng, tất cả trong một batch_update của hàng đợi ghi.
+    def __init__(self, queue, specs, quiet_hours=(1, 5), interval=900, before=None):
+        # specs: {sheet: (cột khóa, cột cờ xóa)}; before(sheet): các thao tác ghi cùng giao dịch, trước khi xóa thật
+        self.queue = queue
+        self.specs = specs
+        self.before = before
+        self.quiet_hours = quiet_hours
+        self.interval = interval
+        self.last_run = None
+        self.removed = 0
+        self._thread = threading.Thread(target=self._run, name="sheets-compactor", daemon=True)
+        self._thread.start()
+
+    def tombstones(self, sheet):
+        flag = self.specs[sheet][1]
+        return sum(1 for r in self.queue.store.get(sheet) if r.get(flag))
+
+    def run_now(self, sheets=None):
+        count = 0
+        for sheet in sheets or self.specs:
+            n = self.tombstones(sheet)
+            if not n: continue
+            key, flag = self.specs[sheet]
+            ops = list(self.before(sheet)) if self.before else []
+            ops.append({"sheet": sheet, "op": "compact", "header": self.queue.layouts[sheet][0], "key": key, "flag": flag})
+            self.queue.submit_many(ops)
+            count += n
+        self.last_run = time.time()
+        self.removed += count
+        return count
+
+    def _due(self, now):
+        start, end = self.quiet_hours
+        hour = time.localtime(now).tm_hour
+        if not start <= hour < end: return False
+        return self.last_run is None or time.localtime(self.last_run)[:3] != time.localtime(now)[:3]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                # Chỉ dọn khi không còn thao tác chờ ghi để không chen vào lúc đang có người làm việc
+                if self._due(time.time()) and not self.queue.status()['pending']: self.run_now()
+            except Exception: pass
@@ -0,0 +1,151 @@
+import glob
+import io
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from ledger import CashLedger, cashbook_frame
+
+# --- XUẤT EXCEL ---
+# File chỉ được tạo khi người dùng yêu cầu. openpyxl ở chế độ write-only ghi từng dòng ra luồng
+# nên xuất vài trăm nghìn dòng vẫn không phải giữ cả workbook trong RAM.
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _num(value):
+    try: return float(value)
+    except (TypeError, ValueError): return 0.0
+
+
+def workbook_bytes(sheets):
+    # sheets: [(tên sheet, dòng tiêu đề, các dòng dữ liệu, độ rộng cột)]
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    bold = Font(bold=True)
+    for title, header, rows, widths in sheets:
+        ws = wb.create_sheet(title[:31])
+        for i, w in enumerate(widths or [], start=1): ws.column_dimensions[get_column_letter(i)].width = w
+        cells = []
+        for h in header:
+            c = WriteOnlyCell(ws, value=h)
+            c.font = bold
+            cells.append(c)
+        ws.append(cells)
+        for row in rows: ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def frame_sheet(title, df, width=18):
+    df = df.astype(object).where(pd.notna(df), None)
+    return title, list(df.columns), df.itertuples(index=False, name=None), [width] * len(df.columns)
+
+
+# --- LỊCH SỬ ĐƠN HÀNG ---
+def orders_sheets(orders):
+    def summary():
+        for o in orders:
+            cust, fin = o.get('customer') or {}, o.get('financial') or {}
+            yield [o.get('order_id'), o.get('date'), o.get('status'), o.get('payment_status'),
+                   cust.get('name'), str(cust.get('phone', '')), cust.get('address'), fin.get('staff'),
+                   _num(fin.get('total')), _num(fin.get('paid')), _num(fin.get('debt')),
+                   _num(fin.get('total_profit')), _num(fin.get('total_comm')), fin.get('commission_status')]
+
+    def items():
+        # Mỗi mặt hàng một dòng, kèm mã đơn và khách để lọc/pivot trong Excel
+        for o in orders:
+            cust = o.get('customer') or {}
+            for it in o.get('items') or []:
+                yield [o.get('order_id'), o.get('date'), o.get('status'), cust.get('name'),
+                       it.get('name'), it.get('unit'), _num(it.get('qty')), _num(it.get('price')),
+                       _num(it.get('vat_rate')), _num(it.get('total_line')), _num(it.get('cost')),
+                       _num(it.get('profit')), _num(it.get('commission'))]
+
+    return [
+        ("Đơn hàng", ["Mã đơn", "Ngày", "Trạng thái", "Thanh toán", "Khách hàng", "SĐT", "Địa chỉ", "Nhân viên",
+                      "Tổng tiền", "Đã trả", "Còn nợ", "Lợi nhuận", "Hoa hồng", "TT hoa hồng"],
+         summary(), [12, 11, 12, 12, 28, 13, 36, 10, 14, 14, 14, 14, 12, 12]),
+        ("Chi tiết hàng", ["Mã đơn", "Ngày", "Trạng thái", "Khách hàng", "Tên hàng", "ĐVT", "SL", "Đơn giá",
+                           "VAT (%)", "Thành tiền", "Giá vốn", "Lợi nhuận", "Hoa hồng"],
+         items(), [12, 11, 12, 28, 32, 8, 10, 12, 8, 14, 12, 14, 12]),
+    ]
+
+
+# --- SỔ QUỸ THEO KỲ ---
+def cashbook_sheets(records, start=None, end=None):
+    ledger = CashLedger(records)
+    rows, totals = ledger.period(start, end)
+    tm = [[str(d), c, thu, chi, bal, note] for d, c, thu, chi, bal, note
+          in rows[['Date', 'Content', 'Thu', 'Chi', 'Tồn', 'Note']].itertuples(index=False, name=None)]
+    tm.insert(0, ["", "Tồn đầu kỳ", None, None, totals['opening'], ""])
+    tm.append(["", "Tồn cuối kỳ", totals['thu'], totals['chi'], totals['closing'], ""])
+    undated = totals['undated']
+    if len(undated):
+        # Ngoài kỳ vì không đọc được ngày, nhưng vẫn nằm trong tồn quỹ hiện tại
+        tm.append(["", "Không rõ ngày", float(undated['Thu'].sum()), float(undated['Chi'].sum()), None,
+                   f"{len(undated)} dòng không đọc được ngày, không tính vào kỳ"])
+        tm.extend([str(d), c, thu, chi, None, note] for d, c, thu, chi, note
+                  in undated[['Date', 'Content', 'Thu', 'Chi', 'Note']].itertuples(index=False, name=None))
+
+    df = cashbook_frame(records)
+    mask = pd.Series(True, index=df.index)
+    if start is not None or end is not None: mask = df['Day'].notna()
+    if start is not None: mask &= df['Day'] >= pd.Timestamp(start)
+    if end is not None: mask &= df['Day'] <= pd.Timestamp(end)
+    every = df[mask].sort_values('Day', kind='mergesort')
+    allrows = ([str(d), c, amount, method, note] for d, c, amount, method, note
+               in every[['Date', 'Content', 'Amount', 'TM/CK', 'Note']].itertuples(index=False, name=None))
+    return [
+        ("Sổ quỹ TM", ["Ngày", "Loại", "Thu", "Chi", "Tồn quỹ", "Nội dung"], tm, [12, 12, 14, 14, 16, 48]),
+        ("Tất cả giao dịch", ["Ngày", "Loại", "Số tiền", "TM/CK", "Nội dung"], allrows, [12, 8, 14, 8, 48]),
+    ]
+
+
+# --- KHÁCH CÒN NỢ ---
+def debtors_sheets(orders):
+    debts = []
+    for o in orders:
+        fin = o.get('financial') or {}
+        debt = _num(fin.get('debt'))
+        if debt <= 0: continue
+        cust = o.get('customer') or {}
+        debts.append([cust.get('name', ''), str(cust.get('phone', '')), o.get('order_id'), o.get('date'),
+                      o.get('status'), _num(fin.get('total')), _num(fin.get('paid')), debt])
+    # Gộp theo SĐT (hoặc tên nếu không có SĐT)
+    by_cust = {}
+    for name, phone, oid, d, _, _, _, debt in debts:
+        c = by_cust.setdefault(phone or name, [name, phone, 0, 0.0, d])
+        c[2] += 1
+        c[3] += debt
+        if d and (not c[4] or str(d) < str(c[4])): c[4] = d
+    summary = sorted(by_cust.values(), key=lambda c: -c[3])
+    return [
+        ("Tổng hợp công nợ", ["Khách hàng", "SĐT", "Số đơn nợ", "Tổng nợ", "Đơn nợ cũ nhất"], summary, [30, 13, 10, 16, 14]),
+        ("Chi tiết đơn nợ", ["Khách hàng", "SĐT", "Mã đơn", "Ngày", "Trạng thái", "Tổng tiền", "Đã trả", "Còn nợ"],
+         sorted(debts, key=lambda r: (r[0], str(r[3]))), [30, 13, 12, 11, 12, 14, 14, 14]),
+    ]
+
+
+# --- KHÁCH THÊM ---
+def extra_sheets(records):
+    rows = ([r.get('id'), r.get('customer'), _num(r.get('pre_tax')), _num(r.get('actual')), _num(r.get('not_done')),
+             _num(r.get('vat_rate')), _num(r.get('pit_tax')), _num(r.get('refund')), r.get('status')] for r in records)
+    return [("Khách thêm", ["Mã số", "Khách hàng", "Tiền trước thuế", "Thực làm", "Không làm", "Thuế suất (%)",
+                            "Thuế TNCN", "Còn chuyển lại", "Trạng thái"], rows, [16, 28, 16, 14, 14, 12, 14, 16, 12])]
+
+
+def export_filename(prefix):
+    return f"{prefix}_{datetime.now().strftime('%Y%m%d')}.xlsx"
+
+
+def latest_report(folder, prefix):
+    # File dựng sẵn mới nhất (cli.py export), tên có ngày nên sắp theo tên là theo ngày
+    files = sorted(glob.glob(os.path.join(folder, f"{prefix}_*.xlsx")))
+    return files[-1] if files else None
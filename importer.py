@@ -0,0 +1,263 @@
+import os
+import re
+import unicodedata
+from datetime import date, datetime
+
+import pandas as pd
+
+from commission import item_commission, rates_for
+
+# --- NHẬP DỮ LIỆU HÀNG LOẠT ---
+# Đọc Excel/CSV (đơn hàng kèm mặt hàng, khách hàng, sổ quỹ), chuẩn hóa SĐT / số tiền / ngày và
+# dựng đúng cấu trúc dòng của Google Sheets. Nhận cả file do mục "Xuất Excel" tạo ra (sheet
+# "Đơn hàng" + "Chi tiết hàng") lẫn bảng mỗi mặt hàng một dòng có lặp lại thông tin đơn.
+# Trả về (dòng hợp lệ, lỗi); việc ghi lên Sheets theo từng lô nằm ở cli.py.
+
+ORDER_FIELDS = {
+    'order_id': ["ma don", "order_id", "ma don hang", "so don"],
+    'date': ["ngay", "date", "ngay tao"],
+    'status': ["trang thai", "status"],
+    'payment_status': ["thanh toan", "payment_status", "tt thanh toan"],
+    'name': ["khach hang", "ten khach", "customer", "ten khach hang"],
+    'phone': ["sdt", "so dien thoai", "dien thoai", "phone"],
+    'address': ["dia chi", "address"],
+    'staff': ["nhan vien", "staff", "nv"],
+    'total': ["tong tien", "total"],
+    'paid': ["da tra", "paid", "da thanh toan"],
+    'total_comm': ["hoa hong", "total_comm"],
+    'commission_status': ["tt hoa hong", "commission_status"],
+}
+ITEM_FIELDS = {
+    'order_id': ORDER_FIELDS['order_id'],
+    'item': ["ten hang", "item", "san pham", "ten hang / quy cach"],
+    'unit': ["dvt", "don vi", "unit"],
+    'qty': ["sl", "so luong", "qty"],
+    'price': ["don gia", "gia ban", "price"],
+    'vat_rate': ["vat (%)", "vat", "% vat", "vat_rate"],
+    'cost': ["gia von", "cost"],
+    'commission': ["hoa hong", "commission"],
+}
+CUSTOMER_FIELDS = {
+    'phone': ORDER_FIELDS['phone'],
+    'name': ORDER_FIELDS['name'] + ["ten", "name"],
+    'address': ORDER_FIELDS['address'],
+    'last_order': ["don gan nhat", "last_order", "ngay mua"],
+}
+CASH_FIELDS = {
+    'Date': ["ngay", "date"],
+    'Content': ["loai", "content", "thu/chi"],
+    'Amount': ["so tien", "amount"],
+    'TM/CK': ["tm/ck", "hinh thuc", "method"],
+    'Note': ["noi dung", "ghi chu", "note", "dien giai"],
+    'Thu': ["thu"],
+    'Chi': ["chi"],
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+def _plain(text):
+    text = unicodedata.normalize('NFKD', str(text)).replace('đ', 'd').replace('Đ', 'D')
+    return " ".join("".join(ch for ch in text if not unicodedata.combining(ch)).lower().split())
+
+
+def _blank(value):
+    return value is None or (isinstance(value, float) and value != value) or str(value).strip() == ""
+
+
+def read_tables(path):
+    # {tên sheet: [dict theo dòng]}; CSV coi như một sheet. Đọc mọi ô dạng object để không mất số 0 đầu của SĐT
+    if not os.path.exists(path): raise RowError(f"Không có file {path}")
+    if path.lower().endswith((".csv", ".txt")):
+        frames = {os.path.basename(path): pd.read_csv(path, dtype=str, keep_default_na=False, encoding='utf-8-sig')}
+    else: frames = pd.read_excel(path, sheet_name=None, dtype=object)
+    return {name: df.astype(object).where(pd.notna(df), None).to_dict('records') for name, df in frames.items()}
+
+
+def map_columns(columns, fields):
+    # Tên cột trong file -> tên trường, so sánh sau khi bỏ dấu; cột không nhận ra thì bỏ qua
+    lookup = {alias: field for field, aliases in fields.items() for alias in aliases}
+    out = {}
+    for col in columns:
+        field = lookup.get(_plain(col))
+        if field and field not in out.values(): out[col] = field
+    return out
+
+
+def _rows(records, fields):
+    if not records: return []
+    mapping = map_columns(records[0].keys(), fields)
+    return [{field: r.get(col) for col, field in mapping.items()} for r in records]
+
+
+# --- CHUẨN HÓA ---
+def phone(value):
+    if _blank(value): return ""
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    digits = re.sub(r"\D", "", str(value))
+    if digits.startswith("84") and len(digits) == 11: digits = "0" + digits[2:]
+    # Excel/Sheets đổi SĐT thành số nên mất số 0 đầu
+    if len(digits) == 9 and digits[0] != "0": digits = "0" + digits
+    return digits
+
+
+def money(value):
+    if _blank(value): return 0.0
+    if isinstance(value, (int, float)): return float(value)
+    text = str(value).strip().lower().replace("đ", "").replace("vnd", "").replace(" ", "")
+    # "1.200.000" và "1,200,000" đều là 1200000; chỉ một dấu với <= 2 chữ số sau là phần thập phân
+    if re.fullmatch(r"-?\d{1,3}([.,]\d{3})+", text): text = re.sub(r"[.,]", "", text)
+    else: text = text.replace(",", ".")
+    try: return float(text)
+    except ValueError: raise RowError(f"số tiền không hợp lệ: {value!r}")
+
+
+def day(value, default=None):
+    if _blank(value):
+        if default is not None: return default
+        raise RowError("thiếu ngày")
+    if isinstance(value, (datetime, date)): return value.strftime("%Y-%m-%d")
+    text = str(value).strip()[:10]
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d/%m/%y"):
+        try: return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError: continue
+    raise RowError(f"ngày không hợp lệ: {value!r}")
+
+
+def text(value):
+    return "" if _blank(value) else str(value).strip()
+
+
+def financial_shape(fin, total=None):
+    # Ô financial luôn đủ trường và là số: total, paid, debt = max(0, total - paid), lợi nhuận, hoa hồng
+    fin = dict(fin or {})
+    total = money(fin.get('total')) if total is None else total
+    paid = money(fin.get('paid'))
+    fin.update(total=total, paid=paid, debt=max(0.0, total - paid), staff=text(fin.get('staff')),
+               total_profit=money(fin.get('total_profit')), total_comm=money(fin.get('total_comm')),
+               commission_status=text(fin.get('commission_status')) or "Chưa chi")
+    return fin
+
+
+# --- ĐƠN HÀNG ---
+def _split_order_tables(tables):
+    # Sheet có cột tên hàng là bảng mặt hàng, sheet còn lại có mã đơn là bảng đơn
+    heads, items = [], []
+    for records in tables.values():
+        if not records: continue
+        if 'item' in map_columns(records[0].keys(), ITEM_FIELDS).values(): items.append(records)
+        elif 'order_id' in map_columns(records[0].keys(), ORDER_FIELDS).values(): heads.append(records)
+    return [r for t in heads for r in t], [r for t in items for r in t]
+
+
+def build_orders(tables, rules=None, today=None):
+    # rules: bảng quy tắc hoa hồng, dùng khi file không có cột hoa hồng từng mặt hàng
+    today = today or datetime.now().strftime("%Y-%m-%d")
+    heads, lines = _split_order_tables(tables)
+    orders, errors, order_of = {}, [], {}
+    if not heads and not lines: return [], [("", "không tìm thấy cột Mã đơn / Tên hàng")]
+
+    def head(row, where):
+        oid = text(row.get('order_id'))
+        if not oid: raise RowError("thiếu mã đơn")
+        if oid in orders: return orders[oid]
+        name = text(row.get('name'))
+        if not name: raise RowError("thiếu tên khách")
+        o = orders[oid] = {
+            'order_id': oid, 'date': day(row.get('date'), today), 'status': text(row.get('status')) or "Báo giá",
+            'payment_status': text(row.get('payment_status')) or "Chưa TT",
+            'customer': {'name': name, 'phone': phone(row.get('phone')), 'address': text(row.get('address'))},
+            'items': [],
+            'financial': {'total': money(row.get('total')) if not _blank(row.get('total')) else None, 'paid': money(row.get('paid')),
+                          'staff': text(row.get('staff')), 'total_comm': row.get('total_comm'), 'commission_status': text(row.get('commission_status'))},
+        }
+        order_of[oid] = where
+        return o
+
+    for i, row in enumerate(_rows(heads, ORDER_FIELDS), start=2):
+        try:
+            if text(row.get('order_id')) in orders: raise RowError(f"trùng mã đơn {row.get('order_id')}")
+            head(row, f"Đơn hàng dòng {i}")
+        except RowError as e: errors.append((f"Đơn hàng dòng {i}", str(e)))
+    bad = {text(r.get('order_id')) for r in _rows(heads, ORDER_FIELDS)} - set(orders)
+
+    for i, row in enumerate(_rows(lines, dict(ORDER_FIELDS, **ITEM_FIELDS)), start=2):
+        where = f"Mặt hàng dòng {i}"
+        try:
+            oid = text(row.get('order_id'))
+            if oid in bad: continue
+            o = orders.get(oid) or head(row, where)
+            qty, price, cost, vat = money(row.get('qty')) or 1.0, money(row.get('price')), money(row.get('cost')), money(row.get('vat_rate'))
+            if not text(row.get('item')): raise RowError("thiếu tên hàng")
+            if qty < 0 or price < 0 or cost < 0: raise RowError("số lượng / giá âm")
+            sell = qty * price
+            vat_amt = sell * vat / 100
+            profit = sell - qty * cost
+            comm = money(row.get('commission')) if not _blank(row.get('commission')) else None
+            o['items'].append({'name': text(row.get('item')), 'unit': text(row.get('unit')), 'qty': qty, 'cost': cost,
+                               'price': price, 'vat_rate': vat, 'vat_amt': vat_amt, 'profit': profit,
+                               'commission': comm, 'total_line': sell + vat_amt})
+        except RowError as e: errors.append((where, str(e)))
+
+    # Tỉ lệ hoa hồng của mọi đơn tra một lần theo vector
+    orders_list = list(orders.values())
+    rates = rates_for(rules, [o['financial']['staff'] for o in orders_list], [o['date'] for o in orders_list]) if rules is not None and orders_list else None
+    out = []
+    for n, o in enumerate(orders_list):
+        oid, fin, items = o['order_id'], o['financial'], o['items']
+        for it in items:
+            if it['commission'] is None: it['commission'] = item_commission(it['profit'], rates[n] if rates is not None else 0.0)
+        lines_total = sum(it['total_line'] for it in items)
+        total = fin['total'] if fin['total'] is not None else lines_total
+        if items and fin['total'] is not None and abs(total - lines_total) > 1:
+            errors.append((order_of[oid], f"{oid}: tổng tiền {total:,.0f} khác tổng mặt hàng {lines_total:,.0f}"))
+            continue
+        if fin['paid'] - total > 1:
+            errors.append((order_of[oid], f"{oid}: đã trả {fin['paid']:,.0f} lớn hơn tổng {total:,.0f}"))
+            continue
+        fin['total_profit'] = sum(it['profit'] for it in items)
+        if items or _blank(fin['total_comm']): fin['total_comm'] = sum(it['commission'] for it in items)
+        o['financial'] = financial_shape(fin, total)
+        out.append(o)
+    return out, errors
+
+
+# --- KHÁCH HÀNG / SỔ QUỸ ---
+def build_customers(tables, today=None):
+    today = today or datetime.now().strftime("%Y-%m-%d")
+    out, errors, seen = [], [], set()
+    for records in tables.values():
+        for i, row in enumerate(_rows(records, CUSTOMER_FIELDS), start=2):
+            try:
+                p, name = phone(row.get('phone')), text(row.get('name'))
+                if not p: raise RowError("thiếu SĐT")
+                if not name: raise RowError("thiếu tên khách")
+                if p in seen: raise RowError(f"trùng SĐT {p}")
+                seen.add(p)
+                out.append({'phone': p, 'name': name, 'address': text(row.get('address')), 'last_order': day(row.get('last_order'), today)})
+            except RowError as e: errors.append((f"dòng {i}", str(e)))
+    return out, errors
+
+
+def build_cashbook(tables):
+    # File sổ quỹ xuất ra có cả sheet Thu/Chi/Tồn quỹ lẫn sheet "Tất cả giao dịch": chỉ lấy sheet có cột Số tiền
+    tables = [t for t in tables.values() if t]
+    with_amount = [t for t in tables if 'Amount' in map_columns(t[0].keys(), CASH_FIELDS).values()]
+    out, errors = [], []
+    for records in with_amount or tables:
+        for i, row in enumerate(_rows(records, CASH_FIELDS), start=2):
+            try:
+                if _blank(row.get('Amount')) and (not _blank(row.get('Thu')) or not _blank(row.get('Chi'))):
+                    thu, chi = money(row.get('Thu')), money(row.get('Chi'))
+                    content, amount = ("Thu", thu) if thu else ("Chi", chi)
+                else: content, amount = text(row.get('Content')).capitalize(), money(row.get('Amount'))
+                # Dòng tồn đầu kỳ / cuối kỳ và dòng trống
+                if _blank(row.get('Date')) and (not amount or _plain(row.get('Content')).startswith("ton")): continue
+                if content not in ("Thu", "Chi"): raise RowError(f"loại phải là Thu/Chi: {content!r}")
+                if amount <= 0: raise RowError("số tiền phải lớn hơn 0")
+                method = text(row.get('TM/CK')).upper() or "TM"
+                out.append({'Date': day(row.get('Date')), 'Content': content, 'Amount': amount, 'TM/CK': method, 'Note': text(row.get('Note'))})
+            except RowError as e: errors.append((f"dòng {i}", str(e)))
+    return out, errors
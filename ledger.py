@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# --- SỔ QUỸ TIỀN MẶT ---
+# Dựng một lần cho mỗi phiên bản dữ liệu Cashbook: cột Thu/Chi/Tồn quỹ tính theo vector,
+# số dư cuối từng tháng được chốt sẵn nên số dư đầu kỳ của bất kỳ ngày nào chỉ cần tra bảng.
+
+CASH_COLS = ["Date", "Content", "Amount", "TM/CK", "Note"]
+LEGACY_COLS = {'date': 'Date', 'type': 'Content', 'amount': 'Amount', 'desc': 'Note'}
+
+
+def cashbook_frame(records):
+    df = pd.DataFrame(records)
+    if 'date' in df.columns: df = df.rename(columns=LEGACY_COLS)
+    for col in CASH_COLS:
+        if col not in df.columns: df[col] = ""
+    df = df[CASH_COLS].copy()
+    df['TM/CK'] = df['TM/CK'].replace("", "TM").fillna("TM").astype(str).str.strip().str.upper()
+    df['Content'] = df['Content'].astype(str).str.strip()
+    df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce').fillna(0.0).astype(float)
+    df['Day'] = pd.to_datetime(df['Date'].astype(str), errors='coerce', format='mixed').dt.normalize()
+    df['Thu'] = np.where(df['Content'] == 'Thu', df['Amount'], 0.0)
+    df['Chi'] = np.where(df['Content'] == 'Chi', df['Amount'], 0.0)
+    return df
+
+
+class CashLedger:
+    def __init__(self, records, method="TM"):
+        df = cashbook_frame(records)
+        df = df[df['TM/CK'] == method]
+        # Sắp theo ngày, giữ nguyên thứ tự ghi sổ trong cùng một ngày; dòng không đọc được ngày nằm cuối
+        df = df.sort_values('Day', kind='mergesort', na_position='last').reset_index(drop=True)
+        df['Tồn'] = (df['Thu'] - df['Chi']).cumsum()
+        self.entries = df
+        self.total_thu = float(df['Thu'].sum())
+        self.total_chi = float(df['Chi'].sum())
+        self.balance = self.total_thu - self.total_chi
+
+        dated = df[df['Day'].notna()]
+        months = dated.groupby(dated['Day'].dt.to_period('M'))[['Thu', 'Chi']].sum()
+        months['Cuối kỳ'] = (months['Thu'] - months['Chi']).cumsum()
+        months['Đầu kỳ'] = months['Cuối kỳ'] - months['Thu'] + months['Chi']
+        self.monthly = months[['Đầu kỳ', 'Thu', 'Chi', 'Cuối kỳ']]
+        self._days = dated['Day'].to_numpy()
+        self._balance_after = dated['Tồn'].to_numpy()
+
+    def opening_balance(self, day):
+        # Số dư ngay trước ngày `day`: vị trí tìm nhị phân trong cột ngày đã sắp xếp
+        pos = np.searchsorted(self._days, np.datetime64(pd.Timestamp(day).normalize()), side='left')
+        return float(self._balance_after[pos - 1]) if pos else 0.0
+
+    def closing_balance(self, month):
+        month = pd.Period(month, 'M')
+        if month in self.monthly.index: return float(self.monthly.at[month, 'Cuối kỳ'])
+        before = self.monthly.index[self.monthly.index < month]
+        return float(self.monthly.at[before[-1], 'Cuối kỳ']) if len(before) else 0.0
+
+    def period(self, start=None, end=None):
+        # Các dòng trong khoảng ngày [start, end] kèm số dư đầu kỳ / cuối kỳ. Không giới hạn ngày thì lấy
+        # cả dòng không đọc được ngày (khớp với self.balance); có giới hạn thì các dòng đó được trả riêng
+        # trong 'undated' để giao diện / file xuất báo cho người dùng
+        df = self.entries
+        undated = df['Day'].isna()
+        mask = pd.Series(True, index=df.index)
+        if start is not None or end is not None: mask = ~undated
+        if start is not None: mask &= df['Day'] >= pd.Timestamp(start).normalize()
+        if end is not None: mask &= df['Day'] <= pd.Timestamp(end).normalize()
+        rows = df[mask]
+        opening = self.opening_balance(start) if start is not None else 0.0
+        thu, chi = float(rows['Thu'].sum()), float(rows['Chi'].sum())
+        return rows, {'opening': opening, 'thu': thu, 'chi': chi, 'closing': opening + thu - chi,
+                      'undated': df[undated & ~mask]}
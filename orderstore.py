@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+# --- BẢNG CỘT ĐƠN HÀNG CHO BÁO CÁO ---
+# Dựng một lần cho mỗi phiên bản Orders và dùng chung (chỉ đọc) cho mọi phiên: tiền là mảng float64,
+# ngày là datetime64, trạng thái / nhân viên / khách / tên hàng là mã số nguyên kèm bảng nhãn.
+# Các tab Dashboard gọi thẳng hàm tổng hợp (bincount trên mã) thay vì dựng DataFrame dict lồng nhau
+# ở mỗi lần chạy, nên thêm một phiên gần như không tốn thêm bộ nhớ.
+
+MONEY = ['total', 'paid', 'debt', 'profit', 'comm', 'cogs']
+PAID_COMM = "Đã chi"
+
+
+def _num(value):
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+
+def _codes(values):
+    codes, labels = pd.factorize(pd.Series(values, dtype=object).fillna(""), sort=True)
+    return codes.astype(np.int32), np.asarray(labels, dtype=object)
+
+
+def _frozen(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+class OrderColumns:
+    def __init__(self, orders):
+        n = len(orders)
+        self.n = n
+        money = {k: np.zeros(n) for k in MONEY}
+        ids, days, status, staff, cust, comm_status = [], [], [], [], [], []
+        item_owner, item_name, item_revenue = [], [], []
+        for i, o in enumerate(orders):
+            fin, c = o.get('financial') or {}, o.get('customer') or {}
+            ids.append(str(o.get('order_id', '')))
+            days.append(o.get('date'))
+            status.append(o.get('status') or "")
+            staff.append(fin.get('staff', 'Unknown'))
+            cust.append(c.get('name', 'Unknown'))
+            comm_status.append(fin.get('commission_status', 'Chưa chi'))
+            money['total'][i] = _num(fin.get('total'))
+            money['paid'][i] = _num(fin.get('paid'))
+            money['debt'][i] = _num(fin.get('debt'))
+            money['profit'][i] = _num(fin.get('total_profit'))
+            money['comm'][i] = _num(fin.get('total_comm'))
+            cogs = 0.0
+            for it in o.get('items') or []:
+                cogs += _num(it.get('qty')) * _num(it.get('cost'))
+                item_owner.append(i)
+                item_name.append(it.get('name'))
+                item_revenue.append(_num(it.get('total_line')))
+            money['cogs'][i] = cogs
+
+        self.order_id = _frozen(np.asarray(ids, dtype=object))
+        self.date = _frozen(pd.to_datetime(pd.Series(days, dtype=object).astype(str), errors='coerce', format='mixed')
+                            .dt.normalize().to_numpy(dtype='datetime64[ns]'))
+        for k, arr in money.items(): setattr(self, k, _frozen(arr))
+        for name, values in (('status', status), ('staff', staff), ('customer', cust), ('comm_status', comm_status)):
+            codes, labels = _codes(values)
+            setattr(self, name, _frozen(codes))
+            setattr(self, name + '_labels', labels)
+        self.item_order = _frozen(np.asarray(item_owner, dtype=np.int32))
+        codes, labels = _codes(item_name)
+        self.item_name, self.item_name_labels = _frozen(codes), labels
+        self.item_revenue = _frozen(np.asarray(item_revenue, dtype=float))
+
+    def __len__(self):
+        return self.n
+
+    # --- LỌC ---
+    def code_of(self, field, label):
+        labels = getattr(self, field + '_labels')
+        hit = np.flatnonzero(labels == label)
+        return int(hit[0]) if len(hit) else -1
+
+    def mask(self, status=None, comm_paid=None):
+        m = np.ones(self.n, dtype=bool)
+        if status is not None: m &= self.status == self.code_of('status', status)
+        if comm_paid is not None:
+            paid = self.comm_status == self.code_of('comm_status', PAID_COMM)
+            m &= paid if comm_paid else ~paid
+        return m
+
+    def count(self, status=None):
+        return int(self.mask(status).sum())
+
+    def sum(self, field, mask=None):
+        values = getattr(self, field)
+        return float(values[mask].sum() if mask is not None else values.sum())
+
+    # --- TỔNG HỢP ---
+    def group_sum(self, by, field, mask=None):
+        # Tổng theo mã nhóm; trả về Series nhãn -> tổng, bỏ các nhóm không có đơn
+        codes, labels = getattr(self, by), getattr(self, by + '_labels')
+        values = getattr(self, field)
+        if mask is not None: codes, values = codes[mask], values[mask]
+        sums = np.bincount(codes, weights=values, minlength=len(labels))
+        present = np.bincount(codes, minlength=len(labels)) > 0
+        return pd.Series(sums[present], index=labels[present])
+
+    def status_counts(self):
+        counts = np.bincount(self.status, minlength=len(self.status_labels))
+        df = pd.DataFrame({'Status': self.status_labels, 'Count': counts})
+        return df[df['Count'] > 0].sort_values('Count', ascending=False, kind='mergesort').reset_index(drop=True)
+
+    def revenue_by_staff(self):
+        s = self.group_sum('staff', 'total').sort_values(ascending=False, kind='mergesort')
+        return pd.DataFrame({'staff': s.index, 'total_revenue': s.to_numpy()})
+
+    def top_customers(self, n=10):
+        s = self.group_sum('customer', 'total').sort_values(ascending=False, kind='mergesort').head(n)
+        return pd.DataFrame({'cust_name': s.index, 'total_revenue': s.to_numpy()})
+
+    def top_products(self, n=10):
+        if not len(self.item_name): return pd.DataFrame(columns=['Product', 'Revenue'])
+        sums = np.bincount(self.item_name, weights=self.item_revenue, minlength=len(self.item_name_labels))
+        top = np.argsort(-sums, kind='stable')[:n]
+        return pd.DataFrame({'Product': self.item_name_labels[top], 'Revenue': sums[top]})
+
+    def commission_by_staff(self):
+        paid = self.mask(comm_paid=True)
+        df = pd.DataFrame({'Chưa chi': self.group_sum('staff', 'comm', ~paid), 'Đã chi': self.group_sum('staff', 'comm', paid)}).fillna(0.0)
+        df['Tổng hoa hồng'] = df['Chưa chi'] + df['Đã chi']
+        return df.rename_axis('staff').reset_index()
+
+    def pending_commissions(self, status="Hoàn thành"):
+        # Đơn đã hoàn thành mà chưa chi hoa hồng
+        idx = np.flatnonzero(self.mask(status=status, comm_paid=False))
+        return pd.DataFrame({'order_id': self.order_id[idx], 'cust_name': self.customer_labels[self.customer[idx]],
+                             'total_comm': self.comm[idx], 'staff': self.staff_labels[self.staff[idx]]})
+
+    def nbytes(self):
+        arrays = [v for v in vars(self).values() if isinstance(v, np.ndarray)]
+        return sum(a.nbytes for a in arrays)
@@ -0,0 +1,122 @@
+import csv
+import functools
+import io
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# --- ĐO HIỆU NĂNG TỪNG LẦN CHẠY LẠI (RERUN) ---
+# Mỗi rerun của Streamlit được ghi thành một bản ghi gồm thời gian từng thao tác (span)
+# và số lượt gọi API Google Sheets theo hàm đã gọi. Các bản ghi nằm trong bộ đệm vòng.
+
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class PerfRecorder:
+    def __init__(self, maxlen=200):
+        self.reruns = deque(maxlen=maxlen)
+        self.background = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def current(self):
+        return getattr(self._local, 'rerun', None)
+
+    def begin_rerun(self, **tags):
+        self._local.rerun = {'ts': time.time(), 'start': time.perf_counter(), 'tags': tags, 'ops': {}, 'api': {}, 'api_calls': 0}
+        self._local.stack = []
+
+    def tag(self, **tags):
+        rerun = self.current()
+        if rerun: rerun['tags'].update(tags)
+
+    def end_rerun(self):
+        rerun = self.current()
+        if not rerun: return None
+        self._local.rerun = None
+        rerun['total_ms'] = (time.perf_counter() - rerun.pop('start')) * 1000
+        with self._lock: self.reruns.append(rerun)
+        return rerun
+
+    @contextmanager
+    def span(self, name):
+        rerun = self.current()
+        if rerun is None:
+            yield
+            return
+        self._local.stack.append(name)
+        start = time.perf_counter()
+        try: yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            self._local.stack.pop()
+            op = rerun['ops'].setdefault(name, {'count': 0, 'ms': 0.0})
+            op['count'] += 1
+            op['ms'] += ms
+
+    def timed(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.span(fn.__name__): return fn(*args, **kwargs)
+        return wrapper
+
+    def record_api_call(self, method, kind, elapsed):
+        # Gán lượt gọi API cho hàm (span) trong cùng nhất đang chạy
+        rerun = self.current()
+        ms = elapsed * 1000
+        if rerun is None:
+            with self._lock:
+                b = self.background.setdefault(method, {'count': 0, 'ms': 0.0})
+                b['count'] += 1
+                b['ms'] += ms
+            return
+        owner = self._local.stack[-1] if self._local.stack else '(rerun)'
+        api = rerun['api'].setdefault(owner, {'count': 0, 'ms': 0.0, 'methods': {}})
+        api['count'] += 1
+        api['ms'] += ms
+        api['methods'][method] = api['methods'].get(method, 0) + 1
+        rerun['api_calls'] += 1
+
+    # --- TỔNG HỢP & XUẤT ---
+    def snapshot(self, last=None):
+        with self._lock: data = list(self.reruns)
+        return data[-last:] if last else data
+
+    def summary(self, last=None):
+        data = self.snapshot(last)
+        per_op = {}
+        for r in data:
+            per_op.setdefault('(rerun)', []).append(r['total_ms'])
+            for name, op in r['ops'].items(): per_op.setdefault(name, []).append(op['ms'])
+        rows = [{'op': name, 'n': len(v), 'p50_ms': percentile(v, 50), 'p95_ms': percentile(v, 95), 'max_ms': max(v)} for name, v in per_op.items()]
+        calls = [r['api_calls'] for r in data]
+        return {
+            'reruns': len(data), 'ops': sorted(rows, key=lambda x: -x['p95_ms']),
+            'api_calls_avg': sum(calls) / len(calls) if calls else 0.0, 'api_calls_p95': percentile(calls, 95),
+        }
+
+    def export_json(self):
+        return json.dumps({'reruns': self.snapshot(), 'background_api': self.background}, ensure_ascii=False, indent=1)
+
+    def export_csv(self):
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(['rerun', 'ts', 'tags', 'total_ms', 'kind', 'name', 'count', 'ms'])
+        for i, r in enumerate(self.snapshot()):
+            base = [i, r['ts'], json.dumps(r['tags'], ensure_ascii=False), round(r['total_ms'], 2)]
+            for name, op in r['ops'].items(): w.writerow(base + ['op', name, op['count'], round(op['ms'], 2)])
+            for name, api in r['api'].items(): w.writerow(base + ['api', name, api['count'], round(api['ms'], 2)])
+        return buf.getvalue()
+
+
+RECORDER = PerfRecorder()
+span = RECORDER.span
+timed = RECORDER.timed
@@ -0,0 +1,131 @@
+import threading
+from datetime import date, datetime
+
+# --- CÔNG NỢ PHẢI THU ---
+# Chỉ mục theo khách hàng của các đơn còn nợ: dựng một lần từ Orders rồi cập nhật từng đơn mỗi khi
+# đơn được ghi (thu tiền, sửa, xóa...). Tra số dư, phân tuổi nợ, bảng kê của một khách không
+# phải quét lại toàn bộ đơn hàng.
+
+BUCKETS = [(0, 30, "0–30 ngày"), (31, 60, "31–60 ngày"), (61, 90, "61–90 ngày"), (91, None, "Trên 90 ngày")]
+MIN_DEBT = 1.0
+
+
+def _num(value):
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+
+def _day(value):
+    text = str(value or "").strip()[:10]
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try: return datetime.strptime(text, fmt).date()
+        except ValueError: continue
+    return None
+
+
+def bucket_of(days):
+    for lo, hi, label in BUCKETS:
+        if hi is None or days <= hi: return label
+    return BUCKETS[-1][2]
+
+
+class ReceivablesIndex:
+    def __init__(self, normalize):
+        self._normalize = normalize
+        self.lock = threading.Lock()
+        self.source = None
+        self._orders = {}
+        self._customers = {}
+
+    def customer_key(self, cust):
+        # SĐT (bỏ số 0 đầu vì Sheets đổi sang số) hoặc tên không dấu nếu không có SĐT
+        phone = "".join(ch for ch in str(cust.get('phone', '')) if ch.isdigit()).lstrip('0')
+        return phone or self._normalize(cust.get('name', '')).lower().strip()
+
+    def _entry(self, order):
+        if order.get('deleted'): return None
+        fin = order.get('financial') or {}
+        total, paid = _num(fin.get('total')), _num(fin.get('paid'))
+        debt = _num(fin['debt']) if 'debt' in fin else max(0.0, total - paid)
+        if debt < MIN_DEBT: return None
+        cust = order.get('customer') or {}
+        return {'order_id': str(order.get('order_id')), 'customer': self.customer_key(cust), 'name': cust.get('name', ''),
+                'phone': str(cust.get('phone', '')), 'address': cust.get('address', ''), 'date': order.get('date', ''),
+                'day': _day(order.get('date')), 'status': order.get('status', ''), 'total': total, 'paid': paid, 'debt': debt}
+
+    def _drop(self, order_id):
+        old = self._orders.pop(order_id, None)
+        if not old: return
+        c = self._customers[old['customer']]
+        c['orders'].discard(order_id)
+        c['balance'] -= old['debt']
+        if not c['orders']: del self._customers[old['customer']]
+
+    def _put(self, order):
+        oid = str(order.get('order_id'))
+        self._drop(oid)
+        e = self._entry(order)
+        if not e: return
+        self._orders[oid] = e
+        c = self._customers.setdefault(e['customer'], {'key': e['customer'], 'orders': set(), 'balance': 0.0})
+        c['orders'].add(oid)
+        c['balance'] += e['debt']
+        # Tên/SĐT/địa chỉ lấy theo đơn mới nhất
+        if not c.get('day') or (e['day'] and e['day'] >= c['day']):
+            c.update(name=e['name'], phone=e['phone'], address=e['address'], day=e['day'])
+
+    def ensure(self, source, load_orders):
+        with self.lock:
+            if self.source is source: return False
+            self._orders, self._customers = {}, {}
+            for o in load_orders(): self._put(o)
+            self.source = source
+            return True
+
+    def upsert(self, orders):
+        with self.lock:
+            for o in orders: self._put(o)
+
+    def remove(self, order_id):
+        with self.lock: self._drop(str(order_id))
+
+    def total(self):
+        with self.lock: return sum(c['balance'] for c in self._customers.values())
+
+    def aging(self, today=None):
+        # Mỗi khách một dòng: số dư theo từng khoảng tuổi nợ (tính từ ngày đơn)
+        today = today or date.today()
+        rows = []
+        with self.lock:
+            for c in self._customers.values():
+                row = {'key': c['key'], 'name': c['name'], 'phone': c['phone'], 'orders': len(c['orders']), 'balance': c['balance'], 'oldest': None}
+                for _, _, label in BUCKETS: row[label] = 0.0
+                for oid in c['orders']:
+                    e = self._orders[oid]
+                    days = (today - e['day']).days if e['day'] else 0
+                    row[bucket_of(max(days, 0))] += e['debt']
+                    if e['day'] and (row['oldest'] is None or e['day'] < row['oldest']): row['oldest'] = e['day']
+                rows.append(row)
+        return sorted(rows, key=lambda r: -r['balance'])
+
+    def find(self, query, limit=20):
+        q = self._normalize(query).lower().strip()
+        digits = "".join(ch for ch in q if ch.isdigit()).lstrip('0')
+        with self.lock:
+            hits = [c for c in self._customers.values()
+                    if (digits and digits in c['key']) or (q and q in self._normalize(c['name']).lower())]
+        return [c['key'] for c in sorted(hits, key=lambda c: -c['balance'])[:limit]]
+
+    def statement(self, key, today=None):
+        today = today or date.today()
+        with self.lock:
+            c = self._customers.get(key)
+            if not c: return None
+            orders = sorted((dict(self._orders[oid]) for oid in c['orders']), key=lambda e: (e['day'] or date.max, e['order_id']))
+            info = {k: c[k] for k in ('key', 'name', 'phone', 'address', 'balance')}
+        buckets = {label: 0.0 for _, _, label in BUCKETS}
+        for e in orders:
+            e['days'] = max((today - e['day']).days, 0) if e['day'] else 0
+            e['bucket'] = bucket_of(e['days'])
+            buckets[e['bucket']] += e['debt']
+        return dict(info, orders=orders, buckets=buckets, today=today)
@@ -0,0 +1,131 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from ledger import cashbook_frame
+
+# --- ĐỐI SOÁT ĐƠN HÀNG / THU TIỀN / SỔ QUỸ ---
+# Số đã trả / công nợ trong ô financial, cột payment_status và các phiếu "Thu tiền đơn ..." trong
+# sổ quỹ được ghi ở nhiều chỗ khác nhau và có thể lệch nhau khi một lần ghi hỏng giữa chừng.
+# Dựng một lần cho mỗi cặp phiên bản Orders/Cashbook: mọi phép so đều tính theo vector trên cả bảng,
+# đủ nhanh để chạy sau mỗi lần đồng bộ. Trùng mã đơn và phiếu thu thừa chỉ báo, không tự sửa.
+
+RECEIPT_NOTE = "Thu tiền đơn "
+TOLERANCE = 1.0
+# Còn nợ dưới mức này coi như đã trả đủ (giống màn hình thu tiền)
+PAID_IN_FULL = 10.0
+
+ISSUES = {
+    'duplicate': "Trùng mã đơn",
+    'debt': "Công nợ khác tổng - đã trả",
+    'status': "TT thanh toán không khớp số đã trả",
+    'unrecorded': "Đã trả nhưng thiếu phiếu thu trong sổ quỹ",
+    'overrecorded': "Sổ quỹ thu nhiều hơn số đã trả",
+    'orphan': "Phiếu thu cho mã đơn không tồn tại",
+}
+# Loại sửa tự động -> loại lỗi được sửa
+FIXES = {'debt': 'debt', 'status': 'status', 'cashbook': 'unrecorded'}
+FIX_LABELS = {'debt': "Tính lại công nợ", 'status': "Cập nhật TT thanh toán", 'cashbook': "Ghi phiếu thu bù vào sổ quỹ"}
+DESCRIBE = {
+    'duplicate': lambda r: f"{r.order_id} ({r.rows} dòng)",
+    'debt': lambda r: f"{r.order_id}: nợ {r.debt:,.0f}, tổng {r.total:,.0f}, đã trả {r.paid:,.0f}",
+    'status': lambda r: f"{r.order_id}: {r.payment_status or '(trống)'} -> {r.expected_status}",
+    'unrecorded': lambda r: f"{r.order_id}: đã trả {r.paid:,.0f}, sổ quỹ {r.receipts:,.0f}, thiếu {r.missing:,.0f}",
+    'overrecorded': lambda r: f"{r.order_id}: đã trả {r.paid:,.0f}, sổ quỹ {r.receipts:,.0f}, thừa {r.excess:,.0f}",
+    'orphan': lambda r: f"{r.order_id}: {r.receipt_count:.0f} phiếu, {r.receipts:,.0f}",
+}
+
+
+def _financial(values):
+    rows = []
+    for v in values:
+        if isinstance(v, str):
+            try: v = json.loads(v) if v else {}
+            except ValueError: v = {}
+        rows.append(v if isinstance(v, dict) else {})
+    fin = pd.DataFrame.from_records(rows, columns=['total', 'paid', 'debt'])
+    return fin.apply(pd.to_numeric, errors='coerce').fillna(0.0).astype(float)
+
+
+def order_frame(records):
+    df = pd.DataFrame(records)
+    for col in ('order_id', 'payment_status', 'financial', 'deleted', 'version'):
+        if col not in df.columns: df[col] = ""
+    out = pd.DataFrame({
+        'order_id': df['order_id'].fillna("").astype(str).str.strip(),
+        'payment_status': df['payment_status'].fillna("").astype(str).str.strip(),
+        'version': pd.to_numeric(df['version'], errors='coerce').fillna(0).astype(int),
+        'live': ~df['deleted'].fillna("").astype(bool),
+    })
+    fin = _financial(df['financial'].tolist())
+    fin.index = out.index
+    return out.join(fin)
+
+
+def receipt_frame(records):
+    # Tổng tiền và số phiếu "Thu tiền đơn <mã>" theo mã đơn
+    cash = cashbook_frame(records)
+    ids = cash['Note'].fillna("").astype(str).str.extract(r'^\s*Thu tiền đơn\s+(\S.*?)\s*$', expand=False)
+    hit = (cash['Content'] == 'Thu') & ids.notna()
+    thu = pd.DataFrame({'order_id': ids[hit], 'amount': cash.loc[hit, 'Amount']})
+    return thu.groupby('order_id')['amount'].agg(receipts='sum', receipt_count='count')
+
+
+class Reconciliation:
+    def __init__(self, orders, cashbook):
+        df = order_frame(orders)
+        rec = receipt_frame(cashbook)
+        counts = df.loc[df['order_id'] != "", 'order_id'].value_counts()
+        dup = counts[counts > 1]
+        self.missing_ids = int((df['order_id'] == "").sum())
+        known = set(df['order_id'])
+
+        # Đơn trùng mã không so được với sổ quỹ (không biết phiếu thu thuộc dòng nào)
+        df = df[df['live'] & (df['order_id'] != "") & ~df['order_id'].isin(dup.index)].copy()
+        df = df.join(rec, on='order_id')
+        df[['receipts', 'receipt_count']] = df[['receipts', 'receipt_count']].fillna(0)
+        df['expected_debt'] = np.maximum(0.0, df['total'] - df['paid'])
+        df['expected_status'] = np.select([df['paid'] <= 0, df['expected_debt'] <= PAID_IN_FULL], ["Chưa TT", "Đã TT"], "Cọc/Còn nợ")
+        gap = df['paid'] - df['receipts']
+        self.orders = len(df)
+        self.receipts = int(rec['receipt_count'].sum())
+        self.frame = df
+
+        orphan = rec[~rec.index.isin(known)]
+        self.issues = {
+            'duplicate': dup.rename_axis('order_id').reset_index(name='rows'),
+            'debt': df.loc[(df['debt'] - df['expected_debt']).abs() > TOLERANCE, ['order_id', 'total', 'paid', 'debt', 'expected_debt']],
+            'status': df.loc[df['payment_status'] != df['expected_status'], ['order_id', 'paid', 'expected_debt', 'payment_status', 'expected_status']],
+            'unrecorded': df.loc[gap > TOLERANCE, ['order_id', 'paid', 'receipts']].assign(missing=gap[gap > TOLERANCE]),
+            'overrecorded': df.loc[gap < -TOLERANCE, ['order_id', 'paid', 'receipts']].assign(excess=-gap[gap < -TOLERANCE]),
+            'orphan': orphan.rename_axis('order_id').reset_index(),
+        }
+        self.issues = {k: v.reset_index(drop=True) for k, v in self.issues.items()}
+
+    def summary(self):
+        return {ISSUES[k]: len(v) for k, v in self.issues.items()}
+
+    def problems(self):
+        # {loại lỗi: [mô tả từng đơn]} theo cùng dạng với cli.py check
+        out = {}
+        if self.missing_ids: out["Đơn không có mã"] = [f"{self.missing_ids} dòng"]
+        for kind, df in self.issues.items():
+            if df.empty: continue
+            out[ISSUES[kind]] = [DESCRIBE[kind](r) for r in df.itertuples(index=False)]
+        return out
+
+    def fixes(self, kinds):
+        # Một dòng cho mỗi đơn cần sửa: TT thanh toán mới (rỗng nếu giữ nguyên), công nợ đúng, số tiền phiếu thu bù
+        kinds = [k for k in kinds if k in FIXES]
+        df = self.frame
+        wanted = pd.Series(False, index=df.index)
+        for k in kinds: wanted |= df['order_id'].isin(self.issues[FIXES[k]]['order_id'])
+        df = df[wanted]
+        gap = df['paid'] - df['receipts']
+        new_status = df['expected_status'].where(df['payment_status'] != df['expected_status'], "")
+        return pd.DataFrame({
+            'order_id': df['order_id'], 'version': df['version'], 'paid': df['paid'], 'payment_status': df['payment_status'],
+            'new_status': new_status if 'status' in kinds else "",
+            'debt': df['expected_debt'], 'cash': gap.where(gap > TOLERANCE, 0.0) if 'cashbook' in kinds else 0.0,
+        }).reset_index(drop=True)
@@ -0,0 +1,96 @@
+import json
+
+# --- KHÓA LẠC QUAN THEO DÒNG (OPTIMISTIC CONCURRENCY) ---
+# Mỗi dòng có cột version tăng dần. Thao tác sửa được mô tả bằng "patch" theo từng trường,
+# kể cả trường con trong ô JSON (vd. "financial.paid"):
+#   set:  giá trị mới          inc: cộng thêm (vd. số tiền đã trả)
+#   base: giá trị người dùng đã thấy khi bắt đầu sửa      base_version: version lúc đó
+# Nếu dòng đã bị người khác sửa (version khác), các trường không đụng nhau được gộp lại;
+# chỉ khi cùng một trường bị đổi sang giá trị khác thì mới báo xung đột.
+
+VERSION_FIELD = "version"
+
+
+class Conflict:
+    # Kết quả "sai" kèm danh sách trường bị xung đột để giao diện báo cho người dùng
+    def __init__(self, fields):
+        self.fields = list(fields)
+
+    def __bool__(self):
+        return False
+
+    def __str__(self):
+        return ", ".join(self.fields)
+
+
+def make_patch(set_=None, inc=None, base=None, base_version=None):
+    return {'set': dict(set_ or {}), 'inc': dict(inc or {}), 'base': dict(base or {}), 'base_version': base_version}
+
+
+def row_version(record):
+    try: return int(float(record.get(VERSION_FIELD) or 0))
+    except (TypeError, ValueError): return 0
+
+
+def _loads(value):
+    try: return json.loads(value) if value else None
+    except (TypeError, ValueError): return value
+
+
+def _as_dict(value):
+    if isinstance(value, dict): return dict(value)
+    value = _loads(value)
+    return value if isinstance(value, dict) else {}
+
+
+def read_path(record, path):
+    top, _, sub = path.partition('.')
+    return _as_dict(record.get(top)).get(sub) if sub else record.get(top)
+
+
+def _same(a, b):
+    # Ô JSON đọc từ Sheets là chuỗi, giá trị mới là dict/list: so sánh sau khi giải mã
+    if isinstance(a, str) and isinstance(b, (dict, list)): a = _loads(a)
+    if isinstance(b, str) and isinstance(a, (dict, list)): b = _loads(b)
+    if a == b: return True
+    try: return abs(float(a) - float(b)) < 1e-6
+    except (TypeError, ValueError): return str(a if a is not None else "") == str(b if b is not None else "")
+
+
+def merge_patch(record, patch, derive=None):
+    # Trả về (giá trị cần ghi, []) hoặc (None, các trường xung đột)
+    stale = patch.get('base_version') is not None and patch['base_version'] != row_version(record)
+    base = patch.get('base', {})
+    top, objs, conflicts = {}, {}, []
+
+    def write(path, value):
+        field, _, sub = path.partition('.')
+        if sub:
+            if field not in objs: objs[field] = _as_dict(record.get(field))
+            objs[field][sub] = value
+        else: top[field] = value
+
+    for path, new in patch.get('set', {}).items():
+        cur = read_path(record, path)
+        if stale and path in base and not _same(cur, base[path]) and not _same(cur, new):
+            conflicts.append(path)
+            continue
+        write(path, new)
+    for path, delta in patch.get('inc', {}).items():
+        cur = read_path(record, path)
+        # Cộng dồn luôn gộp được, trừ khi người gọi yêu cầu giá trị gốc phải còn nguyên (vd. thu tiền theo công nợ đã thấy)
+        if stale and path in base and not _same(cur, base[path]):
+            conflicts.append(path)
+            continue
+        try: cur = float(cur or 0)
+        except (TypeError, ValueError): cur = 0.0
+        write(path, cur + float(delta))
+    if conflicts: return None, conflicts
+
+    # Trường JSON ghi đè cả ô trong top sẽ thắng các trường con cùng ô
+    for field, obj in objs.items():
+        if field not in top: top[field] = obj
+    if derive: derive(top)
+    values = {k: (json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v) for k, v in top.items()}
+    values[VERSION_FIELD] = row_version(record) + 1
+    return values, []
@@ -0,0 +1,276 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+import requests
+from gspread.utils import numericise_all
+
+# --- CLIENT GOOGLE SHEETS CÓ KIỂM SOÁT HẠN MỨC ---
+# Google Sheets giới hạn khoảng 60 lượt đọc và 60 lượt ghi mỗi phút cho mỗi tài khoản.
+# Lớp bọc này giới hạn tốc độ phía client (token bucket), tự thử lại khi gặp 429/5xx (lệnh ghi: chỉ 429)
+# và gộp các lượt đọc giống hệt nhau đang chạy song song giữa các phiên.
+
+READ_METHODS = {
+    "get_all_records", "get_all_values", "get_values", "get", "batch_get", "col_values", "row_values",
+    "cell", "acell", "find", "findall", "range", "values_get", "values_batch_get", "fetch_sheet_metadata",
+    "worksheet", "worksheets", "get_worksheet", "get_worksheet_by_id", "get_lastUpdateTime",
+}
+WRITE_METHODS = {
+    "update", "update_cell", "update_cells", "update_acell", "batch_update", "append_row", "append_rows",
+    "insert_row", "insert_rows", "delete_rows", "clear", "batch_clear", "add_worksheet", "del_worksheet",
+    "values_update", "values_batch_update", "values_append", "values_clear", "values_batch_clear", "resize",
+}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Lệnh ghi hết giờ / lỗi 5xx có thể đã được Google áp dụng: gửi lại một appendCells sẽ nhân đôi dòng.
+# Chỉ 429 chắc chắn là chưa ghi; lỗi khác trả về cho hàng đợi ghi tự kiểm tra rồi mới gửi lại
+WRITE_RETRY_STATUS = {429}
+# Handle worksheet trong cache trỏ tới sheet đã bị xóa / tạo lại ngoài app: Google trả 400 hoặc 404
+STALE_STATUS = {400, 404}
+
+
+class TokenBucket:
+    def __init__(self, per_minute=60, burst=10):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Trả về số giây đã phải chờ
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def _status_of(err):
+    if isinstance(err, gspread.exceptions.APIError):
+        code = getattr(err, 'code', None)
+        if code is None and getattr(err, 'response', None) is not None: code = err.response.status_code
+        return code
+    if isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)): return 503
+    return None
+
+
+def _clone(result):
+    # Bản sao nông theo dòng để các phiên dùng chung kết quả không sửa đè lên nhau
+    if isinstance(result, list):
+        return [dict(x) if isinstance(x, dict) else (list(x) if isinstance(x, list) else x) for x in result]
+    return result
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class QuotaAwareClient:
+    def __init__(self, client, read_per_minute=60, write_per_minute=60, burst=10, max_retries=5, max_backoff=32.0):
+        self.client = client
+        self.read_bucket = TokenBucket(read_per_minute, burst)
+        self.write_bucket = TokenBucket(write_per_minute, burst)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.on_call = None
+        self._inflight = {}
+        self._spreadsheets = {}
+        self._lock = threading.Lock()
+        self._metrics = {
+            'reads': 0, 'writes': 0, 'throttled': 0, 'throttle_wait_s': 0.0,
+            'retries': 0, 'backoff_wait_s': 0.0, 'errors': 0, 'deduped_reads': 0, 'by_method': {},
+        }
+
+    def metrics(self):
+        with self._lock:
+            m = dict(self._metrics)
+            m['by_method'] = dict(self._metrics['by_method'])
+            return m
+
+    def _count(self, **kw):
+        with self._lock:
+            for k, v in kw.items(): self._metrics[k] += v
+
+    def open_by_url(self, url):
+        with self._lock:
+            sh = self._spreadsheets.get(url)
+        if sh is None:
+            sh = _SpreadsheetProxy(self.call(self.client.open_by_url, "open_by_url", (url,), {}, "read", ("open_by_url", url)), self)
+            with self._lock: self._spreadsheets[url] = sh
+        return sh
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def call(self, fn, name, args, kwargs, kind, dedup_key=None):
+        if kind != 'read' or dedup_key is None: return self._call(fn, name, args, kwargs, kind)
+        with self._lock:
+            flight = self._inflight.get(dedup_key)
+            leader = flight is None
+            if leader: flight = self._inflight[dedup_key] = _InFlight()
+            else: flight.waiters += 1
+        if not leader:
+            self._count(deduped_reads=1)
+            flight.done.wait()
+            if flight.error: raise flight.error
+            return _clone(flight.result)
+        try: flight.result = self._call(fn, name, args, kwargs, kind)
+        except Exception as e: flight.error = e
+        with self._lock:
+            self._inflight.pop(dedup_key, None)
+            shared = flight.waiters > 0
+        flight.done.set()
+        if flight.error: raise flight.error
+        return _clone(flight.result) if shared else flight.result
+
+    def _call(self, fn, name, args, kwargs, kind):
+        bucket = self.read_bucket if kind == 'read' else self.write_bucket
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            if waited: self._count(throttled=1, throttle_wait_s=waited)
+            with self._lock:
+                self._metrics['reads' if kind == 'read' else 'writes'] += 1
+                self._metrics['by_method'][name] = self._metrics['by_method'].get(name, 0) + 1
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                if self.on_call: self.on_call(name, kind, time.perf_counter() - start)
+                return result
+            except Exception as e:
+                if self.on_call: self.on_call(name, kind, time.perf_counter() - start)
+                retryable = RETRY_STATUS if kind == 'read' else WRITE_RETRY_STATUS
+                if _status_of(e) not in retryable or attempt >= self.max_retries:
+                    self._count(errors=1)
+                    raise
+                delay = min(self.max_backoff, 2 ** attempt) + random.uniform(0, 1)
+                attempt += 1
+                self._count(retries=1, backoff_wait_s=delay)
+                time.sleep(delay)
+
+
+class _Proxy:
+    def __init__(self, target, owner):
+        self._target = target
+        self._owner = owner
+
+    def _scope(self):
+        return (getattr(self._target, 'id', None),)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr) or (name not in READ_METHODS and name not in WRITE_METHODS): return attr
+        kind = 'read' if name in READ_METHODS else 'write'
+
+        def wrapped(*args, **kwargs):
+            key = None
+            if kind == 'read':
+                key = self._scope() + (name, repr(args), repr(sorted(kwargs.items())))
+            try: result = self._owner.call(attr, name, args, kwargs, kind, key)
+            except gspread.exceptions.APIError as e:
+                if _status_of(e) not in STALE_STATUS or not self._stale(name): raise
+                # Lệnh bị từ chối nên chưa được áp dụng: gửi lại một lần với handle vừa tra lại
+                return getattr(self, name)(*args, **kwargs)
+            return self._wrap(name, result)
+        return wrapped
+
+    def _wrap(self, name, result):
+        return result
+
+    def _stale(self, name):
+        # True nếu đã thay handle hỏng bằng handle mới và có thể gửi lại lệnh
+        return False
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self._target!r}>"
+
+
+class _SpreadsheetProxy(_Proxy):
+    def __init__(self, target, owner):
+        super().__init__(target, owner)
+        self._worksheets = {}
+
+    def worksheet(self, title):
+        # Lưu lại worksheet đã tìm để khỏi tốn một lượt đọc metadata mỗi lần
+        ws = self._worksheets.get(title)
+        if ws is None:
+            ws = self.__getattr__('worksheet')(title)
+            self._worksheets[title] = ws
+        return ws
+
+    def _wrap(self, name, result):
+        if name in ('worksheet', 'add_worksheet', 'get_worksheet', 'get_worksheet_by_id'):
+            result = _WorksheetProxy(result, self._owner, self)
+            if name == 'add_worksheet': self._worksheets[result.title] = result
+        elif name == 'worksheets':
+            result = [_WorksheetProxy(w, self._owner, self) for w in result]
+        elif name == 'del_worksheet':
+            self._worksheets.clear()
+        return result
+
+    def _stale(self, name):
+        # batch_update mang sheetId lấy từ handle trong cache: bỏ cache để lần gửi sau (hàng đợi ghi
+        # tự thử lại) tra lại worksheet. Không gửi lại ở đây vì nội dung lệnh do người gọi dựng
+        if name == 'batch_update': self._worksheets.clear()
+        return False
+
+    def _resolve(self, title):
+        self._worksheets.pop(title, None)
+        try: return self.worksheet(title)
+        except gspread.WorksheetNotFound: return None
+
+
+class _WorksheetProxy(_Proxy):
+    def __init__(self, target, owner, parent=None):
+        super().__init__(target, owner)
+        self._parent = parent
+
+    def _scope(self):
+        return (getattr(self._target, 'spreadsheet_id', None), self._target.id)
+
+    def _stale(self, name):
+        # Tra lại worksheet theo tên; cùng id nghĩa là lỗi thật (vd. sai vùng ô), không gửi lại
+        if self._parent is None: return False
+        fresh = self._parent._resolve(self._target.title)
+        if fresh is None or fresh._target.id == self._target.id: return False
+        self._target = fresh._target
+        return True
+
+
+# --- ĐỌC NHIỀU WORKSHEET TRONG MỘT LẦN GỌI ---
+def values_to_records(values):
+    # Giống get_all_records: dòng đầu là tiêu đề, các dòng sau được bù ô trống và đổi sang số
+    if not values: return []
+    header = values[0]
+    width = len(header)
+    return [dict(zip(header, numericise_all((list(row) + [""] * width)[:width]))) for row in values[1:]]
+
+
+def batch_get_records(sh, titles, max_workers=4):
+    # Một lệnh values_batch_get cho tất cả worksheet; nếu có sheet chưa tồn tại thì Google trả
+    # lỗi 400 cho cả lô, khi đó đọc từng sheet song song và coi sheet thiếu là rỗng.
+    try:
+        resp = sh.values_batch_get(["'%s'" % t.replace("'", "''") for t in titles])
+        return {t: values_to_records(vr.get('values', [])) for t, vr in zip(titles, resp.get('valueRanges', []))}
+    except gspread.exceptions.APIError as e:
+        if _status_of(e) != 400: raise
+
+    def one(title):
+        try: return sh.worksheet(title).get_all_records()
+        except gspread.WorksheetNotFound: return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(titles))) as pool:
+        return dict(zip(titles, pool.map(one, titles)))
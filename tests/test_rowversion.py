@@ -0,0 +1,39 @@
+import json
+
+from rowversion import VERSION_FIELD, make_patch, merge_patch
+
+
+def test_concurrent_set_on_same_field_conflicts():
+    # Người khác đã đổi ghi chú từ "a" sang "b" sau khi patch được tạo ở version 1
+    record = {'order_id': "1", 'note': "b", VERSION_FIELD: 2}
+    patch = make_patch(set_={'note': "c"}, base={'note': "a"}, base_version=1)
+    values, conflicts = merge_patch(record, patch)
+    assert values is None
+    assert conflicts == ['note']
+
+
+def test_concurrent_set_on_other_field_merges():
+    record = {'order_id': "1", 'note': "b", 'status': "Mới", VERSION_FIELD: 2}
+    patch = make_patch(set_={'status': "Xong"}, base={'status': "Mới"}, base_version=1)
+    values, conflicts = merge_patch(record, patch)
+    assert conflicts == []
+    assert values == {'status': "Xong", VERSION_FIELD: 3}
+
+
+def test_inc_patches_compose():
+    # Hai phiên cùng thu tiền từ version 1: lần thứ hai bị cũ nhưng vẫn cộng dồn được
+    record = {'order_id': "1", 'financial': json.dumps({'total': 100, 'paid': 10}), VERSION_FIELD: 1}
+    first = make_patch(inc={'financial.paid': 20}, base_version=1)
+    second = make_patch(inc={'financial.paid': 30}, base_version=1)
+    for patch in (first, second):
+        values, conflicts = merge_patch(record, patch)
+        assert conflicts == []
+        record.update(values)
+    assert json.loads(record['financial'])['paid'] == 60
+    assert record[VERSION_FIELD] == 3
+
+
+def test_inc_with_base_conflicts_when_base_changed():
+    record = {'order_id': "1", 'financial': json.dumps({'paid': 50}), VERSION_FIELD: 2}
+    patch = make_patch(inc={'financial.paid': 20}, base={'financial.paid': 10}, base_version=1)
+    assert merge_patch(record, patch) == (None, ['financial.paid'])
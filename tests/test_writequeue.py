@@ -0,0 +1,71 @@
+import pytest
+
+from bench.fake_gspread import FakeClient
+from datastore import LocalStore, WriteQueue, coalesce_ops
+from rowversion import VERSION_FIELD, make_patch, merge_patch, row_version
+
+URL = "https://docs.google.com/spreadsheets/d/test/edit"
+HEADER = ["item_id", "qty", "note", VERSION_FIELD]
+LAYOUTS = {"Items": (HEADER, 100, 4)}
+
+
+@pytest.fixture
+def backend(tmp_path):
+    client = FakeClient()
+    sh = client.spreadsheet(URL)
+    sh.load({"Items": [HEADER, ["1", 5, "a", 1], ["2", 8, "b", 1]]})
+    store = LocalStore(lambda sheet: sh.worksheet(sheet).get_all_records())
+    queue = WriteQueue(lambda: client, URL, store, LAYOUTS, str(tmp_path / "journal.jsonl"), debounce=0)
+    return sh.worksheet("Items"), store, queue
+
+
+def op(kind, key_value, **extra):
+    return dict({'sheet': "Items", 'op': kind, 'header': HEADER, 'key': "item_id", 'key_value': key_value}, **extra)
+
+
+def patch_op(store, key_value, patch):
+    # Giống order_patch_op trong app.py: gộp trên bản cục bộ, ghi kèm version mong đợi
+    rec = next(r for r in store.get("Items") if str(r['item_id']) == key_value)
+    values, conflicts = merge_patch(rec, patch)
+    assert not conflicts
+    return op('update', key_value, values=values, patch=patch, expect=row_version(rec))
+
+
+def test_update_delete_append_same_key_coalesce():
+    plan = coalesce_ops([op('update', "1", values={'qty': 6}),
+                         op('delete', "1"),
+                         {'sheet': "Items", 'op': 'append', 'header': HEADER, 'row': ["1", 9, "mới", 1]}])
+    assert plan['updates'] == {}
+    assert plan['deletes'] == ["1"]
+    assert plan['appends'] == [["1", 9, "mới", 1]]
+
+
+def test_update_delete_append_same_key_flush(backend):
+    ws, store, queue = backend
+    store.get("Items")
+    queue.submit_many([op('update', "1", values={'qty': 6}),
+                       op('delete', "1"),
+                       {'sheet': "Items", 'op': 'append', 'header': HEADER, 'row': ["1", 9, "mới", 1]}])
+    assert queue.flush(10)
+    assert ws.rows == [HEADER, ["2", 8, "b", 1], ["1", 9, "mới", 1]]
+
+
+def test_stale_version_is_rebased(backend):
+    ws, store, queue = backend
+    store.get("Items")
+    # Nơi khác đã cộng thêm 5 vào dòng 1 sau khi bản cục bộ được tải
+    ws.rows[1] = ["1", 10, "a", 2]
+    queue.submit(patch_op(store, "1", make_patch(inc={'qty': 2}, base_version=1)))
+    assert queue.flush(10)
+    assert ws.rows[1] == ["1", 12, "a", 3]
+    assert not queue.status()['conflicts']
+
+
+def test_stale_version_conflict_is_dropped(backend):
+    ws, store, queue = backend
+    store.get("Items")
+    ws.rows[2] = ["2", 8, "khác", 2]
+    queue.submit(patch_op(store, "2", make_patch(set_={'note': "c"}, base={'note': "b"}, base_version=1)))
+    assert queue.flush(10)
+    assert ws.rows[2] == ["2", 8, "khác", 2]
+    assert [c['fields'] for c in queue.status()['conflicts']] == [['note']]